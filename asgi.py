@@ -0,0 +1,641 @@
+# --- Async Mode ---
+# Serves main.py's endpoints from an ASGI server and runs post jobs as coroutines on the
+# server's event loop instead of on POST_WORKER_CONCURRENCY worker threads. A post spends
+# nearly all of its time waiting on providers and the Graph API, so each in-flight post costs
+# an asyncio task rather than a worker thread plus a publish thread per target, and one
+# instance can hold hundreds of posts in flight:
+#   - image generation and captions use the providers' async SDK clients; Stability's gRPC
+#     client has no async API and runs in a worker thread,
+#   - Graph API and Threads calls go through one pooled httpx.AsyncClient,
+#   - container waits register with main.py's shared container poller, which wakes the task,
+#   - short synchronous steps (prompt building, encoding, the GCS upload, the state store)
+#     run on the loop's default executor, ASYNC_THREAD_POOL_SIZE threads.
+# The Flask endpoints only validate and enqueue, so they are served as they are through a
+# WSGI adapter, on ASYNC_REQUEST_THREADS threads of their own. Jobs keep main.py's spans,
+# deadlines, checkpoints, idempotency keys, provider health and content buffer; jobs without
+# an async variant (resumes) run in a thread.
+#
+#   uvicorn asgi:app --host 0.0.0.0 --port 8080
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import httpx  # type: ignore
+from asgiref.sync import sync_to_async  # type: ignore
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance  # type: ignore
+
+# Jobs are cheap here, so allow a deeper queue than the threaded default; must be set before main loads
+os.environ.setdefault('POST_QUEUE_MAX', '500')
+
+import main  # noqa: E402
+
+# --- Async Configuration ---
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', '200'))  # jobs running at once; the rest wait queued
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', '100'))
+# Threads for the synchronous steps; Stability calls and rate limit waits hold one for seconds
+ASYNC_THREAD_POOL_SIZE = int(os.environ.get('ASYNC_THREAD_POOL_SIZE', '64'))
+ASYNC_REQUEST_THREADS = int(os.environ.get('ASYNC_REQUEST_THREADS', '16'))  # Flask requests served at once
+
+main.register_client('openai_async', lambda: main.lazy_import('openai').AsyncOpenAI(api_key=main.OPENAI_TOKEN))
+
+event_loop = None
+job_slots = None  # asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+# Threads that wait for main.provider_semaphores; waits beyond ASYNC_MAX_IN_FLIGHT queue, within their budget
+slot_executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_IN_FLIGHT, thread_name_prefix='async-slot')
+http_client = None
+
+# --- Runtime ---
+
+def install_async_runtime(loop):
+    """
+    Route every job enqueued from now on to run_job_async on the given event loop.
+    """
+    global event_loop, job_slots, http_client
+    event_loop = loop
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_THREAD_POOL_SIZE, thread_name_prefix='async-step'))
+    job_slots = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS, max_keepalive_connections=main.HTTP_POOL_SIZE))
+    main.job_dispatcher = dispatch_job
+    print(f"Async mode: jobs run on the event loop, up to {ASYNC_MAX_IN_FLIGHT} at once")
+
+def start_async_runtime():
+    """
+    Run an event loop on a background thread and install it, for servers that are not ASGI
+    (the load harness, gunicorn). Returns the loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='async-jobs', daemon=True).start()
+    install_async_runtime(loop)
+    return loop
+
+async def stop_async_runtime():
+    """
+    Stop routing jobs to the event loop and close the async HTTP client.
+    """
+    main.job_dispatcher = None
+    if http_client is not None:
+        await http_client.aclose()
+
+def dispatch_job(job_id, target, args):
+    """
+    main.job_dispatcher: schedule a queued job on the event loop. Safe to call from any thread.
+    """
+    try:
+        future = asyncio.run_coroutine_threadsafe(run_job_async(job_id, target, args), event_loop)
+    except Exception as e:
+        fail_undispatched_job(job_id, e)
+        return
+    future.add_done_callback(lambda done: report_dispatch_failure(job_id, done))
+
+def report_dispatch_failure(job_id, future):
+    """
+    Done callback for a dispatched job: fail the job if it never got as far as run_job_in_context,
+    whose own errors are recorded by finish_job, so it does not stay queued.
+    """
+    error = RuntimeError("Job was cancelled before it started") if future.cancelled() else future.exception()
+    if error is not None:
+        fail_undispatched_job(job_id, error)
+
+def fail_undispatched_job(job_id, error):
+    print(f"Could not start job {job_id}: {error}")
+    job = main.get_job(job_id) or {}
+    main.finish_job(job_id, job.get('kind', ''), job.get('started_at') or job.get('created_at') or time.time(), error=error)
+
+async def run_job_async(job_id, target, args):
+    """
+    Run a job's pipeline as a task and record its outcome, like main.run_job.
+    """
+    async with job_slots:
+        # begin_job writes the checkpoint, so it runs on the executor. It also sets the job's context
+        # variables; running it in an explicit context and starting the job's task from that
+        # context (tasks copy the context they are created in) carries them over.
+        context = contextvars.copy_context()
+        kind, started = await asyncio.get_running_loop().run_in_executor(None, context.run, main.begin_job, job_id)
+        await context.run(asyncio.ensure_future, run_job_in_context(job_id, kind, started, target, args))
+
+async def run_job_in_context(job_id, kind, started, target, args):
+    try:
+        main.check_deadline('start')  # the budget may have gone on queue wait
+        async_target = ASYNC_TARGETS.get(target)
+        if async_target is None:
+            result = await asyncio.to_thread(target, *args)
+        else:
+            result = await async_target(*args)
+    except Exception as e:
+        await asyncio.to_thread(main.finish_job, job_id, kind, started, error=e)
+        return
+    await asyncio.to_thread(main.finish_job, job_id, kind, started, result=result)
+
+async def within_budget(stage, fn, *args, **kwargs):
+    """
+    Await fn(*args, **kwargs), giving up with TimeoutError after main.PROVIDER_CALL_TIMEOUT_SECONDS,
+    or with DeadlineExceeded when the job's budget runs out first.
+    Abandoned async SDK calls are cancelled. Stability runs in a worker thread through
+    asyncio.to_thread, and like main.run_within_budget that call keeps running after the wait
+    is abandoned; its result is discarded.
+    """
+    call_timeout = main.PROVIDER_CALL_TIMEOUT_SECONDS or None
+    timeout = main.budget_timeout(call_timeout, stage)
+    try:
+        return await asyncio.wait_for(fn(*args, **kwargs), timeout)
+    except asyncio.TimeoutError:
+        if call_timeout is None or timeout < call_timeout:
+            raise main.DeadlineExceeded(f"Job deadline exceeded during {stage}") from None
+        raise TimeoutError(f"{stage} did not return within {call_timeout:g}s") from None
+
+# --- Async HTTP ---
+
+async def async_http_request(method, url, timeout=None, **kwargs):
+    """
+    Async counterpart of main.http_request on the shared httpx.AsyncClient, with the same
+    retry rules: 429 for every method, 5xx and connection errors only for GET and HEAD,
+    connect timeouts for every method, all within the current job's deadline.
+
+    Returns the final httpx.Response.
+    """
+    method = method.upper()
+    idempotent = method in ('GET', 'HEAD')
+    connect_timeout, read_timeout = timeout or (main.HTTP_CONNECT_TIMEOUT, main.HTTP_READ_TIMEOUT)
+    attempt = 0
+    while True:
+        stage = f"{method} {urlsplit(url).netloc}"
+        attempt_timeout = httpx.Timeout(main.budget_timeout(read_timeout, stage), connect=main.budget_timeout(connect_timeout, stage))
+        try:
+            response = await http_client.request(method, url, timeout=attempt_timeout, **kwargs)
+        except httpx.ConnectTimeout as e:
+            if attempt >= main.HTTP_MAX_RETRIES:
+                raise
+            delay = main.retry_delay(attempt)
+            print(f"Connect timeout for {method} {urlsplit(url).netloc}: {e}. Retrying in {delay:.1f}s")
+        except httpx.TransportError as e:
+            if isinstance(e, httpx.TimeoutException):
+                main.check_deadline(f"{stage} (request timed out)")
+            if not idempotent or attempt >= main.HTTP_MAX_RETRIES:
+                raise
+            delay = main.retry_delay(attempt)
+            print(f"Request error for {method} {urlsplit(url).netloc}: {e}. Retrying in {delay:.1f}s")
+        else:
+            retryable = response.status_code == 429 or (idempotent and response.status_code in main.RETRY_STATUS_CODES)
+            if not retryable or attempt >= main.HTTP_MAX_RETRIES:
+                return response
+            delay = main.retry_delay(attempt, response.headers.get('Retry-After'))
+            print(f"Received status {response.status_code} for {method} {urlsplit(url).netloc}. Retrying in {delay:.1f}s")
+        remaining = main.remaining_budget()
+        if remaining is not None and delay >= remaining:
+            raise main.DeadlineExceeded(f"Job deadline exceeded before retrying {stage}")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+async def download_image_async(url):
+    """
+    Download an image from a provider URL into memory.
+    """
+    print(f"Downloading image: {url}")
+    response = await async_http_request('GET', url)
+    if response.status_code != 200:
+        raise Exception(f"Failed to download image: {response.status_code}")
+    mime_type = response.headers.get('Content-Type', 'image/png').split(';')[0]
+    return {'data': response.content, 'mime_type': mime_type}
+
+# --- Provider Calls ---
+
+async def call_provider_async(provider, fn, *args, **kwargs):
+    """
+    Await a provider's async generation call through its circuit breaker and rate limiter,
+    like main.call_provider. Waiting for a rate limit token happens in a worker thread.
+    """
+    await asyncio.to_thread(main.reserve_provider_call, provider)
+    try:
+        result = await within_budget('provider call', fn, *args, **kwargs)
+    except Exception as e:
+        raise main.provider_call_failed(provider, e)
+    main.record_provider_result(provider, True)
+    main.increment_counter('instabot_provider_calls_total', provider=provider, outcome='ok')
+    return result
+
+async def track_generation_async(provider, strategy, generate, *args, reservation=None):
+    """
+    Run a provider's async generation call through call_provider_async and record the attempt.
+
+    Returns:
+        tuple: (artifact, performance), like main.track_generation
+    """
+    started_at = time.time()
+    started = time.perf_counter()
+    try:
+        with main.stage_span('generation'):
+            artifact = await call_provider_async(provider, generate, *args)
+    except Exception as e:
+        await asyncio.to_thread(main.release_combination, reservation)
+        if isinstance(e, main.ProviderUnavailable) and e.__cause__ is not None:  # the call ran and failed, rather than being rejected
+            await asyncio.to_thread(main.record_prompt_attempt, provider, strategy, False)
+        raise
+    return await asyncio.to_thread(main.record_generation, provider, strategy, artifact, started_at, time.perf_counter() - started, reservation)
+
+async def generate_stability_image_async(my_prompt, negative_prompt):
+    """
+    Stability's gRPC client has no async API, so the call runs in a worker thread.
+    """
+    return await asyncio.to_thread(main.generate_stability_image, my_prompt, negative_prompt)
+
+async def generate_dalle_image_async(my_prompt):
+    print("Generating image with DALL-E...")
+    response = await main.get_client('openai_async').images.generate(**main.dalle_request(my_prompt))
+    print(f"DALL-E response: {response}")
+    return {'source_url': response.data[0].url}
+
+async def generate_imagen_image_async(my_prompt):
+    print("Generating image with Gemini 3.1 Flash Image...")
+    result = await main.get_client('genai').aio.models.generate_content(**main.imagen_request(my_prompt))
+    print("Image generation complete.")
+    return main.imagen_artifact(result)
+
+ASYNC_GENERATORS = {
+    'stability': generate_stability_image_async,
+    'dalle': generate_dalle_image_async,
+    'imagen': generate_imagen_image_async,
+}
+PROMPT_BUILDERS = {
+    'stability': main.build_stability_prompt,
+    'dalle': main.build_openai_prompt,
+    'imagen': main.build_imagen_prompt,
+}
+
+# --- Async Captions ---
+
+async def gemini_caption_async(prompt_text, image_bytes, mime_type, image_url):
+    if image_bytes is None:
+        # Streamed upload: the Gemini Developer API takes the image as bytes, not by URL
+        image_bytes = (await download_image_async(image_url))['data']
+    response = ""
+    async for chunk in await main.get_client('genai').aio.models.generate_content_stream(
+            **main.gemini_caption_request(image_bytes, prompt_text, mime_type, image_url)):
+        response += chunk.text or ""
+    print(f"Gemini response: {response}")
+    return response
+
+async def openai_vision_caption_async(prompt_text, image_bytes, mime_type, image_url):
+    print(f"Generating OpenAI vision description for image: {image_url}")
+    response = await main.get_client('openai_async').chat.completions.create(**main.openai_vision_request(image_url, prompt_text=prompt_text))
+    ai_response = response.choices[0].message.content
+    print(f"OpenAI vision response: {ai_response}")
+    return ai_response
+
+CAPTION_CALLERS_ASYNC = {
+    'gemini': gemini_caption_async,
+    'openai': openai_vision_caption_async,
+}
+
+async def request_caption_async(provider, prompt_text, image_bytes, mime_type, image_url):
+    started = time.perf_counter()
+    text = main.usable_caption(await CAPTION_CALLERS_ASYNC[provider](prompt_text, image_bytes, mime_type, image_url))
+    main.record_caption_sample(provider, time.perf_counter() - started)
+    return text
+
+async def generate_caption_async(my_prompt, image_bytes, mime_type, image_url):
+    """
+    Caption an image with the same hedging as main.generate_caption. The slower request is
+    cancelled outright once another provider has answered.
+
+    Returns:
+        tuple: (caption text, provider that wrote it)
+    """
+    providers = [provider for provider in main.CAPTION_PROVIDERS if provider in CAPTION_CALLERS_ASYNC]
+    if not providers:
+        raise main.CaptionError(f"No caption provider configured (CAPTION_PROVIDERS={main.CAPTION_PROVIDERS})")
+    prompt_text = main.get_chat_with_image_template(my_prompt)
+    loop = asyncio.get_running_loop()
+    budget = main.budget_timeout(main.CAPTION_TIMEOUT_SECONDS, 'caption')
+    deadline = loop.time() + budget
+    pending = {}  # task -> provider
+    errors = []
+    next_index, hedge_at = 0, loop.time()
+    try:
+        while pending or next_index < len(providers):
+            now = loop.time()
+            if now >= deadline:
+                if budget < main.CAPTION_TIMEOUT_SECONDS:
+                    raise main.DeadlineExceeded(f"Job deadline exceeded waiting for a caption from {', '.join(pending.values())}")
+                raise main.CaptionError(f"No caption within {main.CAPTION_TIMEOUT_SECONDS}s from {', '.join(pending.values())}")
+            if next_index < len(providers) and (not pending or now >= hedge_at):
+                provider = providers[next_index]
+                if pending:
+                    print(f"Caption from {', '.join(pending.values())} is slow, hedging with {provider}")
+                    main.increment_counter('instabot_caption_hedges_total', provider=provider)
+                task = asyncio.ensure_future(request_caption_async(provider, prompt_text, image_bytes, mime_type, image_url))
+                pending[task] = provider
+                next_index += 1
+                hedge_at = now + main.caption_hedge_delay(provider)
+                continue
+            wait_until = min(deadline, hedge_at) if next_index < len(providers) else deadline
+            done, _ = await asyncio.wait(pending, timeout=max(0, wait_until - now), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                provider = pending.pop(task)
+                try:
+                    text = task.result()
+                except Exception as e:
+                    print(f"Caption from {provider} failed: {e}")
+                    main.increment_counter('instabot_caption_requests_total', provider=provider, outcome='failed')
+                    errors.append(f"{provider}: {e}")
+                    continue
+                main.increment_counter('instabot_caption_requests_total', provider=provider, outcome='won')
+                return text, provider
+        raise main.CaptionError(f"No usable caption ({'; '.join(errors)})")
+    finally:
+        for task, provider in pending.items():
+            task.cancel()
+            main.increment_counter('instabot_caption_requests_total', provider=provider, outcome='cancelled')
+
+# --- Async Publishing ---
+# Same container lifecycle as main.publish_instagram_feed / _story / publish_threads, table-driven.
+
+GRAPH_ACCOUNTS = {
+    'instagram': {'url': f"{main.INSTAGRAM_GRAPH_URL}/{main.BUSINESS_ACCOUNT_ID}", 'edge': 'media', 'access_token': main.PAGE_ACCESS_TOKEN},
+    'threads': {'url': f"{main.THREADS_GRAPH_URL}/{main.THREADS_USER_ID}", 'edge': 'threads', 'access_token': main.THREADS_API_TOKEN},
+}
+GRAPH_TARGETS = {
+    'instagram_feed': {'kind': 'instagram', 'params': lambda image_url, caption: {'image_url': image_url, 'caption': caption}},
+    'instagram_story': {'kind': 'instagram', 'params': lambda image_url, caption: {'image_url': image_url, 'media_type': 'STORIES'}},
+    # Threads accepts at most 500 characters of text
+    'threads': {'kind': 'threads', 'params': lambda image_url, caption: {'media_type': 'IMAGE', 'image_url': image_url, 'text': caption[:500]}},
+}
+
+async def graph_post_async(url, params, action):
+    """
+    POST to the Graph API and return the 'id' of the result.
+    """
+    print(f"--- REQUEST ---\n  Method: POST, URL: {url}, Params: {params}")
+    response = await async_http_request('POST', url, params={key: value for key, value in params.items() if value})
+    print(f"--- RESPONSE ---\n  Status: {response.status_code}\n  Text: {response.text}")
+    if response.status_code != 200:
+        raise Exception(f"Failed to {action}: {response.text}")
+    return response.json()['id']
+
+async def publish_target_async(target, image_url, caption, container_id=None):
+    """
+    Create (or reuse), wait for and publish one target's container. Returns the published ID,
+    or None when a checkpointed container turned out to be published already.
+    """
+    kind = GRAPH_TARGETS[target]['kind']
+    account = GRAPH_ACCOUNTS[kind]
+    if container_id:
+        status = (await asyncio.to_thread(main.fetch_container_statuses, kind, [container_id], account['access_token'])).get(container_id, (None, None))[0]
+        action = main.checkpointed_container_action(target, container_id, status)
+        if action == 'published':
+            return None
+        if action == 'create':
+            container_id = None
+    if not container_id:
+        with main.stage_span('container_create', target=target):
+            container_id = await graph_post_async(f"{account['url']}/{account['edge']}",
+                                                  {'access_token': account['access_token'], **GRAPH_TARGETS[target]['params'](image_url, caption)},
+                                                  f"create {target} container")
+        await asyncio.to_thread(main.checkpoint_target, target, container_id=container_id)
+    print(f"Created {target} container with ID: {container_id}")
+    with main.stage_span('status_poll', target=target):
+        await wait_for_container_async(kind, container_id, account['access_token'])
+    with main.stage_span('publish', target=target):
+        return await graph_post_async(f"{account['url']}/{account['edge']}_publish",
+                                      {'access_token': account['access_token'], 'creation_id': container_id},
+                                      f"publish to {target}")
+
+async def wait_for_container_async(kind, media_id, access_token, timeout=120):
+    """
+    Register a container with main.py's shared poller and wait, without holding a thread,
+    until it is FINISHED. Raises like main.wait_for_container.
+    """
+    label = main.CONTAINER_KINDS[kind]['label']
+    print(f"Waiting for {label} {media_id} to be ready...")
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    budget = main.budget_timeout(timeout, f"waiting for {label}")
+    deadline = loop.time() + budget
+    with main.poller_condition:
+        entry = main.watch_container(kind, media_id, access_token, wake=lambda: loop.call_soon_threadsafe(changed.set))
+    try:
+        while True:
+            changed.clear()
+            with main.poller_condition:
+                status, data = entry['status'], entry['data']
+            if status == 'FINISHED':
+                print(f"{label} {media_id} is ready for publishing.")
+                return True
+            if status in main.CONTAINER_FAILED_STATUSES:
+                raise Exception(f"{label} failed with status: {status}. Full response: {data}")
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                with main.poller_condition:
+                    main.poller_stats['timed_out'] += 1
+                if budget < timeout:
+                    raise main.DeadlineExceeded(f"Job deadline exceeded waiting for {label} {media_id}")
+                raise Exception(f"{label} not ready after {timeout} seconds.")
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        with main.poller_condition:
+            main.watched_containers.pop((kind, media_id), None)
+
+async def publish_to_targets_async(image_url, caption, targets, container_ids=None):
+    """
+    Publish to several targets concurrently, like main.publish_to_targets.
+
+    Returns:
+        dict: target -> {"status": "published", "id": ...}, or "timed_out"/"failed" with an error
+    """
+    container_ids = container_ids or {}
+    outcomes = await asyncio.gather(*(publish_target_async(target, image_url, caption, container_ids.get(target)) for target in targets),
+                                    return_exceptions=True)
+    results = {}
+    for target, outcome in zip(targets, outcomes):
+        if isinstance(outcome, main.DeadlineExceeded):
+            print(f"Publishing to {target} timed out: {outcome}")
+            results[target] = {"status": "timed_out", "error": str(outcome)}
+        elif isinstance(outcome, BaseException):
+            print(f"Failed to publish to {target}: {outcome}")
+            results[target] = {"status": "failed", "error": str(outcome)}
+        else:
+            results[target] = {"status": "published", "id": outcome}
+            print(f"Published to {target}: {outcome}")
+        await asyncio.to_thread(main.checkpoint_target, target, **results[target])
+    return results
+
+# --- Async Pipelines ---
+
+async def prepare_provider_post_async(provider):
+    """
+    Async counterpart of main's prepare_<provider>_post.
+    """
+    print(f"--- Preparing {provider} post ---")
+    my_prompt, generate_args, reservation = await asyncio.to_thread(PROMPT_BUILDERS[provider])
+    artifact, performance = await track_generation_async(provider, 'enhanced', ASYNC_GENERATORS[provider], *generate_args, reservation=reservation)
+    if 'data' not in artifact and not main.STREAM_URL_UPLOADS:
+        with main.stage_span('download'):
+            artifact = await download_image_async(artifact['source_url'])
+    prepared, image_bytes = await asyncio.to_thread(main.upload_artifact, provider, artifact, my_prompt, main.POST_HASHTAGS[provider], performance)
+
+    # Generate caption using vision models; streamed images are read back from their public URL
+    print("Generating caption...")
+    with main.stage_span('caption'):
+        ai_response, caption_provider = await generate_caption_async(my_prompt, image_bytes, prepared['mime_type'], prepared['image_url'])
+    print(f"--- Prepared {provider} post ---")
+    return main.add_caption(prepared, ai_response, caption_provider)
+
+async def acquire_provider_slot(provider):
+    """
+    Take one of main.provider_semaphores[provider], so async jobs, threaded jobs and the content
+    buffer producers share one PROVIDER_CONCURRENCY limit. A wait runs on slot_executor, within
+    the job's budget; raises DeadlineExceeded when the budget runs out first.
+    """
+    semaphore = main.provider_semaphores[provider]
+    if semaphore.acquire(blocking=False):
+        return
+    timeout = main.budget_timeout(None, 'provider slot')
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def acquire():
+        # Computed here, since the wait may have queued for a slot_executor thread
+        return semaphore.acquire(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+
+    def release_if_acquired(done):
+        if not done.cancelled() and done.exception() is None and done.result():
+            semaphore.release()
+
+    future = asyncio.get_running_loop().run_in_executor(slot_executor, acquire)
+    try:
+        acquired = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(release_if_acquired)  # the wait goes on in its thread; give back what it takes
+        raise
+    if not acquired:
+        raise main.DeadlineExceeded(f"Job deadline exceeded waiting for a {provider} slot")
+
+async def prepare_post_async(provider, fallback=True):
+    """
+    Run a provider's prepare step within its PROVIDER_CONCURRENCY limit, falling back like main.prepare_post.
+    """
+    errors = []
+    for candidate in main.prepare_candidates(provider, fallback):
+        if not main.provider_available(candidate):
+            errors.append(f"{candidate}: circuit open")
+            continue
+        started = time.perf_counter()
+        token = main.trace_provider_var.set(candidate)
+        try:
+            await acquire_provider_slot(candidate)
+            try:
+                prepared = await prepare_provider_post_async(candidate)
+            finally:
+                main.provider_semaphores[candidate].release()
+        except main.ProviderUnavailable as e:
+            print(f"Provider {candidate} unavailable: {e}")
+            main.record_prepare_sample(candidate, time.perf_counter() - started, False)
+            errors.append(f"{candidate}: {e}")
+            continue
+        except Exception:
+            main.record_prepare_sample(candidate, time.perf_counter() - started, False)
+            raise
+        finally:
+            main.trace_provider_var.reset(token)
+        main.record_prepare_sample(candidate, time.perf_counter() - started, True)
+        if candidate != provider:
+            print(f"Prepared {provider} post with fallback provider {candidate}")
+            prepared['fallback_from'] = provider
+        return prepared
+    raise main.ProviderUnavailable(f"No available provider for {provider} post ({'; '.join(errors)})")
+
+async def publish_prepared_post_async(prepared, targets=None, container_ids=None, already_published=None):
+    """
+    Publish a prepared post to Instagram and Threads, like main.publish_prepared_post.
+    """
+    targets = await asyncio.to_thread(main.begin_publish, prepared, targets)
+    token = main.trace_provider_var.set(prepared['provider'])
+    started = time.time()
+    try:
+        publish_results = {**(already_published or {}), **await publish_to_targets_async(prepared['image_url'], prepared['caption'], targets, container_ids)}
+    finally:
+        main.trace_provider_var.reset(token)
+    return await asyncio.to_thread(main.finish_publish, prepared, publish_results, already_published, started)
+
+async def run_post_async(provider):
+    return await publish_prepared_post_async(await prepare_post_async(provider))
+
+async def run_batch_post_async(counts):
+    """
+    Prepare and publish counts[provider] posts for each provider as concurrent tasks,
+    with the same per-item results and summary as main.run_batch_post.
+    """
+    providers = [provider for provider, n in counts.items() for _ in range(n)]
+    print(f"--- Starting batch of {len(providers)} posts: {counts} ---")
+    outcomes = await asyncio.gather(*(run_post_async(provider) for provider in providers), return_exceptions=True)
+    items = []
+    for index, (provider, outcome) in enumerate(zip(providers, outcomes)):
+        if isinstance(outcome, main.DeadlineExceeded):
+            print(f"Batch item {index} ({provider}) timed out: {outcome}")
+            items.append({"index": index, "provider": provider, "status": "timed_out", "error": str(outcome)})
+        elif isinstance(outcome, BaseException):
+            print(f"Batch item {index} ({provider}) failed: {outcome}")
+            items.append({"index": index, "provider": provider, "status": "failed", "error": str(outcome)})
+        else:
+            items.append({"index": index, "provider": provider, "status": main.job_status_for_result(outcome), "result": outcome})
+    summary = {status: sum(1 for item in items if item['status'] == status) for status in ('succeeded', 'partial', 'timed_out', 'failed')}
+    print(f"--- Finished batch: {summary} ---")
+    return {"items": items, "summary": summary}
+
+# Job targets enqueued by main.py's endpoints -> their async variants
+ASYNC_TARGETS = {
+    main.run_stability_post: lambda: run_post_async('stability'),
+    main.run_openai_post: lambda: run_post_async('dalle'),
+    main.run_imagen_post: lambda: run_post_async('imagen'),
+    main.publish_prepared_post: publish_prepared_post_async,
+    main.run_batch_post: run_batch_post_async,
+}
+
+# --- ASGI App ---
+
+# asgiref runs every WSGI call on one shared thread (thread_sensitive=True), so a slow endpoint
+# such as /warmup would hold up every other request. Run them on a pool of their own instead.
+request_executor = ThreadPoolExecutor(max_workers=ASYNC_REQUEST_THREADS, thread_name_prefix='asgi-request')
+
+# asgiref has no option for this, so the adapter rewraps the plain function behind its
+# sync_to_async-decorated run_wsgi_app. Fail at import, not on the first request, if an asgiref
+# upgrade (requirements.txt pins 3.12.1) changes that.
+wsgi_app_function = getattr(WsgiToAsgiInstance.__dict__.get('run_wsgi_app'), 'func', None)
+if not callable(wsgi_app_function):
+    raise ImportError("asgi.py needs asgiref's WsgiToAsgiInstance.run_wsgi_app to be a sync_to_async wrapper "
+                      "with a .func attribute; check the installed asgiref against requirements.txt")
+
+class ThreadedWsgiInstance(WsgiToAsgiInstance):
+    run_wsgi_app = sync_to_async(wsgi_app_function, thread_sensitive=False, executor=request_executor)
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """
+    WsgiToAsgi that serves concurrent requests on request_executor.
+    """
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+wsgi_app = ThreadedWsgiToAsgi(main.app)
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point: installs the async runtime on the server's loop at startup and serves
+    HTTP requests with the Flask app.
+    """
+    if scope['type'] != 'lifespan':
+        return await wsgi_app(scope, receive, send)
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            install_async_runtime(asyncio.get_running_loop())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await stop_async_runtime()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,189 @@
+# --- Microbenchmarks ---
+# Times the CPU-bound work each post does besides waiting on the network: prompt building,
+# caption text assembly, PIL decode and re-encode of generated images, perceptual hashing and
+# building the inline image part sent to Gemini. Image benchmarks at 1024x1024 and 2048x2048 also
+# record one call's allocations: peak Python memory (tracemalloc, which covers bytes, BytesIO and
+# NumPy buffers) and the number of PIL images created, since Pillow allocates pixel memory in C
+# where tracemalloc cannot see it and every convert/crop/resize is another full-size copy.
+#
+# Results are compared against benchmarks/baseline.json; a benchmark regresses when its best
+# time (the least noisy estimate on a shared machine) or its peak memory exceeds the baseline by
+# more than the threshold, or when it creates more PIL images than before. Baselines are only
+# comparable on the machine they were recorded on, so record them where the comparison runs.
+#
+#   python -m benchmarks.bench                      # run and compare, exit 1 on a regression
+#   python -m benchmarks.bench --filter image       # only benchmarks whose name contains "image"
+#   python -m benchmarks.bench --update-baseline    # run and store the results as the new baseline
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import timeit
+import tracemalloc
+
+import main
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+IMAGE_SIZES = (1024, 2048)
+
+# --- Inputs ---
+
+def synthetic_png(size):
+    """
+    A deterministic, detailed RGB PNG, closer to a generated image than a flat fill.
+    """
+    from PIL import Image  # type: ignore
+    detail = Image.effect_mandelbrot((size, size), (-2.0, -1.25, 0.75, 1.25), 64)
+    noise = Image.effect_noise((size, size), 24)
+    gradient = Image.linear_gradient('L').resize((size, size))
+    img = Image.merge('RGB', (detail, noise, gradient))
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def build_benchmarks():
+    """
+    Return name -> (callable, tracks_memory). Inputs are built once, outside the timed code.
+    """
+    rng = random.Random(1)
+    vocab = main.PROMPT_VOCABULARIES
+    subject, style = vocab['cartoon'][0], vocab['pattern'][0]
+    prompt, _ = main.generate_enhanced_prompt(subject, style, 'stability', rng)
+    hashtags = "#api #stabilityai #stablediffusion #texttoimage"
+    caption = "A bright, playful scene full of colour and motion. Which detail did you spot first?"
+
+    benchmarks = {
+        'prompt.enhanced': (lambda: main.generate_enhanced_prompt(subject, style, 'stability', rng), False),
+        'prompt.contextual': (lambda: main.generate_contextual_prompt(vocab['topic'][0], vocab['place'][0], style), False),
+        'prompt.character': (lambda: main.generate_character_prompt(subject, style, rng), False),
+        'prompt.sample_1000': (lambda: main.sample_enhanced_prompts(1000, 'stability', seed=1), False),
+        'caption.assembly': (lambda: (main.get_chat_with_image_template(prompt), f"{caption} {hashtags}"), False),
+    }
+
+    try:
+        types = main.lazy_import('google.genai.types')
+    except ImportError:
+        types = None
+        print("google-genai is not installed, skipping caption.inline_image benchmarks")
+
+    Image = main.lazy_import('PIL.Image')
+    for size in IMAGE_SIZES:
+        png = synthetic_png(size)
+        jpeg = main.encode_for_instagram({'data': png, 'mime_type': 'image/png'})[0]['data']
+
+        def decode(data=png):
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+
+        benchmarks[f'image.decode_png_{size}'] = (decode, True)
+        benchmarks[f'image.encode_instagram_{size}'] = (lambda data=png: main.encode_for_instagram({'data': data, 'mime_type': 'image/png'}), True)
+        benchmarks[f'image.phash_{size}'] = (lambda data=jpeg: main.image_phash(data), True)
+        if types is not None:
+            # What the caption request costs before it leaves the process: the inline part and its base64 body
+            benchmarks[f'caption.inline_image_{size}'] = (
+                lambda data=jpeg: base64.b64encode(types.Part.from_bytes(data=data, mime_type='image/jpeg').inline_data.data), True)
+    return benchmarks
+
+# --- Measurement ---
+
+def measure(fn, tracks_memory, repeat):
+    """
+    Median and best seconds per call over `repeat` timing runs, plus peak traced memory of one call.
+    """
+    timer = timeit.Timer(fn)
+    loops, _ = timer.autorange()  # enough calls per run for the run to take at least 0.2s
+    runs = [seconds / loops for seconds in timer.repeat(repeat=repeat, number=loops)]
+    result = {'median_seconds': statistics.median(runs), 'best_seconds': min(runs), 'loops': loops}
+    if tracks_memory:
+        pil_core = main.lazy_import('PIL.Image').core
+        pil_before = pil_core.get_stats()['new_count']
+        tracemalloc.start()
+        fn()
+        result['peak_kib'] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        tracemalloc.stop()
+        result['pil_images'] = pil_core.get_stats()['new_count'] - pil_before
+    return result
+
+def machine_info():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor() or platform.machine()}
+
+def compare(results, baseline, time_threshold, memory_threshold):
+    """
+    Return (name, metric, baseline value, current value) for each regression beyond its threshold.
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if previous is None:
+            continue
+        if current['best_seconds'] > previous['best_seconds'] * (1 + time_threshold):
+            regressions.append((name, 'best_seconds', previous['best_seconds'], current['best_seconds']))
+        if 'peak_kib' in current and 'peak_kib' in previous and current['peak_kib'] > previous['peak_kib'] * (1 + memory_threshold):
+            regressions.append((name, 'peak_kib', previous['peak_kib'], current['peak_kib']))
+        if current.get('pil_images', 0) > previous.get('pil_images', current.get('pil_images', 0)):
+            regressions.append((name, 'pil_images', previous['pil_images'], current['pil_images']))
+    return regressions
+
+def format_seconds(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+def run():
+    parser = argparse.ArgumentParser(description="Run the CPU hot-path microbenchmarks and compare them with the baseline.")
+    parser.add_argument('--filter', default='', help="Only run benchmarks whose name contains this text")
+    parser.add_argument('--repeat', type=int, default=7, help="Timing runs per benchmark (default: 7)")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed best time increase over baseline (default: 0.25 = 25%%)")
+    parser.add_argument('--memory-threshold', type=float, default=0.10, help="Allowed peak memory increase over baseline (default: 0.10)")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="Baseline file (default: benchmarks/baseline.json)")
+    parser.add_argument('--update-baseline', action='store_true', help="Store these results as the baseline instead of comparing")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if baseline and baseline.get('machine') != machine_info() and not args.update_baseline:
+        print(f"Warning: baseline was recorded on {baseline.get('machine')}, this is {machine_info()}")
+
+    with contextlib.redirect_stdout(io.StringIO()):  # main.py logs every encode
+        benchmarks = build_benchmarks()
+    results = {}
+    print(f"{'benchmark':<32}{'median':>10}{'best':>10}{'baseline':>10}{'change':>9}{'peak KiB':>11}{'PIL images':>12}")
+    for name, (fn, tracks_memory) in benchmarks.items():
+        if args.filter not in name:
+            continue
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = measure(fn, tracks_memory, args.repeat)
+        previous = baseline.get('benchmarks', {}).get(name)
+        change = f"{results[name]['best_seconds'] / previous['best_seconds'] - 1:+.0%}" if previous else '-'
+        print(f"{name:<32}{format_seconds(results[name]['median_seconds']):>10}{format_seconds(results[name]['best_seconds']):>10}"
+              f"{format_seconds(previous['best_seconds']) if previous else '-':>10}{change:>9}{results[name].get('peak_kib', '-'):>11}"
+              f"{results[name].get('pil_images', '-'):>12}")
+
+    if args.update_baseline:
+        stored = baseline.get('benchmarks', {}) if args.filter else {}
+        stored.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine_info(), 'benchmarks': stored}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.threshold, args.memory_threshold)
+    for name, metric, before, after in regressions:
+        print(f"REGRESSION {name} {metric}: {before} -> {after}")
+    if not baseline:
+        print("No baseline yet; run with --update-baseline to record one.")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,396 @@
+# --- Local Stand-in Services ---
+# Fakes for everything main.py talks to, so the whole pipeline can run on one machine:
+#   - a Graph API server that plays graph.instagram.com and graph.threads.net (container create,
+#     status, multi-ID status, publish) and serves generated images for the fake DALL-E URLs
+#   - an in-memory Google Cloud Storage client
+#   - Stability AI, OpenAI and Gemini clients that return generated images and captions, with
+#     async variants (AsyncOpenAI, genai's client.aio) for asgi.py
+# Each one sleeps for a configurable latency and fails at a configurable rate (see FAULT_PROFILES).
+#
+# Run the Graph API server on its own with: python -m loadtest.fakes --port 8081
+
+import argparse
+import asyncio
+import itertools
+import random
+import threading
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+from flask import Flask, request  # type: ignore
+from werkzeug.serving import make_server  # type: ignore
+
+# Latency (seconds, mean and +/- uniform jitter) and error rate of each fake.
+# 'graph' applies to every Graph API request; container_ready is the time a container
+# spends IN_PROGRESS before it reports FINISHED. 'nsfw_rate' only applies to Stability.
+FAULT_PROFILES = {
+    'graph': {'latency': 0.05, 'jitter': 0.02, 'error_rate': 0.0, 'container_ready': 2.0},
+    'gcs': {'latency': 0.1, 'jitter': 0.05, 'error_rate': 0.0},
+    'stability': {'latency': 3.0, 'jitter': 1.0, 'error_rate': 0.0, 'nsfw_rate': 0.0},
+    'dalle': {'latency': 6.0, 'jitter': 2.0, 'error_rate': 0.0},
+    'openai_chat': {'latency': 0.8, 'jitter': 0.3, 'error_rate': 0.0},
+    'imagen': {'latency': 4.0, 'jitter': 1.5, 'error_rate': 0.0},
+    'caption': {'latency': 1.5, 'jitter': 0.5, 'error_rate': 0.0},
+    'vision': {'latency': 2.0, 'jitter': 0.7, 'error_rate': 0.0},
+}
+
+IMAGE_SIZE = (1024, 1024)
+
+class InjectedFault(Exception):
+    """
+    An error raised on purpose by a fake, according to its error_rate.
+    """
+
+def simulate(profile_name):
+    """
+    Sleep for the profile's latency, then raise InjectedFault at its error rate.
+    """
+    time.sleep(fault_latency(profile_name))
+    inject_fault(profile_name)
+
+async def simulate_async(profile_name):
+    """
+    simulate() for the async fakes: waits without blocking the event loop.
+    """
+    await asyncio.sleep(fault_latency(profile_name))
+    inject_fault(profile_name)
+
+def fault_latency(profile_name):
+    profile = FAULT_PROFILES[profile_name]
+    return max(0.0, profile['latency'] + random.uniform(-profile['jitter'], profile['jitter']))
+
+def inject_fault(profile_name):
+    if random.random() < FAULT_PROFILES[profile_name]['error_rate']:
+        raise InjectedFault(f"Injected {profile_name} failure")
+
+def parse_fault_overrides(items):
+    """
+    Apply "profile.key=value" overrides, e.g. "stability.latency=1.5", to FAULT_PROFILES.
+    """
+    for item in items:
+        key, _, value = item.partition('=')
+        profile_name, _, field = key.partition('.')
+        if profile_name not in FAULT_PROFILES or field not in FAULT_PROFILES[profile_name]:
+            raise ValueError(f"Unknown fault setting: {key}")
+        FAULT_PROFILES[profile_name][field] = float(value)
+
+# --- Fake Images ---
+# Every fake image is a different mosaic of random blocks, so near-duplicate detection
+# sees unrelated images, while the flat blocks keep PNG encoding cheap.
+
+image_counter = itertools.count()
+
+def fake_png(size=IMAGE_SIZE, blocks=8):
+    """
+    Encode a PNG mosaic of blocks x blocks random colours, seeded by a running counter.
+    """
+    from PIL import Image  # type: ignore
+    rng = random.Random(next(image_counter))
+    tile = Image.frombytes('RGB', (blocks, blocks), bytes(rng.randrange(256) for _ in range(blocks * blocks * 3)))
+    img = tile.resize(size, Image.NEAREST)
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+# --- Fake Graph API Server ---
+# Instagram is served under /instagram and Threads under /threads, so main.py is pointed at it with
+# INSTAGRAM_GRAPH_URL=http://host:port/instagram and THREADS_GRAPH_URL=http://host:port/threads.
+
+graph_app = Flask('fake_graph')
+containers = {}  # container id -> {'service', 'ready_at', 'published'}
+containers_lock = threading.Lock()
+container_ids = itertools.count(17841400000000000)
+graph_stats = {'requests': 0, 'containers': 0, 'published': 0, 'errors': 0}
+graph_stats_lock = threading.Lock()
+STATUS_FIELDS = {'instagram': 'status_code', 'threads': 'status'}
+
+def count(stat):
+    with graph_stats_lock:
+        graph_stats[stat] += 1
+
+def graph_call(handler):
+    """
+    Wrap a Graph API handler with the 'graph' latency and error injection.
+    """
+    def wrapper(service, *args, **kwargs):
+        count('requests')
+        try:
+            simulate('graph')
+        except InjectedFault as e:
+            count('errors')
+            return {"error": {"message": str(e), "type": "OAuthException", "code": 2}}, 500
+        return handler(service, *args, **kwargs)
+    wrapper.__name__ = handler.__name__
+    return wrapper
+
+def container_status(container_id):
+    container = containers.get(container_id)
+    if container is None:
+        return None
+    if container['published']:
+        return 'PUBLISHED'
+    return 'FINISHED' if time.time() >= container['ready_at'] else 'IN_PROGRESS'
+
+@graph_app.route('/<service>/<account_id>/media', methods=['POST'])
+@graph_app.route('/<service>/<account_id>/threads', methods=['POST'])
+@graph_call
+def create_container(service, account_id):
+    if 'image_url' not in request.args:
+        return {"error": {"message": "image_url is required", "code": 100}}, 400
+    container_id = str(next(container_ids))
+    ready = FAULT_PROFILES['graph']['container_ready']
+    with containers_lock:
+        containers[container_id] = {'service': service, 'ready_at': time.time() + random.uniform(0.5 * ready, 1.5 * ready), 'published': False}
+    count('containers')
+    return {"id": container_id}, 200
+
+@graph_app.route('/<service>/<account_id>/media_publish', methods=['POST'])
+@graph_app.route('/<service>/<account_id>/threads_publish', methods=['POST'])
+@graph_call
+def publish_container(service, account_id):
+    container_id = request.args.get('creation_id')
+    with containers_lock:
+        status = container_status(container_id)
+        if status != 'FINISHED':
+            return {"error": {"message": f"Container {container_id} is {status}", "code": 9007}}, 400
+        containers[container_id]['published'] = True
+    count('published')
+    return {"id": str(next(container_ids))}, 200
+
+@graph_app.route('/<service>/me', methods=['GET'])
+@graph_call
+def get_me(service):
+    return {"id": "1"}, 200
+
+@graph_app.route('/<service>/', methods=['GET'])
+@graph_call
+def get_container_statuses(service):
+    field = STATUS_FIELDS.get(service, 'status_code')
+    with containers_lock:
+        return {
+            container_id: {field: container_status(container_id), "id": container_id}
+            for container_id in request.args.get('ids', '').split(',') if container_id in containers
+        }, 200
+
+@graph_app.route('/<service>/<container_id>', methods=['GET'])
+@graph_call
+def get_container(service, container_id):
+    with containers_lock:
+        status = container_status(container_id)
+    if status is None:
+        return {"error": {"message": f"Unknown object {container_id}", "code": 100}}, 400
+    return {STATUS_FIELDS.get(service, 'status_code'): status, "id": container_id}, 200
+
+@graph_app.route('/images/<name>', methods=['GET'])
+def get_image(name):
+    # Stands in for the CDN that serves DALL-E results
+    return fake_png(), 200, {'Content-Type': 'image/png'}
+
+@graph_app.route('/storage/<bucket_name>/<path:name>', methods=['GET'])
+def get_blob(bucket_name, name):
+    # Stands in for public GCS URLs, e.g. for Gemini captions of streamed uploads
+    bucket = fake_buckets.get(bucket_name)
+    if bucket is None or name not in bucket.objects:
+        return {"error": "Not found"}, 404
+    data, content_type = bucket.objects[name]
+    return data, 200, {'Content-Type': content_type or 'application/octet-stream'}
+
+def start_graph_server(host='127.0.0.1', port=0):
+    """
+    Serve the fake Graph API on a background thread. Returns its base URL, e.g. http://127.0.0.1:54321.
+    """
+    server = make_server(host, port, graph_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='fake-graph', daemon=True).start()
+    return f"http://{host}:{server.server_port}"
+
+# --- Fake Google Cloud Storage ---
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.public_url = f"{bucket.public_base_url}/{bucket.name}/{name}"
+
+    def upload_from_string(self, data, content_type=None, timeout=None):
+        simulate('gcs')
+        self.bucket.objects[self.name] = (bytes(data), content_type)
+
+    def open(self, mode, chunk_size=None, content_type=None, timeout=None):
+        return FakeBlobWriter(self, content_type)
+
+    def make_public(self, timeout=None):
+        pass
+
+    def delete(self):
+        simulate('gcs')
+        del self.bucket.objects[self.name]
+
+class FakeBlobWriter:
+    """
+    Resumable upload writer: collects chunks and stores them on close.
+    """
+    def __init__(self, blob, content_type):
+        self.blob = blob
+        self.content_type = content_type
+        self.chunks = []
+
+    def __enter__(self):
+        return self
+
+    def write(self, chunk):
+        self.chunks.append(bytes(chunk))
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            simulate('gcs')
+            self.blob.bucket.objects[self.blob.name] = (b''.join(self.chunks), self.content_type)
+
+class FakeBucket:
+    def __init__(self, name, public_base_url):
+        self.name = name
+        self.public_base_url = public_base_url
+        self.objects = {}  # blob name -> (bytes, content type)
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def exists(self):
+        return True
+
+fake_buckets = {}  # bucket name -> FakeBucket, shared with the fake server's /storage route
+
+class FakeStorageClient:
+    def __init__(self, public_base_url="https://storage.googleapis.com"):
+        self.public_base_url = public_base_url
+
+    def bucket(self, name):
+        bucket = fake_buckets.get(name)
+        if bucket is None:
+            bucket = fake_buckets.setdefault(name, FakeBucket(name, self.public_base_url))
+        return bucket
+
+# --- Fake Providers ---
+
+class FakeStabilityClient:
+    """
+    Stands in for stability_sdk's StabilityInference: generate() yields one answer with one artifact.
+    """
+    def __init__(self, generation):
+        self.generation = generation  # the stability_sdk generation_pb2 module, for its enum values
+
+    def generate(self, prompt=None, **kwargs):
+        simulate('stability')
+        nsfw = random.random() < FAULT_PROFILES['stability']['nsfw_rate']
+        finish_reason = self.generation.FILTER if nsfw else self.generation.NULL
+        yield SimpleNamespace(artifacts=[SimpleNamespace(finish_reason=finish_reason, type=self.generation.ARTIFACT_IMAGE, binary=fake_png())])
+
+class FakeOpenAIClient:
+    """
+    Stands in for openai.OpenAI: chat completions (vision requests use the 'vision' profile),
+    DALL-E image generation and model lookups.
+    Generated images are served by the fake Graph API server at image_base_url.
+    """
+    def __init__(self, image_base_url):
+        self.image_base_url = image_base_url
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat_completion))
+        self.images = SimpleNamespace(generate=self.generate_image)
+        self.models = SimpleNamespace(retrieve=lambda model: SimpleNamespace(id=model))
+
+    def create_chat_completion(self, model=None, messages=None, **kwargs):
+        profile = chat_profile(messages)
+        simulate(profile)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=CHAT_REPLIES[profile]))])
+
+    def generate_image(self, model=None, prompt=None, **kwargs):
+        simulate('dalle')
+        return self.image_result()
+
+    def image_result(self):
+        return SimpleNamespace(data=[SimpleNamespace(url=f"{self.image_base_url}/images/{next(image_counter)}.png")])
+
+class FakeAsyncOpenAIClient(FakeOpenAIClient):
+    """
+    Stands in for openai.AsyncOpenAI, with the same answers as FakeOpenAIClient.
+    """
+    async def create_chat_completion(self, model=None, messages=None, **kwargs):
+        profile = chat_profile(messages)
+        await simulate_async(profile)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=CHAT_REPLIES[profile]))])
+
+    async def generate_image(self, model=None, prompt=None, **kwargs):
+        await simulate_async('dalle')
+        return self.image_result()
+
+CHAT_REPLIES = {
+    'vision': "Bold shapes and bright colours fill the frame. What do you see first?",
+    'openai_chat': "The Golden Gate Bridge, a suspension bridge in San Francisco.",
+}
+CAPTION_CHUNKS = ("A bright, playful scene ", "full of colour and motion. ", "Which detail did you spot first?")
+
+def chat_profile(messages):
+    """
+    'vision' for chat requests that carry an image, 'openai_chat' otherwise.
+    """
+    content = messages[-1]['content'] if messages else ''
+    if isinstance(content, list) and any(part.get('type') == 'image_url' for part in content):
+        return 'vision'
+    return 'openai_chat'
+
+class FakeGenaiModels:
+    def generate_content(self, model=None, contents=None, config=None):
+        simulate('imagen')
+        return SimpleNamespace(parts=[SimpleNamespace(inline_data=SimpleNamespace(data=fake_png(), mime_type='image/png'))])
+
+    def generate_content_stream(self, model=None, contents=None, config=None):
+        simulate('caption')
+        for text in CAPTION_CHUNKS:
+            yield SimpleNamespace(text=text)
+
+    def get(self, model=None):
+        return SimpleNamespace(name=model)
+
+class FakeAsyncGenaiModels:
+    """
+    Stands in for client.aio.models.
+    """
+    async def generate_content(self, model=None, contents=None, config=None):
+        await simulate_async('imagen')
+        return SimpleNamespace(parts=[SimpleNamespace(inline_data=SimpleNamespace(data=fake_png(), mime_type='image/png'))])
+
+    async def generate_content_stream(self, model=None, contents=None, config=None):
+        await simulate_async('caption')
+
+        async def chunks():
+            for text in CAPTION_CHUNKS:
+                yield SimpleNamespace(text=text)
+        return chunks()
+
+class FakeGenaiClient:
+    """
+    Stands in for google.genai.Client: image generation (Imagen posts) and streamed captions.
+    """
+    def __init__(self):
+        self.models = FakeGenaiModels()
+        self.aio = SimpleNamespace(models=FakeAsyncGenaiModels())
+
+def install_fake_clients(main, graph_base_url):
+    """
+    Replace every provider and storage client in main's client registry with a fake.
+    """
+    main.set_client('storage', FakeStorageClient(f"{graph_base_url}/storage"))
+    main.set_client('stability', FakeStabilityClient(main.lazy_import(main.STABILITY_GENERATION_MODULE)))
+    main.set_client('openai', FakeOpenAIClient(graph_base_url))
+    main.set_client('openai_async', FakeAsyncOpenAIClient(graph_base_url))
+    main.set_client('genai', FakeGenaiClient())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the fake Instagram/Threads Graph API.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--fault', action='append', default=[], metavar='PROFILE.KEY=VALUE',
+                        help="Override a fault profile setting, e.g. graph.container_ready=5 (repeatable)")
+    args = parser.parse_args()
+    parse_fault_overrides(args.fault)
+    print(f"Fake Graph API on http://{args.host}:{args.port} (/instagram and /threads)")
+    make_server(args.host, args.port, graph_app, threaded=True).serve_forever()
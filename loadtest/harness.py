@@ -0,0 +1,235 @@
+# --- End-to-End Load Harness ---
+# Runs main.py in-process against the local stand-ins in loadtest/fakes.py, drives its post
+# endpoints at a fixed request rate (open loop: requests are sent on schedule whether or not
+# earlier jobs have finished), waits for the jobs and reports throughput, latency percentiles
+# and a per-stage breakdown from each job's spans.
+#
+#   python -m loadtest.harness --rate 0.5 --duration 60 --endpoint /auto_post
+#   python -m loadtest.harness --fault stability.error_rate=0.2 --env PROVIDER_RATE_PER_MINUTE=120 --json run.json
+#   python -m loadtest.harness --async --rate 5 --duration 60     # jobs on asgi.py's event loop
+#   python -m loadtest.harness --asgi --rate 5 --duration 60      # asgi:app served by uvicorn, as deployed
+
+import argparse
+import importlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests  # type: ignore
+from werkzeug.serving import make_server  # type: ignore
+
+from loadtest import fakes
+
+FINISHED_STATUSES = ('succeeded', 'partial', 'timed_out', 'failed')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Drive the post endpoints against local fakes and report latency.")
+    parser.add_argument('--endpoint', action='append', default=[],
+                        help="Endpoint to call, repeatable; requests rotate over them (default: /auto_post)")
+    parser.add_argument('--rate', type=float, default=0.5, help="Requests per second (default: 0.5)")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to keep sending requests (default: 30)")
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds to wait for outstanding jobs afterwards (default: 300)")
+    parser.add_argument('--fault', action='append', default=[], metavar='PROFILE.KEY=VALUE',
+                        help="Override a fake's latency or error rate, e.g. dalle.latency=10 (repeatable)")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="Environment variable for main.py, e.g. POST_WORKER_CONCURRENCY=4 (repeatable)")
+    parser.add_argument('--buffer', default='', help="Comma-separated providers to run the content buffer for")
+    parser.add_argument('--async', dest='async_mode', action='store_true', help="Run jobs on asgi.py's event loop instead of worker threads")
+    parser.add_argument('--asgi', action='store_true', help="Serve asgi:app with uvicorn instead of main.app with Werkzeug (implies --async)")
+    parser.add_argument('--json', dest='json_path', help="Also write the report as JSON to this path")
+    return parser.parse_args()
+
+def configure_environment(graph_url, overrides):
+    """
+    Point main.py at the fake Graph API and give every provider a placeholder key.
+    Must run before main is imported; --env overrides win.
+    """
+    defaults = {
+        'INSTAGRAM_GRAPH_URL': f"{graph_url}/instagram",
+        'THREADS_GRAPH_URL': f"{graph_url}/threads",
+        'INSTA_PAGE_ACCESS_TOKEN': 'fake-token',
+        'INSTA_BUSINESS_ACCOUNT_ID': '17841400000000001',
+        'THREADS_API_TOKEN': 'fake-token',
+        'THREADS_USER_ID': '1',
+        'STABILITY_KEY': 'fake-key',
+        'OPENAI_TOKEN': 'fake-key',
+        'GEMINI_API_KEY': 'fake-key',
+        'STATE_DB_PATH': os.path.join(tempfile.mkdtemp(prefix='loadtest-'), 'state.sqlite3'),
+        'POST_QUEUE_MAX': '1000',
+        'CONTENT_BUFFER_PROVIDERS': '',  # started after the fakes are installed, see run()
+    }
+    defaults.update(item.partition('=')[::2] for item in overrides)
+    os.environ.update(defaults)
+
+def start_app(main):
+    """
+    Serve main.app on a background thread and return its base URL.
+    """
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def start_asgi_app(asgi):
+    """
+    Serve asgi.app with uvicorn on a background thread and return its base URL once it has
+    started; its lifespan startup installs the async runtime on uvicorn's event loop.
+    """
+    import uvicorn  # type: ignore
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(asgi.app, log_level='warning', lifespan='on'))
+    threading.Thread(target=server.run, kwargs={'sockets': [sock]}, name='asgi-server', daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+def drive(base_url, endpoints, rate, duration):
+    """
+    Send int(rate * duration) requests on a fixed schedule, rotating over the endpoints.
+
+    Returns:
+        list: one submission per request with endpoint, sent_at, status_code and job_id
+    """
+    total = int(rate * duration)
+    session = requests.Session()
+
+    def send(index):
+        endpoint = endpoints[index % len(endpoints)]
+        submission = {'endpoint': endpoint, 'sent_at': time.time(), 'status_code': None, 'job_id': None}
+        try:
+            response = session.get(f"{base_url}{endpoint}", timeout=30)
+            submission['status_code'] = response.status_code
+            if response.status_code == 202:
+                submission['job_id'] = response.json()['job_id']
+        except requests.RequestException as e:
+            submission['error'] = str(e)
+        return submission
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=32, thread_name_prefix='load') as executor:
+        futures = []
+        for index in range(total):
+            delay = started + index / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(send, index))
+        return [future.result() for future in futures]
+
+def wait_for_jobs(base_url, submissions, timeout):
+    """
+    Poll /jobs/<id> until every accepted job has finished or the timeout passes.
+
+    Returns:
+        dict: job id -> last job record seen
+    """
+    session = requests.Session()
+    pending = {s['job_id'] for s in submissions if s['job_id']}
+    records = {}
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        for job_id in list(pending):
+            response = session.get(f"{base_url}/jobs/{job_id}", timeout=30)
+            if response.status_code != 200:
+                continue
+            records[job_id] = response.json()
+            if records[job_id]['status'] in FINISHED_STATUSES:
+                pending.discard(job_id)
+        if pending:
+            time.sleep(0.25)
+    return records
+
+def summarize(main, submissions, records, args):
+    """
+    Build the report: request outcomes, job statuses, throughput, latency percentiles and stages.
+    """
+    finished = [records[s['job_id']] for s in submissions if s['job_id'] in records and records[s['job_id']]['status'] in FINISHED_STATUSES]
+    sent_at = {s['job_id']: s['sent_at'] for s in submissions if s['job_id']}
+    latencies = [job['finished_at'] - sent_at[job['id']] for job in finished]
+    queue_waits = [job['started_at'] - job['created_at'] for job in finished if job['started_at']]
+    completed = [job for job in finished if job['status'] != 'failed']
+    window = (max(job['finished_at'] for job in finished) - min(s['sent_at'] for s in submissions)) if finished else 0
+
+    def quantiles(values):
+        return {f"p{pct}": round(main.percentile(values, pct), 3) if values else None for pct in (50, 95, 99)}
+
+    spans = {}
+    for job in finished:
+        for span in job.get('spans', []):
+            key = f"{span['stage']}[{span['target']}]" if span['target'] else span['stage']
+            spans.setdefault(key, []).append(span)
+    stages = {
+        key: {
+            'count': len(items),
+            'errors': sum(1 for span in items if span['outcome'] != 'ok'),
+            'mean': round(sum(span['seconds'] for span in items) / len(items), 3),
+            **quantiles([span['seconds'] for span in items]),
+        }
+        for key, items in spans.items()
+    }
+
+    return {
+        'config': {'endpoints': args.endpoint, 'async': args.async_mode, 'asgi': args.asgi, 'rate': args.rate, 'duration': args.duration, 'faults': fakes.FAULT_PROFILES, 'env': args.env},
+        'requests': {
+            'sent': len(submissions),
+            'accepted': sum(1 for s in submissions if s['status_code'] == 202),
+            'rejected': sum(1 for s in submissions if s['status_code'] not in (202, None)),
+            'errors': sum(1 for s in submissions if s['status_code'] is None),
+        },
+        'jobs': {status: sum(1 for job in records.values() if job['status'] == status) for status in ('queued', 'running') + FINISHED_STATUSES},
+        'failures': dict(Counter(job['error'] for job in finished if job['status'] in ('failed', 'timed_out'))),
+        'throughput_per_minute': round(len(completed) / window * 60, 2) if window else None,
+        'latency_seconds': quantiles(latencies),
+        'queue_wait_seconds': quantiles(queue_waits),
+        'stages': stages,
+        'graph_api': dict(fakes.graph_stats),
+    }
+
+def print_report(report):
+    requests_ = report['requests']
+    print("\n=== Load test report ===")
+    print(f"Requests: {requests_['sent']} sent, {requests_['accepted']} accepted, {requests_['rejected']} rejected, {requests_['errors']} errors")
+    print("Jobs:     " + ", ".join(f"{count} {status}" for status, count in report['jobs'].items() if count))
+    for error, count in report['failures'].items():
+        print(f"  {count} failed: {error}")
+    print(f"Throughput: {report['throughput_per_minute']} posts/minute")
+    for name in ('latency_seconds', 'queue_wait_seconds'):
+        q = report[name]
+        print(f"{name.replace('_', ' ').capitalize()}: p50={q['p50']} p95={q['p95']} p99={q['p99']}")
+    print(f"\n{'stage':<34}{'count':>7}{'errors':>8}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for key, stats in sorted(report['stages'].items(), key=lambda item: -item[1]['mean']):
+        print(f"{key:<34}{stats['count']:>7}{stats['errors']:>8}{stats['mean']:>9}{stats['p50']:>9}{stats['p95']:>9}{stats['p99']:>9}")
+    print(f"\nFake Graph API: {report['graph_api']}")
+
+def run():
+    args = parse_args()
+    args.endpoint = args.endpoint or ['/auto_post']
+    fakes.parse_fault_overrides(args.fault)
+
+    graph_url = fakes.start_graph_server()
+    configure_environment(graph_url, args.env)
+    main = importlib.import_module('main')
+    fakes.install_fake_clients(main, graph_url)
+    if args.async_mode and not args.asgi:
+        importlib.import_module('asgi').start_async_runtime()
+    if args.buffer:
+        main.CONTENT_BUFFER_PROVIDERS[:] = [p.strip() for p in args.buffer.split(',') if p.strip()]
+        main.start_content_buffer()
+    base_url = start_asgi_app(importlib.import_module('asgi')) if args.asgi else start_app(main)
+
+    print(f"Driving {args.endpoint} at {args.rate}/s for {args.duration}s (app {base_url}, fake Graph API {graph_url})")
+    submissions = drive(base_url, args.endpoint, args.rate, args.duration)
+    records = wait_for_jobs(base_url, submissions, args.timeout)
+    report = summarize(main, submissions, records, args)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json_path}")
+
+if __name__ == '__main__':
+    run()
@@ -1,27 +1,35 @@
 # --- Standard Library Imports ---
-import io
 import os  # For environment variables and file operations
 import random  # For random selection of topics, patterns, etc.
 import time  # For timestamping image files
-import base64  # For encoding images for API requests
+import threading  # For guarding shared state between gunicorn threads
+import traceback  # For logging failures of background jobs
+import uuid  # For job identifiers
+from collections import deque  # For content buffer queues
+from contextlib import contextmanager  # For timing spans
+import contextvars  # For carrying a job's trace id into worker threads
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError  # For the background post worker pool, hedged captions and deadlines
+from email.utils import parsedate_to_datetime  # For HTTP-date Retry-After headers
 from io import BytesIO  # For in-memory image operations
+import hashlib  # For hashing uploaded images
+import importlib  # For importing provider SDKs on first use
+import json  # For job checkpoints in the state store
+import sqlite3  # For the local state store
+import sys  # For the import-time report
+from urllib.parse import unquote, urlsplit  # For keying HTTP sessions by host and naming blobs from their URLs
+
+MODULE_LOAD_STARTED = time.perf_counter()  # Start of main.py import, for the startup report
 
 # --- Third-Party Imports ---
 import requests  # type: ignore # For HTTP requests to APIs
-from flask import Flask  # type: ignore # For web server and API endpoints
-from PIL import Image  # type: ignore # For image processing
-
-# Stability AI SDK (for image generation)
-import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation  # type: ignore # For artifact types
-from stability_sdk import client  # type: ignore # For Stability API client
+from requests.adapters import HTTPAdapter  # type: ignore # For per-host connection pools
+from flask import Flask, request  # type: ignore # For web server and API endpoints
 
-# OpenAI (for text and image generation)
-from openai import OpenAI  # type: ignore # For OpenAI API client
-
-# Google Cloud & Gemini (for storage and vision models)
-from google.cloud import storage  # For Google Cloud Storage
-from google import genai  # For Gemini API
-from google.genai import types  # type: ignore # For Gemini API types
+# Provider SDKs and PIL are imported on first use through lazy_import(), so a cold start
+# only pays for the providers a request actually needs:
+#   stability_sdk (Stability AI image generation, gRPC), openai (OpenAI text and image generation),
+#   google.cloud.storage (Google Cloud Storage), google.genai (Gemini), PIL (image processing)
+STABILITY_GENERATION_MODULE = 'stability_sdk.interfaces.gooseai.generation.generation_pb2'
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
@@ -32,10 +40,128 @@ PAGE_ACCESS_TOKEN = os.environ.get('INSTA_PAGE_ACCESS_TOKEN', '')  # Instagram p
 VERIFY_TOKEN = os.environ.get('INSTA_PAGE_VERIFY_TOKEN', '')      # Webhook verification token
 BUSINESS_ACCOUNT_ID = os.environ.get('INSTA_BUSINESS_ACCOUNT_ID', '')  # Instagram business account ID
 STABILITY_KEY = os.environ.get('STABILITY_KEY', '')              # Stability AI API key
-openai = OpenAI(api_key=os.environ.get('OPENAI_TOKEN', ''))       # OpenAI API client
+OPENAI_TOKEN = os.environ.get('OPENAI_TOKEN', '')                # OpenAI API key
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')                # Google Gemini API key
+STABILITY_ENGINE = "stable-diffusion-xl-1024-v1-0"               # Stability AI engine to use
+GEMINI_CAPTION_MODEL = "gemini-2.5-flash"                        # Gemini model used for captions
+GCS_BUCKET_NAME = "ai-bot-app-insta"                             # Bucket that serves generated images
 OPENAI_MODEL = 'gpt-4o-mini'                                     # OpenAI model to use
 THREADS_API_TOKEN = os.environ.get('THREADS_API_TOKEN', '')      # Threads API token
 THREADS_USER_ID = os.environ.get('THREADS_USER_ID', '')          # Threads user ID
+INSTAGRAM_GRAPH_URL = os.environ.get('INSTAGRAM_GRAPH_URL', 'https://graph.instagram.com/v22.0')  # Instagram Graph API base URL
+THREADS_GRAPH_URL = os.environ.get('THREADS_GRAPH_URL', 'https://graph.threads.net/v1.0')          # Threads API base URL
+
+# --- State Store Configuration ---
+# Local SQLite file for state that should survive restarts of this instance.
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', '/tmp/ai_bot_state.sqlite3')
+
+# --- Encoding Configuration ---
+# Every in-memory image is re-encoded once to a JPEG within Instagram's limits before upload.
+ENCODE_ENABLED = os.environ.get('ENCODE_ENABLED', 'true').lower() == 'true'
+ENCODE_MAX_DIMENSION = int(os.environ.get('ENCODE_MAX_DIMENSION', '1080'))    # Longest side in pixels (Instagram displays 1080)
+ENCODE_MIN_DIMENSION = 320                                                    # Instagram's minimum width
+ENCODE_JPEG_QUALITY = int(os.environ.get('ENCODE_JPEG_QUALITY', '90'))        # First quality tried
+ENCODE_MIN_JPEG_QUALITY = int(os.environ.get('ENCODE_MIN_JPEG_QUALITY', '60'))  # Lowest quality before giving up on ENCODE_MAX_BYTES
+ENCODE_MAX_BYTES = int(os.environ.get('ENCODE_MAX_BYTES', str(8 * 1024 * 1024)))  # Instagram's 8 MB limit
+ENCODE_MIN_ASPECT, ENCODE_MAX_ASPECT = 4 / 5, 1.91                            # Instagram's feed aspect ratio range
+
+# --- Dedup Configuration ---
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'true').lower() == 'true'
+DEDUP_HAMMING_THRESHOLD = int(os.environ.get('DEDUP_HAMMING_THRESHOLD', '6'))  # Max differing pHash bits for a near-duplicate
+DEDUP_PICK_ATTEMPTS = int(os.environ.get('DEDUP_PICK_ATTEMPTS', '20'))         # Random draws before accepting a used combination
+
+# --- Provider Concurrency Configuration ---
+# Max prepare steps (generate, upload, caption) running at once per provider, across single posts,
+# batches and the content buffer. Format: "stability=2,dalle=1,imagen=2"; unlisted providers get the default.
+PROVIDER_CONCURRENCY_DEFAULT = int(os.environ.get('PROVIDER_CONCURRENCY_DEFAULT', '2'))
+PROVIDER_CONCURRENCY = {
+    name.strip(): int(limit)
+    for name, _, limit in (item.partition('=') for item in os.environ.get('PROVIDER_CONCURRENCY', '').split(',') if '=' in item)
+}
+BATCH_POST_MAX_ITEMS = int(os.environ.get('BATCH_POST_MAX_ITEMS', '20'))  # Max posts one /batch_post may request
+PROMPT_TEST_CONCURRENCY = int(os.environ.get('PROMPT_TEST_CONCURRENCY', '4'))  # Stability calls at once in /test_prompt_strategies
+PROMPT_TEST_MAX_SAMPLES = int(os.environ.get('PROMPT_TEST_MAX_SAMPLES', '10'))  # Max ?samples= per strategy
+PROMPT_SAMPLE_MAX = int(os.environ.get('PROMPT_SAMPLE_MAX', '10000'))  # Max ?count= for /sample_prompts
+
+# --- Provider Health Configuration ---
+# Every generation call takes a token from its provider's bucket and goes through its circuit breaker.
+# A DALL-E post's prompt chat call goes through the dalle breaker without a token, so limits count posts.
+# Format for PROVIDER_RATE_LIMITS: "stability=10,dalle=5,imagen=10" (posts per minute); unlisted providers get the default.
+PROVIDER_RATE_PER_MINUTE = float(os.environ.get('PROVIDER_RATE_PER_MINUTE', '30'))
+PROVIDER_RATE_LIMITS = {
+    name.strip(): float(limit)
+    for name, _, limit in (item.partition('=') for item in os.environ.get('PROVIDER_RATE_LIMITS', '').split(',') if '=' in item)
+}
+PROVIDER_RATE_BURST = int(os.environ.get('PROVIDER_RATE_BURST', '5'))                      # Calls allowed back to back after idling
+PROVIDER_RATE_MAX_WAIT_SECONDS = float(os.environ.get('PROVIDER_RATE_MAX_WAIT_SECONDS', '10'))  # Longer waits count as saturated
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '3'))          # Consecutive failures that open a breaker
+BREAKER_COOLDOWN_SECONDS = float(os.environ.get('BREAKER_COOLDOWN_SECONDS', '300'))        # Open time before one trial call is let through
+PROVIDER_CALL_TIMEOUT_SECONDS = float(os.environ.get('PROVIDER_CALL_TIMEOUT_SECONDS', '120'))  # Slower calls count as breaker failures (0 = no limit)
+PROVIDER_ABANDONED_CALLS_MAX = int(os.environ.get('PROVIDER_ABANDONED_CALLS_MAX', '2'))     # Timed-out calls still running before new calls are rejected
+# Providers a post falls back to, in order, when its own provider is open, saturated or failing. Empty disables fallback.
+PROVIDER_FALLBACK_ORDER = [p.strip() for p in os.environ.get('PROVIDER_FALLBACK_ORDER', 'stability,imagen,dalle').split(',') if p.strip()]
+
+# --- Metrics Configuration ---
+# Upper bounds, in seconds, of the /metrics latency histogram buckets.
+METRICS_BUCKETS = sorted(float(b) for b in os.environ.get('METRICS_BUCKETS', '0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120').split(','))
+
+# --- Auto Post Configuration ---
+# /auto_post routes each post to the provider with the best expected prepare time.
+AUTO_POST_PROVIDERS = [p.strip() for p in os.environ.get('AUTO_POST_PROVIDERS', '').split(',') if p.strip()] or [
+    provider for provider, key in (('stability', STABILITY_KEY), ('dalle', OPENAI_TOKEN), ('imagen', GEMINI_API_KEY)) if key
+]
+AUTO_POST_EXPLORATION = float(os.environ.get('AUTO_POST_EXPLORATION', '0.1'))    # Fraction of posts sent to a random healthy provider
+AUTO_POST_WINDOW = int(os.environ.get('AUTO_POST_WINDOW', '50'))                  # Recent prepares kept per provider for p50/p95
+AUTO_POST_MIN_SAMPLES = int(os.environ.get('AUTO_POST_MIN_SAMPLES', '3'))         # Below this, a provider is tried before others
+AUTO_POST_TAIL_WEIGHT = float(os.environ.get('AUTO_POST_TAIL_WEIGHT', '0.25'))     # Share of p95 (vs p50) in the expected prepare time
+
+# --- Caption Configuration ---
+# Captions come from the first provider in CAPTION_PROVIDERS ("gemini", "openai"); a slow answer
+# is hedged with a request to the next one. Defaults to the providers with an API key.
+CAPTION_PROVIDERS = [p.strip() for p in os.environ.get('CAPTION_PROVIDERS', '').split(',') if p.strip()] or [
+    provider for provider, key in (('gemini', GEMINI_API_KEY), ('openai', OPENAI_TOKEN)) if key
+]
+CAPTION_HEDGE_QUANTILE = float(os.environ.get('CAPTION_HEDGE_QUANTILE', '95'))                 # Hedge after this percentile of recent caption times
+CAPTION_HEDGE_DELAY_SECONDS = float(os.environ.get('CAPTION_HEDGE_DELAY_SECONDS', '8'))        # Hedge delay until a provider has enough samples
+CAPTION_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('CAPTION_HEDGE_MIN_DELAY_SECONDS', '1'))
+CAPTION_TIMEOUT_SECONDS = float(os.environ.get('CAPTION_TIMEOUT_SECONDS', '90'))               # Give up when no provider answered by then
+CAPTION_WINDOW = int(os.environ.get('CAPTION_WINDOW', '100'))                                  # Recent caption times kept per provider
+CAPTION_MIN_SAMPLES = int(os.environ.get('CAPTION_MIN_SAMPLES', '5'))
+CAPTION_MAX_LENGTH = int(os.environ.get('CAPTION_MAX_LENGTH', '2000'))                         # Instagram allows 2200 characters, hashtags included
+
+# --- Content Buffer Configuration ---
+# Providers that keep fully prepared posts (image in GCS, caption done) ready to publish.
+# Comma-separated "stability", "dalle", "imagen"; empty disables the buffer.
+CONTENT_BUFFER_PROVIDERS = [p.strip() for p in os.environ.get('CONTENT_BUFFER_PROVIDERS', '').split(',') if p.strip()]
+CONTENT_BUFFER_TARGET = int(os.environ.get('CONTENT_BUFFER_TARGET', '3'))                 # High watermark: stop refilling here
+CONTENT_BUFFER_LOW_WATERMARK = int(os.environ.get('CONTENT_BUFFER_LOW_WATERMARK', '1'))   # Start refilling at or below this depth
+CONTENT_BUFFER_TTL_SECONDS = int(os.environ.get('CONTENT_BUFFER_TTL_SECONDS', '21600'))   # Prepared posts older than this are dropped
+CONTENT_BUFFER_RETRY_SECONDS = int(os.environ.get('CONTENT_BUFFER_RETRY_SECONDS', '60'))  # Pause after a failed prepare
+CONTENT_BUFFER_CONCURRENCY = int(os.environ.get('CONTENT_BUFFER_CONCURRENCY', '2'))       # Prepares running at once across all buffers
+
+# --- Streaming Upload Configuration ---
+# When enabled, images that providers return as a URL (DALL-E) are piped from the download
+# into a GCS resumable upload chunk by chunk instead of being held in memory first.
+STREAM_URL_UPLOADS = os.environ.get('STREAM_URL_UPLOADS', 'false').lower() == 'true'
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', str(256 * 1024)))  # Must be a multiple of 256 KiB
+if STREAM_CHUNK_SIZE <= 0 or STREAM_CHUNK_SIZE % (256 * 1024):
+    # GCS rejects resumable upload chunks of any other size, which would only surface on the first streamed post
+    raise ValueError(f"STREAM_CHUNK_SIZE must be a positive multiple of 262144 (256 KiB), got {STREAM_CHUNK_SIZE}")
+
+# --- Container Status Polling Configuration ---
+STATUS_POLL_MIN_INTERVAL = float(os.environ.get('STATUS_POLL_MIN_INTERVAL', '1'))        # Shortest gap between polls of a container
+STATUS_POLL_MAX_INTERVAL = float(os.environ.get('STATUS_POLL_MAX_INTERVAL', '15'))       # Longest gap once a container is overdue
+STATUS_POLL_INITIAL_ESTIMATE = float(os.environ.get('STATUS_POLL_INITIAL_ESTIMATE', '3'))  # Seconds to FINISHED before any are observed
+STATUS_POLL_EWMA_WEIGHT = float(os.environ.get('STATUS_POLL_EWMA_WEIGHT', '0.3'))       # Weight of each new time-to-FINISHED sample
+STATUS_POLL_BATCH_SIZE = int(os.environ.get('STATUS_POLL_BATCH_SIZE', '50'))            # Max container ids per multi-ID lookup
+STATUS_POLL_BATCH_RETRY_SECONDS = float(os.environ.get('STATUS_POLL_BATCH_RETRY_SECONDS', '600'))  # Pause after a rejected multi-ID lookup
+
+# --- Warmup Configuration ---
+# Providers /warmup pre-initializes: comma-separated "stability", "dalle", "imagen".
+# Defaults to every provider whose API key is set.
+WARMUP_PROVIDERS = [p.strip() for p in os.environ.get('WARMUP_PROVIDERS', '').split(',') if p.strip()] or [
+    provider for provider, key in (('stability', STABILITY_KEY), ('dalle', OPENAI_TOKEN), ('imagen', GEMINI_API_KEY)) if key
+]
 
 # --- Prompt Tuning Configuration ---
 # Environment variables for fine-tuning prompt generation
@@ -43,13 +169,42 @@ ENABLE_ENHANCED_PROMPTS = os.environ.get('ENABLE_ENHANCED_PROMPTS', 'true').lowe
 ENABLE_NEGATIVE_PROMPTS = os.environ.get('ENABLE_NEGATIVE_PROMPTS', 'true').lower() == 'true'
 ENABLE_AB_TESTING = os.environ.get('ENABLE_AB_TESTING', 'false').lower() == 'true'
 PROMPT_COMPLEXITY_LEVEL = int(os.environ.get('PROMPT_COMPLEXITY_LEVEL', '2'))  # 1=simple, 2=enhanced, 3=complex
-
-# Prompt performance tracking
-prompt_performance = {
-    'stability': {'enhanced': 0, 'simple': 0},
-    'dalle': {'enhanced': 0, 'simple': 0},
-    'imagen': {'enhanced': 0, 'simple': 0}
-}
+PROMPT_PERFORMANCE_WINDOW = int(os.environ.get('PROMPT_PERFORMANCE_WINDOW', '500'))  # Recent attempts per provider/strategy for latency quantiles
+
+# --- Checkpoint Configuration ---
+# Post jobs checkpoint their progress in the state store so a failed publish can be resumed
+# without generating and captioning again.
+CHECKPOINTS_ENABLED = os.environ.get('CHECKPOINTS_ENABLED', 'true').lower() == 'true'
+CHECKPOINT_SWEEP_SECONDS = int(os.environ.get('CHECKPOINT_SWEEP_SECONDS', '300'))            # Gap between automatic resume sweeps; 0 disables
+CHECKPOINT_RETRY_AFTER_SECONDS = int(os.environ.get('CHECKPOINT_RETRY_AFTER_SECONDS', '120'))  # Idle time before the sweep resumes a job
+CHECKPOINT_MAX_ATTEMPTS = int(os.environ.get('CHECKPOINT_MAX_ATTEMPTS', '3'))                # Attempts per job, the first run included
+CHECKPOINT_RETENTION_SECONDS = int(os.environ.get('CHECKPOINT_RETENTION_SECONDS', str(7 * 86400)))  # Drop checkpoints untouched this long
+
+# --- Idempotency Configuration ---
+IDEMPOTENCY_ENABLED = os.environ.get('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))  # How long a key returns its job
+IDEMPOTENCY_SLOT_SECONDS = int(os.environ.get('IDEMPOTENCY_SLOT_SECONDS', '300'))  # Time slot for scheduler keys without a schedule time
+
+# --- Deadline Configuration ---
+# Time budget per job, counted from when it is queued; every stage's timeouts come out of it.
+JOB_DEADLINE_SECONDS = int(os.environ.get('JOB_DEADLINE_SECONDS', '600'))               # Post jobs; 0 = no deadline
+BATCH_JOB_DEADLINE_SECONDS = int(os.environ.get('BATCH_JOB_DEADLINE_SECONDS', '1800'))  # /batch_post jobs; 0 = no deadline
+GCS_TIMEOUT_SECONDS = float(os.environ.get('GCS_TIMEOUT_SECONDS', '60'))                # Per Cloud Storage request, capped by the budget
+
+# --- Job Queue Configuration ---
+# Post endpoints enqueue a job and return immediately; a bounded worker pool runs the pipeline.
+POST_WORKER_CONCURRENCY = int(os.environ.get('POST_WORKER_CONCURRENCY', '2'))  # Pipelines running at once
+POST_QUEUE_MAX = int(os.environ.get('POST_QUEUE_MAX', '20'))                    # Max queued + running jobs
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', '86400'))   # Keep finished jobs for /jobs
+
+# --- HTTP Client Configuration ---
+# Shared by every Graph API and Threads call (see http_request).
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))    # Seconds to establish a connection
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))         # Seconds to wait for a response
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '3'))              # Retries on 429/5xx and connection errors
+HTTP_BACKOFF_SECONDS = float(os.environ.get('HTTP_BACKOFF_SECONDS', '1'))    # First retry delay, doubled each attempt
+HTTP_MAX_BACKOFF_SECONDS = float(os.environ.get('HTTP_MAX_BACKOFF_SECONDS', '30'))  # Upper bound on any retry delay
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '16'))                 # Keep-alive connections kept per host
 
 # --- Content Categories ---
 # These lists are used to randomly select topics, places, and art styles for content generation.
@@ -185,8 +340,73 @@ cartoons = [
 ]
 
 # --- Enhanced Prompt Generation Functions ---
+# Vocabularies are deduplicated once at load (negative_prompts repeats many terms, which skewed
+# sampling and produced repeated negatives), and the per-provider templates are bound str.format
+# methods, so building many prompts is a handful of C-level choices() and map() calls.
+
+def dedupe(values):
+    """
+    Return the distinct values of a list as a tuple, keeping first-seen order.
+    """
+    return tuple(dict.fromkeys(values))
+
+PROMPT_VOCABULARIES = {
+    'topic': dedupe(topic),
+    'place': dedupe(place),
+    'pattern': dedupe(pattern),
+    'lighting': dedupe(lighting_styles),
+    'composition': dedupe(composition_styles),
+    'mood': dedupe(mood_atmospheres),
+    'quality': dedupe(quality_enhancers),
+    'negative': dedupe(negative_prompts),
+    'cartoon': dedupe(cartoons),
+}
+
+# Positional fields: 0=subject, 1=art style, 2=lighting, 3=composition, 4=mood, 5=quality
+ENHANCED_PROMPT_TEMPLATES = {
+    # Stability AI works well with detailed, structured prompts
+    'stability': "{0}, {1}, {2}, {3}, {4}, {5}".format,
+    # DALL-E 3 prefers more natural language
+    'dalle': "A {4} {1} of {0} with {2} and {3}, {5}".format,
+    # Imagen works well with clear, descriptive prompts
+    'imagen': "{0} in {1} style, featuring {2} and {3}, {4} atmosphere, {5}".format,
+}
+SIMPLE_PROMPT_TEMPLATE = "{0}, {1}".format
+NEGATIVE_PROMPT_TERMS = 10  # Distinct negative terms per prompt
 
-def generate_enhanced_prompt(base_subject, art_style, prompt_type="stability"):
+def build_enhanced_prompts(subjects, art_styles, prompt_type="stability", rng=random):
+    """
+    Build an enhanced prompt and a negative prompt for each (subject, art style) pair.
+
+    Returns:
+        list: (enhanced_prompt, negative_prompt) tuples, one per subject
+    """
+    n = len(subjects)
+    vocab = PROMPT_VOCABULARIES
+    template = ENHANCED_PROMPT_TEMPLATES.get(prompt_type, SIMPLE_PROMPT_TEMPLATE)
+    prompts = map(
+        template, subjects, art_styles,
+        rng.choices(vocab['lighting'], k=n),
+        rng.choices(vocab['composition'], k=n),
+        rng.choices(vocab['mood'], k=n),
+        rng.choices(vocab['quality'], k=n),
+    )
+    terms = min(NEGATIVE_PROMPT_TERMS, len(vocab['negative']))
+    negatives = [", ".join(rng.sample(vocab['negative'], terms)) for _ in range(n)]
+    return list(zip(prompts, negatives))
+
+def sample_enhanced_prompts(count, prompt_type="stability", seed=None, subjects=None):
+    """
+    Draw count seeded (prompt, negative) pairs in one call, for batch generation and A/B runs.
+    Subjects are drawn from the cartoons unless given; art styles from the patterns.
+    The same seed always returns the same pairs.
+    """
+    rng = random.Random(seed)
+    subjects = subjects or rng.choices(PROMPT_VOCABULARIES['cartoon'], k=count)
+    art_styles = rng.choices(PROMPT_VOCABULARIES['pattern'], k=len(subjects))
+    return build_enhanced_prompts(subjects, art_styles, prompt_type, rng)
+
+def generate_enhanced_prompt(base_subject, art_style, prompt_type="stability", rng=random):
     """
     Generate enhanced prompts with better structure and components.
     
@@ -194,35 +414,14 @@ def generate_enhanced_prompt(base_subject, art_style, prompt_type="stability"):
         base_subject: The main subject (cartoon, topic, etc.)
         art_style: The art style/pattern
         prompt_type: "stability", "dalle", or "imagen"
+        rng: Random source, e.g. a seeded random.Random for reproducible prompts
     
     Returns:
         tuple: (enhanced_prompt, negative_prompt)
     """
-    # Core components
-    lighting = random.choice(lighting_styles)
-    composition = random.choice(composition_styles)
-    mood = random.choice(mood_atmospheres)
-    quality = random.choice(quality_enhancers)
-    
-    # Build the enhanced prompt based on type
-    if prompt_type == "stability":
-        # Stability AI works well with detailed, structured prompts
-        enhanced_prompt = f"{base_subject}, {art_style}, {lighting}, {composition}, {mood}, {quality}"
-    elif prompt_type == "dalle":
-        # DALL-E 3 prefers more natural language
-        enhanced_prompt = f"A {mood} {art_style} of {base_subject} with {lighting} and {composition}, {quality}"
-    elif prompt_type == "imagen":
-        # Imagen works well with clear, descriptive prompts
-        enhanced_prompt = f"{base_subject} in {art_style} style, featuring {lighting} and {composition}, {mood} atmosphere, {quality}"
-    else:
-        enhanced_prompt = f"{base_subject}, {art_style}"
-    
-    # Generate negative prompt
-    negative_prompt = ", ".join(random.sample(negative_prompts, min(10, len(negative_prompts))))
-    
-    return enhanced_prompt, negative_prompt
+    return build_enhanced_prompts([base_subject], [art_style], prompt_type, rng)[0]
 
-def generate_contextual_prompt(topic, place, art_style):
+def generate_contextual_prompt(topic, place, art_style, rng=random):
     """
     Generate a contextual prompt based on topic and place.
     """
@@ -234,9 +433,9 @@ def generate_contextual_prompt(topic, place, art_style):
         f"{place}'s {topic} portrayed in {art_style}"
     ]
     
-    return random.choice(context_templates)
+    return rng.choice(context_templates)
 
-def generate_character_prompt(cartoon, art_style):
+def generate_character_prompt(cartoon, art_style, rng=random):
     """
     Generate character-focused prompts for anime/cartoon characters.
     """
@@ -250,8 +449,8 @@ def generate_character_prompt(cartoon, art_style):
         "friendly", "focused", "energetic", "calm", "excited"
     ]
     
-    pose = random.choice(character_poses)
-    expression = random.choice(character_expressions)
+    pose = rng.choice(character_poses)
+    expression = rng.choice(character_expressions)
     
     return f"{cartoon} character, {pose}, {expression}, {art_style} style"
 
@@ -260,562 +459,2966 @@ def generate_character_prompt(cartoon, art_style):
 @app.route('/stability_post_insta', methods=['GET'])
 def stability_post_insta():
     """
-    Generate an image using Stability AI based on a random cartoon and art pattern,
-    upload it to Google Cloud Storage, generate a caption using Gemini vision model,
-    and post to Instagram and Threads.
+    Enqueue a Stability AI post job and return its job id.
     """
-    print("--- Starting Stability AI Post to Instagram ---")
-    # Pick a random cartoon and art pattern for the image generation
-    picked_cartoon = random.choice(cartoons)
-    picked_pattern = random.choice(pattern)
-    print(f"Picked cartoon: {picked_cartoon}, Picked pattern: {picked_pattern}")
-
-    # Generate enhanced prompt for Stability AI
-    my_prompt, negative_prompt = generate_enhanced_prompt(picked_cartoon, picked_pattern, "stability")
-    print(f"Enhanced prompt: {my_prompt}")
-    print(f"Negative prompt: {negative_prompt}")
-
-    # generate image by stability
-    print("Generating image with Stability AI...")
-    stability_api = client.StabilityInference(
-        key=STABILITY_KEY, 
-        verbose=True,
-        engine="stable-diffusion-xl-1024-v1-0",)
-    answers = stability_api.generate(
-        prompt=[
-            generation.Prompt(text=my_prompt, parameters=generation.PromptParameters(weight=1.0)),
-            generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1.0))
-        ]
-    )
-    print("Image generation complete.")
-
-    current_time = int(time.time())
-    current_time_string = str(current_time)
-
-    # save image as file
-    image_path = f"/tmp/image_{BUSINESS_ACCOUNT_ID}_{current_time_string}.png"
-    for resp in answers:
-        for artifact in resp.artifacts:
-            if artifact.finish_reason == generation.FILTER:
-                print("NSFW content detected by Stability AI.")
-            if artifact.type == generation.ARTIFACT_IMAGE:
-                img = Image.open(io.BytesIO(artifact.binary))
-                img.save(image_path)
-                print(f"Image saved to {image_path}")
-
-    # Uploads a file to the Google Cloud Storage bucket
-    print("Uploading image to Google Cloud Storage...")
-    image_url = upload_to_bucket(current_time_string, image_path, "ai-bot-app-insta")
-    print(f"Image uploaded to GCS: {image_url}")
-
-    # Generate caption using vision model
-    print("Generating caption with Gemini...")
-    ai_response = gemini_chat_with_image(image_path, get_chat_with_image_template(my_prompt))
-    print(f"Generated caption: {ai_response}")
-
-    caption = f"{ai_response} #api #stabilityai #stablediffusion #texttoimage"
-
-    print("Posting to Instagram...")
-    exec_instagram_post(image_url, caption)
-    print("Posting to Threads...")
-    exec_threads_post(image_url, caption)
-
-    print("Removing temporary image file...")
-    remove_img_file(image_path)
-
-    print("--- Finished Stability AI Post to Instagram ---")
-    return "ok", 200
+    return idempotent(lambda: enqueue_post('stability', run_stability_post))
 
 @app.route('/openai_post_insta', methods=['GET'])
 def openai_post_insta():
     """
-    Generate a topic and place, use OpenAI to create a short description,
-    generate an image with DALL-E, upload to Google Cloud Storage,
-    generate a caption with Gemini, and post to Instagram and Threads.
-    """
-    print("--- Starting OpenAI Post to Instagram ---")
-    # pick topic randomly
-    picked_topic = random.choice(topic)
-    picked_place = random.choice(place)
-    print(f"Picked topic: {picked_topic}, Picked place: {picked_place}")
-
-    # make openai parameter
-    input = []
-    text = f'pick one {picked_topic} in {picked_place} countries then talk about it very shortly'
-    new_message = {"role":"user", "content":text}
-    input.append(new_message)
-
-    # generate text by openai
-    print(f"Generating text with OpenAI: {input}")
-    result = openai.chat.completions.create(model=OPENAI_MODEL, messages=input)
-    ai_response = result.choices[0].message.content
-    print(f"Generated text: {ai_response}")
-    
-    # Generate enhanced prompt for DALL-E 3
-    picked_pattern = random.choice(pattern)
-    my_prompt, _ = generate_enhanced_prompt(ai_response, picked_pattern, "dalle")
-    print(f"Enhanced DALL-E prompt: {my_prompt}")
-
-    # generate image by openai
-    print("Generating image with DALL-E...")
-    response = openai.images.generate(
-        model="dall-e-3",
-        prompt=my_prompt,
-        n=1,
-        size="1024x1024",
-    )
-    print(f"DALL-E response: {response}")
-
-    url = response.data[0].url
-
-    print("--- REQUEST ---")
-    print(f"  Method: GET")
-    print(f"  URL: {url}")
-    response = requests.get(url)
-    print("--- RESPONSE ---")
-    print(f"  Status Code: {response.status_code}")
-
-    current_time = int(time.time())
-    current_time_string = str(current_time)
-
-    # save image as file
-    image_path = f"/tmp/image_{BUSINESS_ACCOUNT_ID}_{current_time_string}.png"
-    with open(image_path, 'wb') as file:
-        file.write(response.content)
-    print(f"Image saved to {image_path}")
-
-    # Uploads a file to the Google Cloud Storage bucket
-    print("Uploading image to Google Cloud Storage...")
-    image_url = upload_to_bucket(current_time_string, image_path, "ai-bot-app-insta")
-    print(f"Image uploaded to GCS: {image_url}")
-
-    # Generate caption using vision model
-    print("Generating caption with Gemini...")
-    ai_response = gemini_chat_with_image(image_path, get_chat_with_image_template(my_prompt))
-    print(f"Generated caption: {ai_response}")
-
-    caption = f"{ai_response} #chatgpt #openai #api #dalle3 #texttoimage"
-    
-    print("Posting to Instagram...")
-    exec_instagram_post(image_url, caption)
-    print("Posting to Threads...")
-    exec_threads_post(image_url, caption)
-
-    print("Removing temporary image file...")
-    remove_img_file(image_path)
-
-    print("--- Finished OpenAI Post to Instagram ---")
-    return "ok", 200
+    Enqueue a DALL-E post job and return its job id.
+    """
+    return idempotent(lambda: enqueue_post('dalle', run_openai_post))
 
 @app.route('/imagen_post_insta', methods=['GET'])
 def imagen_post_insta():
     """
-    Generate an image using Google Imagen, upload to Google Cloud Storage,
-    generate a caption with Gemini, and post to Instagram and Threads.
+    Enqueue a Gemini image post job and return its job id.
     """
-    print("--- Starting Imagen Post to Instagram ---")
-    # pick cartoon and pattern
-    picked_cartoon = random.choice(cartoons)
-    picked_pattern = random.choice(pattern)
-    print(f"Picked cartoon: {picked_cartoon}, Picked pattern: {picked_pattern}")
-
-    # Generate enhanced prompt for Imagen
-    my_prompt, _ = generate_enhanced_prompt(picked_cartoon, picked_pattern, "imagen")
-    print(f"Enhanced Imagen prompt: {my_prompt}")
-
-    # Generate image using Gemini 3.1 Flash Image (Google)
-    print("Generating image with Gemini 3.1 Flash Image...")
-    client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-    result = client.models.generate_content(
-        model="gemini-3.1-flash-image",
-        contents=my_prompt,
-        config=types.GenerateContentConfig(
-            response_modalities=["IMAGE"],
-            image_config=types.ImageConfig(
-                aspect_ratio="1:1",
-            ),
-        ),
-    )
-    print("Image generation complete.")
-
-    img = None
-    if result.parts:
-        for part in result.parts:
-            if part.inline_data:
-                img = part.as_image()
-                break
-
-    if not img:
-        print("No images generated by Gemini 3.1 Flash Image.")
-        return "No image generated", 500
+    return idempotent(lambda: enqueue_post('imagen', run_imagen_post))
 
-    current_time = int(time.time())
-    current_time_string = str(current_time)
+@app.route('/publish_next', methods=['GET'])
+def publish_next():
+    """
+    Publish the next prepared post from the content buffer.
+    Takes an optional ?provider=; otherwise the provider with the most buffered posts is used.
+    Falls back to a live post when nothing is buffered.
+    """
+    provider = request.args.get('provider')
+    if provider and provider not in POST_PREPARERS:
+        return {"error": f"Unknown provider {provider}"}, 400
+    if not provider:
+        provider = deepest_content_buffer() or (CONTENT_BUFFER_PROVIDERS or list(POST_PREPARERS))[0]
+    return idempotent(lambda: enqueue_post(provider, POST_PIPELINES[provider]))
+
+@app.route('/auto_post', methods=['GET'])
+def auto_post():
+    """
+    Post with the provider expected to finish soonest, from recent prepare latency and success rate.
+    A fraction of posts (AUTO_POST_EXPLORATION) goes to a random healthy provider to keep estimates fresh.
+    """
+    def enqueue():
+        choice = choose_auto_post_provider()
+        if choice is None:
+            return {"error": "No healthy provider available", "providers": AUTO_POST_PROVIDERS}, 503
+        print(f"Auto post routed to {choice['provider']} ({choice['reason']})")
+        return enqueue_post(choice['provider'], POST_PIPELINES[choice['provider']], routing=choice)
+    return idempotent(enqueue)
+
+@app.route('/batch_post', methods=['GET', 'POST'])
+def batch_post():
+    """
+    Enqueue one job that prepares and publishes several posts concurrently.
+    The provider mix comes from query parameters or a JSON body, e.g. ?stability=3&dalle=2&imagen=2,
+    or ?count=6 to spread posts evenly over all providers.
+    """
+    body = request.get_json(silent=True)
+    if body is not None and not isinstance(body, dict):
+        return {"error": "JSON body must be an object, e.g. {\"stability\": 2}"}, 400
+    params = body or request.args
+    try:
+        counts = {provider: int(params.get(provider, 0)) for provider in POST_PREPARERS}
+        count = int(params.get('count', 0))
+    except (TypeError, ValueError):
+        return {"error": "Counts must be integers"}, 400
+    if not any(counts.values()):
+        providers = list(POST_PREPARERS)
+        for i in range(count):
+            counts[providers[i % len(providers)]] += 1
+    total = sum(counts.values())
+    if total <= 0 or any(n < 0 for n in counts.values()):
+        return {"error": "Request at least one post, e.g. ?stability=2&imagen=1 or ?count=3"}, 400
+    if total > BATCH_POST_MAX_ITEMS:
+        return {"error": f"At most {BATCH_POST_MAX_ITEMS} posts per batch"}, 400
+    return idempotent(lambda: job_response(enqueue_job('batch', run_batch_post, counts), items=counts))
+
+@app.route('/dedup_index', methods=['GET'])
+def get_dedup_index():
+    """
+    Get the number of used prompt combinations and published image hashes in the dedup index.
+    """
+    return dedup_report(), 200
 
-    # Save image as file
-    image_path = f"/tmp/image_{BUSINESS_ACCOUNT_ID}_{current_time_string}.jpg"
-    img.save(image_path)
-    print(f"Image saved to {image_path}")
+@app.route('/content_buffer', methods=['GET'])
+def get_content_buffer():
+    """
+    Get the depth, oldest item age and counters of each provider's content buffer.
+    """
+    return content_buffer_report(), 200
 
-    # Upload image to Google Cloud Storage
-    print("Uploading image to Google Cloud Storage...")
-    image_url = upload_to_bucket(current_time_string, image_path, "ai-bot-app-insta")
-    print(f"Image uploaded to GCS: {image_url}")
+@app.route('/provider_health', methods=['GET'])
+def get_provider_health():
+    """
+    Get each provider's circuit breaker state and rate limiter saturation, and caption latency.
+    """
+    return {**provider_health_report(), "captions": caption_latency_report()}, 200
 
-    # Generate caption using vision model
-    print("Generating caption with Gemini...")
-    ai_response = gemini_chat_with_image(image_path, get_chat_with_image_template(my_prompt))
-    print(f"Generated caption: {ai_response}")
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus text exposition of stage timings, provider calls, jobs and buffer depths.
+    """
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
-    caption = f"{ai_response} #api #google #imagen #texttoimage"
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """
+    Get the status of a queued, running or finished post job.
+    """
+    job = get_job(job_id)
+    if job is None:
+        return {"error": f"Job {job_id} not found"}, 404
+    return job, 200
 
-    # Post to Instagram and Threads
-    print("Posting to Instagram...")
-    exec_instagram_post(image_url, caption)
-    print("Posting to Threads...")
-    exec_threads_post(image_url, caption)
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    """
+    Continue a failed or interrupted post job from its checkpoint, under the same job id.
+    Targets that already published are skipped.
+    """
+    checkpoint = load_checkpoint(job_id)
+    if checkpoint is None:
+        return {"error": f"No checkpoint for job {job_id}"}, 404
+    if checkpoint['stage'] == 'finished':
+        return {"error": f"Job {job_id} already published to every target"}, 409
+    resumed, _ = enqueue_resume(job_id)
+    if resumed == JOB_ALREADY_ACTIVE:
+        return {"error": f"Job {job_id} is already queued or running"}, 409
+    return job_response(resumed, resumed_from=checkpoint['stage'], attempt=checkpoint['attempts'] + 1)
+
+@app.route('/warmup', methods=['GET'])
+def warmup():
+    """
+    Pre-initialize the configured providers and open their connections.
+    Suitable as a Cloud Run startup probe: it returns 503 only if a client cannot be built;
+    failures to reach a service are reported but do not fail the probe.
+    """
+    print(f"--- Warming up providers: {WARMUP_PROVIDERS} ---")
+    steps = ['storage', 'instagram', 'threads'] + [step for step in WARMUP_PROVIDERS if step in WARMUP_STEPS]
+    if GEMINI_API_KEY and 'imagen' not in steps:
+        steps.append('caption')
+    results = {}
+    healthy = True
+    for step in steps:
+        started = time.perf_counter()
+        try:
+            WARMUP_STEPS[step]()
+            results[step] = {"status": "ok"}
+        except ImportError as e:
+            healthy = False
+            results[step] = {"status": "error", "error": str(e)}
+        except Exception as e:
+            results[step] = {"status": "unreachable", "error": str(e)}
+        results[step]["seconds"] = round(time.perf_counter() - started, 3)
+        print(f"Warmup {step}: {results[step]}")
+    return {"providers": WARMUP_PROVIDERS, "steps": results, "startup": startup_report()}, 200 if healthy else 503
 
-    # Clean up temporary image file
-    print("Removing temporary image file...")
-    remove_img_file(image_path)
+@app.route('/startup_report', methods=['GET'])
+def get_startup_report():
+    """
+    Get the import-time report: where startup and first-use initialization time went.
+    """
+    return startup_report(), 200
 
-    print("--- Finished Imagen Post to Instagram ---")
-    return "ok", 200
+@app.route('/container_poller', methods=['GET'])
+def get_container_poller():
+    """
+    Get the shared container status poller's counters and time-to-FINISHED estimates.
+    """
+    with poller_condition:
+        return {
+            "in_flight": len(watched_containers),
+            "ready_estimates_seconds": dict(container_ready_estimates),
+            "batch_lookup": {kind: time.monotonic() >= until for kind, until in batch_status_paused_until.items()},
+            "stats": dict(poller_stats),
+        }, 200
 
 @app.route('/test_prompt_strategies', methods=['GET'])
 def test_prompt_strategies():
     """
     Test different prompt strategies and compare results.
     Useful for A/B testing and prompt optimization.
+
+    Every strategy runs ?samples=N times (default 1) on a bounded pool. All prompts and Stability
+    seeds derive from ?seed= (random if omitted), and sample i of every strategy uses the same
+    image seed, so a run can be reproduced and strategies are compared on equal footing.
     """
-    print("--- Testing Prompt Strategies ---")
-    picked_cartoon = random.choice(cartoons)
-    picked_pattern = random.choice(pattern)
-    
+    try:
+        samples = min(max(int(request.args.get('samples', 1)), 1), PROMPT_TEST_MAX_SAMPLES)
+        seed = int(request.args.get('seed', random.randrange(1, 2 ** 31)))
+    except ValueError:
+        return {"error": "samples and seed must be integers"}, 400
+    print(f"--- Testing Prompt Strategies (seed {seed}, {samples} samples each) ---")
+    rng = random.Random(seed)
+    picked_cartoon = rng.choice(cartoons)
+    picked_pattern = rng.choice(pattern)
+
+    # The enhanced strategy sends the negative prompt drawn together with its positive prompt
+    enhanced_prompt, negative_prompt = generate_enhanced_prompt(picked_cartoon, picked_pattern, "stability", rng)
     strategies = {
         'simple': f"{picked_cartoon}, {picked_pattern}",
-        'enhanced': generate_enhanced_prompt(picked_cartoon, picked_pattern, "stability")[0],
-        'character_focused': generate_character_prompt(picked_cartoon, picked_pattern),
+        'enhanced': enhanced_prompt,
+        'character_focused': generate_character_prompt(picked_cartoon, picked_pattern, rng),
         'complex': f"{picked_cartoon} character, {picked_pattern}, dramatic lighting, close-up shot, mysterious, highly detailed, 8k resolution"
     }
-    
+    negatives = {'enhanced': negative_prompt}
+
+    tasks = [
+        (strategy_name, prompt, negatives.get(strategy_name), (seed + sample) % (2 ** 32) or 1)
+        for strategy_name, prompt in strategies.items()
+        for sample in range(samples)
+    ]
+    with ThreadPoolExecutor(max_workers=min(len(tasks), PROMPT_TEST_CONCURRENCY), thread_name_prefix='prompt-test') as executor:
+        sample_results = list(executor.map(lambda task: run_strategy_sample(*task), tasks))
+
     results = {}
-    for strategy_name, prompt in strategies.items():
-        print(f"\n--- Testing {strategy_name} strategy ---")
-        print(f"Prompt: {prompt}")
-        
-        try:
-            # Generate image with Stability AI
-            stability_api = client.StabilityInference(
-                key=STABILITY_KEY, 
-                verbose=True,
-                engine="stable-diffusion-xl-1024-v1-0",)
-            
-            if strategy_name == 'enhanced':
-                _, negative_prompt = generate_enhanced_prompt(picked_cartoon, picked_pattern, "stability")
-                answers = stability_api.generate(
-                    prompt=[
-                        generation.Prompt(text=prompt, parameters=generation.PromptParameters(weight=1.0)),
-                        generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1.0))
-                    ]
-                )
-            else:
-                answers = stability_api.generate(prompt=prompt)
-            
-            # Save test image
-            current_time = int(time.time())
-            image_path = f"/tmp/test_{strategy_name}_{current_time}.png"
-            
-            for resp in answers:
-                for artifact in resp.artifacts:
-                    if artifact.finish_reason == generation.FILTER:
-                        results[strategy_name] = {"status": "NSFW", "error": "Content filtered"}
-                        break
-                    if artifact.type == generation.ARTIFACT_IMAGE:
-                        img = Image.open(io.BytesIO(artifact.binary))
-                        img.save(image_path)
-                        results[strategy_name] = {"status": "success", "image_path": image_path}
-                        print(f"Saved test image to {image_path}")
-                        break
-            
-        except Exception as e:
-            print(f"Error testing {strategy_name}: {e}")
-            results[strategy_name] = {"status": "error", "error": str(e)}
-    
+    for strategy_name in strategies:
+        runs = [run for run in sample_results if run['strategy'] == strategy_name]
+        succeeded = [run for run in runs if run['status'] == 'success']
+        latencies = [run['latency_seconds'] for run in runs if run['status'] != 'error']
+        results[strategy_name] = {
+            "samples": len(runs),
+            "success": len(succeeded),
+            "nsfw": sum(1 for run in runs if run['status'] == 'NSFW'),
+            "error": sum(1 for run in runs if run['status'] == 'error'),
+            "nsfw_rate": round(sum(1 for run in runs if run['status'] == 'NSFW') / len(runs), 3),
+            "latency_p50_seconds": percentile(latencies, 50),
+            "latency_p95_seconds": percentile(latencies, 95),
+            "mean_output_bytes": int(sum(run['output_bytes'] for run in succeeded) / len(succeeded)) if succeeded else None,
+            "runs": runs,
+        }
+
     print("--- Finished Testing Prompt Strategies ---")
-    return {"strategies": strategies, "results": results}, 200
+    return {"seed": seed, "samples": samples, "strategies": strategies, "negative_prompts": negatives, "results": results}, 200
+
+@app.route('/sample_prompts', methods=['GET'])
+def sample_prompts():
+    """
+    Draw a batch of seeded enhanced prompts, e.g. ?count=1000&type=dalle&seed=7.
+    The seed is random if omitted and is returned, so any batch can be drawn again.
+    """
+    try:
+        count = min(max(int(request.args.get('count', 10)), 1), PROMPT_SAMPLE_MAX)
+        seed = int(request.args.get('seed', random.randrange(1, 2 ** 31)))
+    except ValueError:
+        return {"error": "count and seed must be integers"}, 400
+    prompt_type = request.args.get('type', 'stability')
+    pairs = sample_enhanced_prompts(count, prompt_type, seed)
+    return {"seed": seed, "type": prompt_type, "prompts": [{"prompt": p, "negative_prompt": n} for p, n in pairs]}, 200
 
 @app.route('/prompt_performance', methods=['GET'])
 def get_prompt_performance():
     """
-    Get current prompt performance statistics.
+    Get attempts, successes, NSFW filters, publishes and generation/end-to-end latency
+    quantiles per provider and prompt strategy.
     """
-    return {"performance": prompt_performance}, 200
+    return {"performance": prompt_performance_report()}, 200
 
 @app.route('/reset_prompt_performance', methods=['POST'])
 def reset_prompt_performance():
     """
-    Reset prompt performance tracking.
+    Reset prompt performance tracking, including its persisted history.
     """
-    global prompt_performance
-    prompt_performance = {
-        'stability': {'enhanced': 0, 'simple': 0},
-        'dalle': {'enhanced': 0, 'simple': 0},
-        'imagen': {'enhanced': 0, 'simple': 0}
-    }
+    reset_prompt_performance_store()
     return {"message": "Performance tracking reset"}, 200
 
-# --- Utility Functions ---
+# --- Post Pipelines ---
+# These run on the job worker pool, never on a request thread.
+# The generated image travels through every stage as one in-memory artifact
+# ({'data': bytes, 'mime_type': str}); nothing is written to disk.
 
-def upload_to_bucket(blob_name, file_path, bucket_name):
+def run_stability_post():
     """
-    Upload a file to Google Cloud Storage and return its public URL.
+    Generate, caption and publish a Stability AI post.
     """
-    # Create a Cloud Storage client
-    storage_client = storage.Client()
+    return publish_prepared_post(prepare_post('stability'))
 
-    # Get the bucket that the file will be uploaded to
-    bucket = storage_client.bucket(bucket_name)
+def run_openai_post():
+    """
+    Generate, caption and publish a DALL-E post.
+    """
+    return publish_prepared_post(prepare_post('dalle'))
 
-    # Create a new blob and upload the file's content
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(file_path)
+def run_imagen_post():
+    """
+    Generate, caption and publish a Gemini image post.
+    """
+    return publish_prepared_post(prepare_post('imagen'))
 
-    # Make the blob publicly viewable
-    blob.make_public()
+POST_HASHTAGS = {
+    'stability': "#api #stabilityai #stablediffusion #texttoimage",
+    'dalle': "#chatgpt #openai #api #dalle3 #texttoimage",
+    'imagen': "#api #google #imagen #texttoimage",
+}
 
-    # Return the public URL of the uploaded file
-    return blob.public_url
+def prepare_stability_post():
+    """
+    Generate an image using Stability AI based on a random cartoon and art pattern,
+    upload it to Google Cloud Storage and generate a caption using Gemini vision model.
+    Returns a prepared post for publish_prepared_post.
+    """
+    print("--- Preparing Stability AI Post ---")
+    my_prompt, generate_args, reservation = build_stability_prompt()
+    artifact, performance = track_generation('stability', 'enhanced', generate_stability_image, *generate_args, reservation=reservation)
+    prepared = upload_and_caption('stability', artifact, my_prompt, POST_HASHTAGS['stability'], performance)
 
-def exec_openai_vision(image_url, my_prompt):
+    print("--- Prepared Stability AI Post ---")
+    return prepared
+
+def build_stability_prompt():
     """
-    Use OpenAI's vision model to generate a description for an image.
+    Pick a fresh cartoon and art pattern and build the Stability AI prompts.
+    Returns (prompt, generate_stability_image arguments, combination reservation).
     """
-    print(f"Generating OpenAI vision description for image: {image_url}")
-    response = openai.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=[
-            {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    "text": f"What are in this image? Describe it good for sns post. The image title tells that {my_prompt}",
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": image_url,
-                    },
-                },
-            ],
-            }
-        ],
-        max_tokens=1000,
-    )
+    with stage_span('prompt_build'):
+        # Pick a random cartoon and art pattern for the image generation
+        picked_cartoon, picked_pattern, reservation = pick_fresh_combination('stability', PROMPT_VOCABULARIES['cartoon'], PROMPT_VOCABULARIES['pattern'])
+        print(f"Picked cartoon: {picked_cartoon}, Picked pattern: {picked_pattern}")
+
+        # Generate enhanced prompt for Stability AI
+        my_prompt, negative_prompt = generate_enhanced_prompt(picked_cartoon, picked_pattern, "stability")
+        print(f"Enhanced prompt: {my_prompt}")
+        print(f"Negative prompt: {negative_prompt}")
+    return my_prompt, (my_prompt, negative_prompt), reservation
+
+def prepare_openai_post():
+    """
+    Generate a topic and place, use OpenAI to create a short description,
+    generate an image with DALL-E, upload to Google Cloud Storage and
+    generate a caption with Gemini. Returns a prepared post for publish_prepared_post.
+    """
+    print("--- Preparing OpenAI Post ---")
+    my_prompt, generate_args, reservation = build_openai_prompt()
+    artifact, performance = track_generation('dalle', 'enhanced', generate_dalle_image, *generate_args, reservation=reservation)
+    prepared = upload_and_caption('dalle', artifact, my_prompt, POST_HASHTAGS['dalle'], performance)
 
-    ai_response = response.choices[0].message.content
-    print(f"OpenAI vision response: {ai_response}")
-    return ai_response
+    print("--- Prepared OpenAI Post ---")
+    return prepared
 
-def gemini_chat_with_image(image_path, prompt_text):
+def build_openai_prompt():
     """
-    Use Gemini API to generate a caption for an image given a prompt.
+    Pick a fresh topic and place, have OpenAI describe it and build the DALL-E prompt from that.
+    Returns (prompt, generate_dalle_image arguments, combination reservation).
     """
-    print(f"Generating Gemini caption for image: {image_path}")
-    try:
-        with open(image_path, "rb") as img_file:
-            image_bytes = img_file.read()
-        encoded_image = base64.b64encode(image_bytes)
-
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_bytes(mime_type="image/jpeg", data=base64.b64decode(encoded_image)),
-                    types.Part.from_text(text=prompt_text)
-                ],
-            )
-        ]
+    with stage_span('prompt_build'):
+        # pick topic randomly
+        picked_topic, picked_place, reservation = pick_fresh_combination('dalle', PROMPT_VOCABULARIES['topic'], PROMPT_VOCABULARIES['place'])
+        print(f"Picked topic: {picked_topic}, Picked place: {picked_place}")
+
+        # make openai parameter
+        input = []
+        text = f'pick one {picked_topic} in {picked_place} countries then talk about it very shortly'
+        new_message = {"role":"user", "content":text}
+        input.append(new_message)
+
+        # generate text by openai
+        print(f"Generating text with OpenAI: {input}")
+        openai = get_client('openai')
+        try:
+            # The image call takes the post's rate limit token
+            result = call_provider('dalle', openai.chat.completions.create, model=OPENAI_MODEL, messages=input, rate_limited=False, **openai_request_options(PROVIDER_CALL_TIMEOUT_SECONDS or None))
+        except Exception:
+            release_combination(reservation)
+            raise
+        ai_response = result.choices[0].message.content
+        print(f"Generated text: {ai_response}")
+
+        # Generate enhanced prompt for DALL-E 3
+        picked_pattern = random.choice(PROMPT_VOCABULARIES['pattern'])
+        my_prompt, _ = generate_enhanced_prompt(ai_response, picked_pattern, "dalle")
+        print(f"Enhanced DALL-E prompt: {my_prompt}")
+    return my_prompt, (my_prompt,), reservation
+
+def prepare_imagen_post():
+    """
+    Generate an image using Google Imagen, upload to Google Cloud Storage and
+    generate a caption with Gemini. Returns a prepared post for publish_prepared_post.
+    """
+    print("--- Preparing Imagen Post ---")
+    my_prompt, generate_args, reservation = build_imagen_prompt()
+    artifact, performance = track_generation('imagen', 'enhanced', generate_imagen_image, *generate_args, reservation=reservation)
+    prepared = upload_and_caption('imagen', artifact, my_prompt, POST_HASHTAGS['imagen'], performance)
 
-        generate_content_config = types.GenerateContentConfig(response_mime_type="text/plain")
+    print("--- Prepared Imagen Post ---")
+    return prepared
 
-        genai_client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-        # Generate content with image and text
-        response = ""
-        for chunk in genai_client.models.generate_content_stream(
-            model="gemini-2.5-flash",
-            contents=contents,
-            config=generate_content_config,
-        ):
-            response += chunk.text or ""
-        print(f"Gemini response: {response}")
-        return response
+def build_imagen_prompt():
+    """
+    Pick a fresh cartoon and art pattern and build the Imagen prompt.
+    Returns (prompt, generate_imagen_image arguments, combination reservation).
+    """
+    with stage_span('prompt_build'):
+        # pick cartoon and pattern
+        picked_cartoon, picked_pattern, reservation = pick_fresh_combination('imagen', PROMPT_VOCABULARIES['cartoon'], PROMPT_VOCABULARIES['pattern'])
+        print(f"Picked cartoon: {picked_cartoon}, Picked pattern: {picked_pattern}")
 
-    except Exception as e:
-        print(f"Error during image + text Gemini request: {e}")
-        return f"Error: {e}"
+        # Generate enhanced prompt for Imagen
+        my_prompt, _ = generate_enhanced_prompt(picked_cartoon, picked_pattern, "imagen")
+        print(f"Enhanced Imagen prompt: {my_prompt}")
+    return my_prompt, (my_prompt,), reservation
 
-def wait_for_media_ready(media_id, access_token, timeout=120, poll_interval=2):
-    """Waits for a media container to be ready for publishing."""
-    print(f"Waiting for media container {media_id} to be ready...")
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        status_url = f"https://graph.instagram.com/v22.0/{media_id}?fields=status_code&access_token={access_token}"
-        print("--- REQUEST ---")
-        print(f"  Method: GET")
-        print(f"  URL: {status_url}")
-        response = requests.get(status_url)
-        print("--- RESPONSE ---")
-        print(f"  Status Code: {response.status_code}")
-        print(f"  Text: {response.text}")
-        if response.status_code != 200:
-            print(f"Warning: Received status {response.status_code} when checking media status.")
-            time.sleep(poll_interval)
-            continue
+def upload_and_caption(provider, artifact, my_prompt, hashtags, performance=None):
+    """
+    Shared tail of every prepare step: upload the artifact to Google Cloud Storage
+    and caption it.
+
+    Returns:
+        dict: prepared post with provider, prompt, image_url, caption and prepared_at
+    """
+    prepared, image_bytes = upload_artifact(provider, artifact, my_prompt, hashtags, performance)
 
-        status_data = response.json()
-        status = status_data.get("status_code")
-        print(f"Current media status: {status}")
+    # Generate caption using vision models; streamed images are read back from their public URL
+    print("Generating caption...")
+    with stage_span('caption'):
+        ai_response, caption_provider = generate_caption(my_prompt, image_bytes, prepared['mime_type'], prepared['image_url'])
+    return add_caption(prepared, ai_response, caption_provider)
 
-        if status == "FINISHED":
-            print("Media is ready for publishing.")
-            return True
-        elif status == "ERROR" or status == "EXPIRED":
-            raise Exception(f"Media container failed with status: {status}. Full response: {status_data}")
+def upload_artifact(provider, artifact, my_prompt, hashtags, performance=None):
+    """
+    Encode, dedup-check and upload a generated artifact to Google Cloud Storage, and
+    checkpoint the job at 'uploaded'.
+    Artifacts that are only a provider URL are streamed into the bucket when
+    STREAM_URL_UPLOADS is on, and downloaded into memory otherwise.
+
+    Returns:
+        tuple: (prepared post without its caption, image bytes for the caption or None when streamed)
+    """
+    if 'data' not in artifact and not STREAM_URL_UPLOADS:
+        with stage_span('download'):
+            artifact = download_image(artifact['source_url'])
+
+    # Convert to an Instagram-ready JPEG once, so every later stage moves the smaller file
+    encode_stats = None
+    if ENCODE_ENABLED and 'data' in artifact:
+        with stage_span('encode'):
+            artifact, encode_stats = encode_for_instagram(artifact)
+
+    # Reject near-duplicates of published images before paying for upload, caption and publish.
+    # Streamed artifacts are never in memory as a whole and are not checked.
+    phash = None
+    if DEDUP_ENABLED and 'data' in artifact:
+        phash = image_phash(artifact['data'])
+        match = find_near_duplicate(phash)
+        if match:
+            raise Exception(f"Generated image is a near-duplicate (distance {match['distance']}) of published image {match['image_url']}")
+
+    # Upload the image to Google Cloud Storage
+    print("Uploading image to Google Cloud Storage...")
+    with stage_span('gcs_upload'):
+        if 'data' in artifact:
+            image_url = upload_to_bucket(new_blob_name(artifact['mime_type']), artifact['data'], GCS_BUCKET_NAME, artifact['mime_type'])
+            sha256 = hashlib.sha256(artifact['data']).hexdigest()
+        else:
+            upload = stream_url_to_bucket(artifact['source_url'], GCS_BUCKET_NAME)
+            image_url, sha256 = upload['public_url'], upload['sha256']
+            artifact = {'mime_type': upload['mime_type']}
+    print(f"Image uploaded to GCS: {image_url}")
+    prepared = {"provider": provider, "prompt": my_prompt, "image_url": image_url, "mime_type": artifact['mime_type'],
+                "sha256": sha256, "hashtags": hashtags, "phash": phash, "encode": encode_stats, "performance": performance}
+    checkpoint_prepared('uploaded', prepared)
+    return prepared, artifact.get('data')
 
-        time.sleep(poll_interval)
+def add_caption(prepared, ai_response, caption_provider):
+    """
+    Complete a prepared post with its caption and hashtags.
+    """
+    print(f"Generated caption with {caption_provider}: {ai_response}")
+    return {**prepared, "caption": f"{ai_response} {prepared['hashtags']}", "caption_provider": caption_provider, "prepared_at": time.time()}
 
-    raise Exception(f"Media container not ready after {timeout} seconds.")
+def publish_prepared_post(prepared, targets=None, container_ids=None, already_published=None):
+    """
+    Publish a prepared post to Instagram and Threads.
+    A resumed job passes only its unpublished targets, their checkpointed containers
+    and the results of the targets that already published.
+    """
+    targets = begin_publish(prepared, targets)
+    token = trace_provider_var.set(prepared['provider'])
+    started = time.time()
+    try:
+        publish_results = {**(already_published or {}), **publish_to_targets(prepared['image_url'], prepared['caption'], targets, container_ids)}
+    finally:
+        trace_provider_var.reset(token)
+    return finish_publish(prepared, publish_results, already_published, started)
 
+def begin_publish(prepared, targets=None):
+    """
+    Checkpoint a prepared post before publishing it. Returns the targets to publish to.
+    """
+    targets = targets or tuple(PUBLISHERS)
+    print(f"--- Posting {prepared['provider']} post to {', '.join(targets)} ---")
+    checkpoint_prepared('prepared', prepared)
+    return targets
 
-def wait_for_threads_media_ready(media_id, access_token, timeout=120, poll_interval=2):
-    """Waits for a Threads media container to be ready for publishing."""
-    print(f"Waiting for Threads media container {media_id} to be ready...")
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        status_url = f"https://graph.threads.net/v1.0/{media_id}?fields=status&access_token={access_token}"
-        print("--- REQUEST ---")
-        print(f"  Method: GET")
-        print(f"  URL: {status_url}")
-        response = requests.get(status_url)
-        print("--- RESPONSE ---")
-        print(f"  Status Code: {response.status_code}")
-        print(f"  Text: {response.text}")
-        if response.status_code != 200:
-            print(f"Warning: Received status {response.status_code} when checking Threads media status.")
-            time.sleep(poll_interval)
+def finish_publish(prepared, publish_results, already_published, started):
+    """
+    Record a published post's image hash and end-to-end time, and build the job result.
+    """
+    # The image was already recorded if an earlier attempt published it anywhere
+    published = not already_published and any(result['status'] == 'published' for result in publish_results.values())
+    if prepared.get('phash') is not None and published:
+        record_published_image(prepared['phash'], prepared['provider'], prepared['image_url'])
+    performance = prepared.get('performance')
+    if performance and published:
+        # Time spent preparing plus publishing, leaving out any wait in the content buffer
+        record_prompt_published(performance, (prepared['prepared_at'] - performance['started_at']) + (time.time() - started))
+    print(f"--- Finished {prepared['provider']} post ---")
+    return {"provider": prepared['provider'], "fallback_from": prepared.get('fallback_from'), "image_url": prepared['image_url'], "sha256": prepared.get('sha256'), "caption": prepared['caption'], "encode": prepared.get('encode'), "publish": publish_results}
+
+def prepare_post(provider, fallback=True):
+    """
+    Run a provider's prepare step within its PROVIDER_CONCURRENCY limit.
+    If the provider is unavailable (breaker open, rate limit saturated or generation failing),
+    try the next available provider in PROVIDER_FALLBACK_ORDER with its own prompt style.
+    """
+    candidates = prepare_candidates(provider, fallback)
+    errors = []
+    for candidate in candidates:
+        if not provider_available(candidate):
+            errors.append(f"{candidate}: circuit open")
+            continue
+        started = time.perf_counter()
+        token = trace_provider_var.set(candidate)
+        try:
+            semaphore = provider_semaphores[candidate]
+            if not semaphore.acquire(timeout=budget_timeout(None, 'provider slot')):
+                raise DeadlineExceeded(f"Job deadline exceeded waiting for a {candidate} slot")
+            try:
+                prepared = POST_PREPARERS[candidate]()
+            finally:
+                semaphore.release()
+        except ProviderUnavailable as e:
+            print(f"Provider {candidate} unavailable: {e}")
+            record_prepare_sample(candidate, time.perf_counter() - started, False)
+            errors.append(f"{candidate}: {e}")
             continue
+        except Exception:
+            # Upload, caption and dedup failures end the post, but still count against the provider
+            record_prepare_sample(candidate, time.perf_counter() - started, False)
+            raise
+        finally:
+            trace_provider_var.reset(token)
+        record_prepare_sample(candidate, time.perf_counter() - started, True)
+        if candidate != provider:
+            print(f"Prepared {provider} post with fallback provider {candidate}")
+            prepared['fallback_from'] = provider
+        return prepared
+    raise ProviderUnavailable(f"No available provider for {provider} post ({'; '.join(errors)})")
+
+def prepare_candidates(provider, fallback=True):
+    """
+    The provider followed, when fallback is on, by the other providers in PROVIDER_FALLBACK_ORDER.
+    """
+    return [provider] + ([p for p in PROVIDER_FALLBACK_ORDER if p != provider and p in POST_PREPARERS] if fallback else [])
 
-        status_data = response.json()
-        status = status_data.get("status")
-        print(f"Current Threads media status: {status}")
+def run_batch_post(counts):
+    """
+    Prepare and publish counts[provider] posts for each provider, all concurrently,
+    each provider capped by its PROVIDER_CONCURRENCY limit.
 
-        if status == "FINISHED":
-            print("Threads media is ready for publishing.")
-            return True
-        elif status == "ERROR":
-            raise Exception(f"Threads media container failed with status: {status}. Full response: {status_data}")
+    Returns:
+        dict: per-item results in submission order and a status summary
+    """
+    providers = [provider for provider, n in counts.items() for _ in range(n)]
+    print(f"--- Starting batch of {len(providers)} posts: {counts} ---")
+    # One thread per item (at most BATCH_POST_MAX_ITEMS); provider_semaphores do the actual limiting,
+    # so items waiting on a busy provider never hold up another provider's items. The batch also
+    # publishes on a pool of its own with a thread per target of every item, so its container waits
+    # never queue behind each other on the shared publish_executor.
+    with ThreadPoolExecutor(max_workers=len(providers), thread_name_prefix='batch-item') as executor, \
+            ThreadPoolExecutor(max_workers=len(providers) * len(PUBLISHERS), thread_name_prefix='batch-publish') as batch_publish_executor:
+        token = publish_executor_var.set(batch_publish_executor)
+        try:
+            futures = [submit_traced(executor, POST_PIPELINES[provider]) for provider in providers]
+        finally:
+            publish_executor_var.reset(token)
+        items = []
+        for index, (provider, future) in enumerate(zip(providers, futures)):
+            try:
+                result = future.result()
+                items.append({"index": index, "provider": provider, "status": job_status_for_result(result), "result": result})
+            except DeadlineExceeded as e:
+                print(f"Batch item {index} ({provider}) timed out: {e}")
+                items.append({"index": index, "provider": provider, "status": "timed_out", "error": str(e)})
+            except Exception as e:
+                print(f"Batch item {index} ({provider}) failed: {e}")
+                items.append({"index": index, "provider": provider, "status": "failed", "error": str(e)})
+    summary = {status: sum(1 for item in items if item['status'] == status) for status in ('succeeded', 'partial', 'timed_out', 'failed')}
+    print(f"--- Finished batch: {summary} ---")
+    return {"items": items, "summary": summary}
+
+# Prepare step and full pipeline for each provider, keyed like prompt_performance.
+POST_PREPARERS = {
+    'stability': prepare_stability_post,
+    'dalle': prepare_openai_post,
+    'imagen': prepare_imagen_post,
+}
+POST_PIPELINES = {
+    'stability': run_stability_post,
+    'dalle': run_openai_post,
+    'imagen': run_imagen_post,
+}
 
-        time.sleep(poll_interval)
+def provider_concurrency(provider):
+    return PROVIDER_CONCURRENCY.get(provider, PROVIDER_CONCURRENCY_DEFAULT)
 
-    raise Exception(f"Threads media container not ready after {timeout} seconds.")
+provider_semaphores = {provider: threading.BoundedSemaphore(provider_concurrency(provider)) for provider in POST_PREPARERS}
 
+# --- Image Generation ---
+# Each generator returns the image as an in-memory artifact, {'data': bytes, 'mime_type': str},
+# or, for providers that serve the result from a URL, as {'source_url': str}.
 
-def exec_instagram_post(image_url, caption):
+def generate_stability_image(my_prompt, negative_prompt):
     """
-    Post an image and caption to Instagram (feed and story).
+    Generate an image with Stability AI. The artifact bytes are already an encoded PNG,
+    so they are used as-is.
     """
-    print("Executing Instagram post...")
-    # Upload the image to Facebook
-    url = f"https://graph.instagram.com/v22.0/{BUSINESS_ACCOUNT_ID}/media"
-    params = {'access_token': PAGE_ACCESS_TOKEN, 'image_url':image_url, 'caption':caption}
-    print("--- REQUEST ---")
-    print(f"  Method: POST")
-    print(f"  URL: {url}")
-    print(f"  Params: {params}")
-    response = requests.post(url, params=params)
-    print("--- RESPONSE ---")
-    print(f"  Status Code: {response.status_code}")
-    print(f"  Text: {response.text}")
-    if response.status_code != 200:
-        print(f"Failed to upload image for post: {response.text}")
-        raise Exception(f"Failed to upload image: {response.text}")
-    media_id = response.json()['id']
-    print(f"Created media container for post with ID: {media_id}")
-
-    # Wait for the media container to be ready
-    wait_for_media_ready(media_id, PAGE_ACCESS_TOKEN)
+    print("Generating image with Stability AI...")
+    generation = lazy_import(STABILITY_GENERATION_MODULE)
+    stability_api = get_client('stability')
+    answers = stability_api.generate(
+        prompt=[
+            generation.Prompt(text=my_prompt, parameters=generation.PromptParameters(weight=1.0)),
+            generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1.0))
+        ]
+    )
 
-    # Publish the photo to Instagram
-    print(f"Publishing post with creation ID: {media_id}")
-    url = f"https://graph.instagram.com/v22.0/{BUSINESS_ACCOUNT_ID}/media_publish"
-    params = {'access_token': PAGE_ACCESS_TOKEN, 'creation_id': media_id}
+    image_data = None
+    nsfw = False
+    for resp in answers:
+        for artifact in resp.artifacts:
+            if artifact.finish_reason == generation.FILTER:
+                print("NSFW content detected by Stability AI.")
+                nsfw = True
+            if artifact.type == generation.ARTIFACT_IMAGE:
+                image_data = artifact.binary
+    print("Image generation complete.")
+
+    if not image_data:
+        raise Exception("No image generated by Stability AI.")
+    return {'data': image_data, 'mime_type': 'image/png', 'nsfw': nsfw}
+
+def generate_dalle_image(my_prompt):
+    """
+    Generate an image with DALL-E 3. The result is left at its URL for upload_artifact to fetch.
+    """
+    print("Generating image with DALL-E...")
+    openai = get_client('openai')
+    response = openai.images.generate(**dalle_request(my_prompt))
+    print(f"DALL-E response: {response}")
+    return {'source_url': response.data[0].url}
+
+def dalle_request(my_prompt):
+    """
+    Keyword arguments for an images.generate call, shared with the async client in asgi.py.
+    """
+    return {'model': "dall-e-3", 'prompt': my_prompt, 'n': 1, 'size': "1024x1024", **openai_request_options(PROVIDER_CALL_TIMEOUT_SECONDS or None)}
+
+def generate_imagen_image(my_prompt):
+    """
+    Generate an image using Gemini 3.1 Flash Image (Google).
+    """
+    print("Generating image with Gemini 3.1 Flash Image...")
+    genai_client = get_client('genai')
+    result = genai_client.models.generate_content(**imagen_request(my_prompt))
+    print("Image generation complete.")
+    return imagen_artifact(result)
+
+def imagen_request(my_prompt):
+    """
+    Keyword arguments for a generate_content call, shared with the async client in asgi.py.
+    """
+    types = lazy_import('google.genai.types')
+    return {
+        'model': "gemini-3.1-flash-image",
+        'contents': my_prompt,
+        'config': types.GenerateContentConfig(
+            response_modalities=["IMAGE"],
+            image_config=types.ImageConfig(
+                aspect_ratio="1:1",
+            ),
+            http_options=genai_http_options(PROVIDER_CALL_TIMEOUT_SECONDS or None),
+        ),
+    }
+
+def imagen_artifact(result):
+    """
+    The first inline image of a generate_content result as an artifact.
+    """
+    if result.parts:
+        for part in result.parts:
+            if part.inline_data:
+                return {'data': part.inline_data.data, 'mime_type': part.inline_data.mime_type or 'image/png'}
+
+    print("No images generated by Gemini 3.1 Flash Image.")
+    raise Exception("No image generated by Gemini 3.1 Flash Image.")
+
+def encode_for_instagram(artifact):
+    """
+    Convert an in-memory image to a JPEG that meets Instagram's feed spec: RGB, aspect ratio
+    between 4:5 and 1.91:1 (center-cropped if outside), longest side at most
+    ENCODE_MAX_DIMENSION, width at least 320, and at most ENCODE_MAX_BYTES.
+    A JPEG that already meets the spec is passed through untouched to avoid a second lossy pass.
+
+    Returns:
+        tuple: (artifact, stats) where stats has original/encoded bytes, bytes saved,
+        encode time, final size and JPEG quality
+    """
+    Image = lazy_import('PIL.Image')
+    started = time.perf_counter()
+    original_bytes = len(artifact['data'])
+    with Image.open(BytesIO(artifact['data'])) as img:
+        width, height = img.size
+        fits = (
+            img.format == 'JPEG' and img.mode == 'RGB' and original_bytes <= ENCODE_MAX_BYTES
+            and ENCODE_MIN_DIMENSION <= width and max(width, height) <= ENCODE_MAX_DIMENSION
+            and ENCODE_MIN_ASPECT <= width / height <= ENCODE_MAX_ASPECT
+        )
+        if fits:
+            data, quality = artifact['data'], None
+        else:
+            img = flatten_to_rgb(img)
+            img = crop_to_aspect(img, ENCODE_MIN_ASPECT, ENCODE_MAX_ASPECT)
+            scale = min(ENCODE_MAX_DIMENSION / max(img.size), 1)
+            scale = max(scale, ENCODE_MIN_DIMENSION / img.size[0])
+            if scale != 1:
+                img = img.resize((round(img.size[0] * scale), round(img.size[1] * scale)), Image.LANCZOS)
+            width, height = img.size
+            quality = ENCODE_JPEG_QUALITY
+            while True:
+                buffer = BytesIO()
+                img.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+                data = buffer.getvalue()
+                if len(data) <= ENCODE_MAX_BYTES or quality <= ENCODE_MIN_JPEG_QUALITY:
+                    break
+                quality = max(quality - 10, ENCODE_MIN_JPEG_QUALITY)
+
+    stats = {
+        'original_mime_type': artifact['mime_type'],
+        'original_bytes': original_bytes,
+        'encoded_bytes': len(data),
+        'bytes_saved': original_bytes - len(data),
+        'encode_seconds': round(time.perf_counter() - started, 4),
+        'size': [width, height],
+        'quality': quality,
+    }
+    print(f"Encoded {artifact['mime_type']} {original_bytes} bytes -> image/jpeg {len(data)} bytes "
+          f"({stats['bytes_saved']} saved) in {stats['encode_seconds']}s")
+    return {'data': data, 'mime_type': 'image/jpeg'}, stats
+
+def flatten_to_rgb(img):
+    """
+    Return an RGB copy of an image, compositing any transparency onto white.
+    """
+    Image = lazy_import('PIL.Image')
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+def crop_to_aspect(img, min_aspect, max_aspect):
+    """
+    Center-crop an image so its width/height ratio lies within [min_aspect, max_aspect].
+    """
+    width, height = img.size
+    aspect = width / height
+    if aspect > max_aspect:
+        new_width = round(height * max_aspect)
+        left = (width - new_width) // 2
+        return img.crop((left, 0, left + new_width, height))
+    if aspect < min_aspect:
+        new_height = round(width / min_aspect)
+        top = (height - new_height) // 2
+        return img.crop((0, top, width, top + new_height))
+    return img
+
+def download_image(url):
+    """
+    Download an image from a provider URL into memory.
+    """
     print("--- REQUEST ---")
-    print(f"  Method: POST")
+    print(f"  Method: GET")
     print(f"  URL: {url}")
-    print(f"  Params: {params}")
-    response = requests.post(url, params=params)
+    response = http_request('GET', url)
     print("--- RESPONSE ---")
     print(f"  Status Code: {response.status_code}")
-    print(f"  Text: {response.text}")
     if response.status_code != 200:
-        print(f"Failed to publish photo for post: {response.text}")
-        raise Exception(f"Failed to publish photo: {response.text}")
+        raise Exception(f"Failed to download image: {response.status_code}")
+    mime_type = response.headers.get('Content-Type', 'image/png').split(';')[0]
+    return {'data': response.content, 'mime_type': mime_type}
+
+# --- Job Queue ---
+# Jobs live in memory for JOB_RETENTION_SECONDS after they finish.
+
+jobs = {}
+jobs_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=POST_WORKER_CONCURRENCY, thread_name_prefix='post-job')
+job_dispatcher = None  # asgi.py installs a function that runs jobs on its event loop instead
+JOB_ALREADY_ACTIVE = 'already_active'  # enqueue_job result when job_id is already queued or running
+
+def enqueue_job(kind, target, *args, job_id=None):
+    """
+    Register a job and submit it to the worker pool. Pass job_id to run a job again under its own id.
+    Returns the job id, None when POST_QUEUE_MAX jobs are already queued or running, or
+    JOB_ALREADY_ACTIVE when job_id is itself queued or running.
+    """
+    with jobs_lock:
+        prune_finished_jobs()
+        if job_id in jobs and jobs[job_id]['status'] in ('queued', 'running'):
+            print(f"Job {job_id} is already {jobs[job_id]['status']}, not enqueuing it again.")
+            return JOB_ALREADY_ACTIVE
+        active = sum(1 for job in jobs.values() if job['status'] in ('queued', 'running'))
+        if active >= POST_QUEUE_MAX:
+            print(f"Job queue is full ({active} active jobs), rejecting {kind} job.")
+            return None
+        job_id = job_id or uuid.uuid4().hex
+        created_at = time.time()
+        budget = BATCH_JOB_DEADLINE_SECONDS if kind == 'batch' else JOB_DEADLINE_SECONDS
+        jobs[job_id] = {
+            'id': job_id,
+            'trace_id': job_id,
+            'kind': kind,
+            'status': 'queued',
+            'created_at': created_at,
+            'deadline_at': created_at + budget if budget > 0 else None,
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+            'error': None,
+            'spans': [],
+        }
+    if job_dispatcher is not None:
+        job_dispatcher(job_id, target, args)
+    else:
+        submit_traced(job_executor, run_job, job_id, target, args)
+    print(f"Enqueued {kind} job {job_id}")
+    return job_id
+
+def job_response(job_id, **extra):
+    """
+    Build the HTTP response for an enqueue attempt from its job id (None when the queue was full).
+    """
+    if job_id is None:
+        return {"error": "Job queue is full, try again later"}, 503
+    status_url = f"/jobs/{job_id}"
+    return {"job_id": job_id, "status": "queued", "status_url": status_url, **extra}, 202, {'Location': status_url}
+
+def enqueue_post(provider, live_pipeline, **extra):
+    """
+    Enqueue a post for a provider: publish the next buffered post when the content buffer
+    has one, otherwise run the live pipeline.
+    """
+    prepared = take_buffered_post(provider)
+    if prepared is None:
+        return job_response(enqueue_job(provider, live_pipeline), source="live", **extra)
+    job_id = enqueue_job(provider, publish_prepared_post, prepared)
+    if job_id is None:
+        return_buffered_post(prepared)
+    return job_response(job_id, source="buffer", **extra)
+
+def run_job(job_id, target, args):
+    """
+    Run a job's pipeline on a worker thread and record its outcome.
+    """
+    kind, started = begin_job(job_id)
+    try:
+        check_deadline('start')  # the budget may have gone on queue wait
+        result = target(*args)
+    except Exception as e:
+        finish_job(job_id, kind, started, error=e)
+        return
+    finish_job(job_id, kind, started, result=result)
+
+def begin_job(job_id):
+    """
+    Mark a job running and set up its trace, deadline and checkpoint in the current context.
+    Each job runs in its own copied context (a worker thread via submit_traced, or an asyncio task),
+    so these do not leak between jobs.
+
+    Returns:
+        tuple: (job kind, start time)
+    """
+    started = time.time()
+    update_job(job_id, status='running', started_at=started)
+    with jobs_lock:
+        kind = jobs[job_id]['kind']
+        deadline_at = jobs[job_id]['deadline_at']
+        trace_spans_var.set(jobs[job_id]['spans'])
+    trace_id_var.set(job_id)
+    trace_provider_var.set(kind if kind in POST_PREPARERS else None)
+    if deadline_at is not None:
+        job_deadline_var.set(time.monotonic() + deadline_at - started)
+    if CHECKPOINTS_ENABLED and kind in POST_PIPELINES:
+        start_checkpoint(job_id, kind)
+        checkpoint_job_var.set(job_id)
+    return kind, started
+
+def finish_job(job_id, kind, started, result=None, error=None):
+    """
+    Record a job's outcome: its status from the result, or 'timed_out'/'failed' from the error it raised.
+    """
+    if isinstance(error, DeadlineExceeded):
+        print(f"Job {job_id} timed out: {error}")
+        update_job(job_id, status='timed_out', error=str(error), finished_at=time.time())
+        record_job_metrics(kind, 'timed_out', time.time() - started)
+        return
+    if error is not None:
+        print(f"Job {job_id} failed: {error}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        update_job(job_id, status='failed', error=str(error), finished_at=time.time())
+        record_job_metrics(kind, 'failed', time.time() - started)
+        return
+    status = job_status_for_result(result)
+    error = {
+        'succeeded': None,
+        'timed_out': "Job deadline exceeded before anything published, see result",
+    }.get(status, "One or more publish targets or batch items failed, see result")
+    update_job(job_id, status=status, result=result, error=error, finished_at=time.time())
+    if status == 'succeeded' and checkpoint_job_var.get():
+        finish_checkpoint(job_id)
+    record_job_metrics(kind, status, time.time() - started)
+    print(f"Job {job_id} {status}")
+
+def job_status_for_result(result):
+    """
+    Derive a finished job's status from its per-target publish results, or from its items for a batch:
+    'succeeded' when everything published, 'partial' when some did, and when none did
+    'timed_out' if something ran out of deadline, 'failed' otherwise.
+    """
+    if not isinstance(result, dict):
+        return 'succeeded'
+    if 'items' in result:
+        outcomes = [item['status'] for item in result['items']]
+        succeeded = sum(1 for status in outcomes if status in ('succeeded', 'partial'))
+        if outcomes and all(status == 'succeeded' for status in outcomes):
+            return 'succeeded'
+        if succeeded:
+            return 'partial'
+        return 'timed_out' if 'timed_out' in outcomes else 'failed'
+    publish = result.get('publish')
+    if not publish:
+        return 'succeeded'
+    published = sum(1 for target in publish.values() if target['status'] == 'published')
+    if published == len(publish):
+        return 'succeeded'
+    if published:
+        return 'partial'
+    return 'timed_out' if any(target['status'] == 'timed_out' for target in publish.values()) else 'failed'
+
+def update_job(job_id, **fields):
+    """
+    Update fields of a job record.
+    """
+    with jobs_lock:
+        jobs[job_id].update(fields)
+
+def get_job(job_id):
+    """
+    Return a copy of a job record, or None if it is unknown or already pruned.
+    """
+    with jobs_lock:
+        job = jobs.get(job_id)
+        return dict(job, spans=list(job['spans'])) if job else None
+
+def prune_finished_jobs():
+    """
+    Drop finished jobs older than JOB_RETENTION_SECONDS. Caller must hold jobs_lock.
+    """
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    expired = [job_id for job_id, job in jobs.items() if job['finished_at'] and job['finished_at'] < cutoff]
+    for job_id in expired:
+        del jobs[job_id]
+
+# --- Lazy Imports ---
+
+lazy_modules = {}
+import_timings = {}  # module name -> seconds its first import took
+lazy_modules_lock = threading.Lock()
+
+def lazy_import(module_name):
+    """
+    Import a module on first use, recording how long the import took for the startup report.
+    """
+    module = lazy_modules.get(module_name)
+    if module is not None:
+        return module
+    with lazy_modules_lock:
+        module = lazy_modules.get(module_name)
+        if module is None:
+            already_loaded = module_name in sys.modules
+            started = time.perf_counter()
+            module = importlib.import_module(module_name)
+            if not already_loaded:
+                import_timings[module_name] = time.perf_counter() - started
+            lazy_modules[module_name] = module
+        return module
+
+def startup_report():
+    """
+    Where startup time went: loading main.py itself, first imports of provider modules
+    and construction of shared clients.
+    """
+    return {
+        "module_load_seconds": MODULE_LOAD_SECONDS,
+        "lazy_imports": dict(import_timings),
+        "client_init": dict(client_init_timings),
+    }
+
+# --- Content Buffer ---
+# One producer thread per provider in CONTENT_BUFFER_PROVIDERS keeps up to CONTENT_BUFFER_TARGET
+# prepared posts ready. When the depth falls to CONTENT_BUFFER_LOW_WATERMARK it refills back
+# to the target, so publishing does not wait on generation or captioning.
+# Producers prepare on buffer_executor, CONTENT_BUFFER_CONCURRENCY threads of their own, so
+# publishing a buffered post never queues behind a refill on job_executor. Their provider's
+# PROVIDER_CONCURRENCY limit still applies. Expired posts' images are deleted.
+
+content_buffers = {provider: deque() for provider in POST_PREPARERS}
+content_buffer_stats = {provider: {'produced': 0, 'served': 0, 'expired': 0, 'failed': 0, 'misses': 0} for provider in content_buffers}
+content_buffer_refilling = {provider: False for provider in content_buffers}
+content_buffer_condition = threading.Condition()
+buffer_executor = ThreadPoolExecutor(max_workers=CONTENT_BUFFER_CONCURRENCY, thread_name_prefix='content-buffer')
+
+def start_content_buffer():
+    """
+    Start a producer thread for each provider in CONTENT_BUFFER_PROVIDERS.
+    """
+    for provider in CONTENT_BUFFER_PROVIDERS:
+        if provider not in content_buffers:
+            print(f"Ignoring unknown content buffer provider: {provider}")
+            continue
+        threading.Thread(target=refill_content_buffer_forever, args=(provider,), name=f'content-buffer-{provider}', daemon=True).start()
+        print(f"Started content buffer producer for {provider}")
+
+def refill_content_buffer_forever(provider):
+    """
+    Producer thread: prepare posts whenever the buffer is between the low watermark and the target.
+    """
+    buffer = content_buffers[provider]
+    with content_buffer_condition:
+        content_buffer_refilling[provider] = True  # fill up to the target on start
+    while True:
+        with content_buffer_condition:
+            while True:
+                drop_expired_posts(provider)
+                if len(buffer) >= CONTENT_BUFFER_TARGET:
+                    content_buffer_refilling[provider] = False
+                elif len(buffer) <= CONTENT_BUFFER_LOW_WATERMARK:
+                    content_buffer_refilling[provider] = True
+                if content_buffer_refilling[provider]:
+                    break
+                # Wake on takes, and periodically to expire stale posts
+                content_buffer_condition.wait(timeout=CONTENT_BUFFER_TTL_SECONDS / 10)
+
+        try:
+            # Other providers fill their own buffers
+            prepared = submit_traced(buffer_executor, prepare_post, provider, False).result()
+        except Exception as e:
+            print(f"Content buffer failed to prepare a {provider} post: {e}")
+            with content_buffer_condition:
+                content_buffer_stats[provider]['failed'] += 1
+            time.sleep(CONTENT_BUFFER_RETRY_SECONDS)
+            continue
+
+        with content_buffer_condition:
+            buffer.append(prepared)
+            content_buffer_stats[provider]['produced'] += 1
+            print(f"Content buffer for {provider} now holds {len(buffer)} posts")
+
+def take_buffered_post(provider):
+    """
+    Pop the oldest fresh prepared post for a provider, or return None if its buffer is empty.
+    """
+    with content_buffer_condition:
+        drop_expired_posts(provider)
+        buffer = content_buffers[provider]
+        if not buffer:
+            content_buffer_stats[provider]['misses'] += 1
+            return None
+        prepared = buffer.popleft()
+        content_buffer_stats[provider]['served'] += 1
+        content_buffer_condition.notify_all()
+        return prepared
+
+def return_buffered_post(prepared):
+    """
+    Put a taken post back at the front of its buffer, e.g. when its publish job could not be queued.
+    """
+    with content_buffer_condition:
+        content_buffers[prepared['provider']].appendleft(prepared)
+        content_buffer_stats[prepared['provider']]['served'] -= 1
+
+def drop_expired_posts(provider):
+    """
+    Drop prepared posts older than CONTENT_BUFFER_TTL_SECONDS and delete their images in the background.
+    Caller must hold content_buffer_condition.
+    """
+    buffer = content_buffers[provider]
+    cutoff = time.time() - CONTENT_BUFFER_TTL_SECONDS
+    expired = []
+    while buffer and buffer[0]['prepared_at'] < cutoff:
+        expired.append(buffer.popleft())
+        content_buffer_stats[provider]['expired'] += 1
+    if expired:
+        threading.Thread(target=delete_expired_images, args=(expired,), name=f'content-buffer-expire-{provider}', daemon=True).start()
+
+def delete_expired_images(posts):
+    """
+    Delete the uploaded images of expired prepared posts from GCS.
+    """
+    for prepared in posts:
+        try:
+            delete_from_bucket(prepared['image_url'], GCS_BUCKET_NAME)
+            print(f"Deleted expired {prepared['provider']} post image: {prepared['image_url']}")
+        except Exception as e:
+            print(f"Failed to delete expired post image {prepared['image_url']}: {e}")
+
+def deepest_content_buffer():
+    """
+    Return the provider with the most fresh prepared posts, or None if every buffer is empty.
+    """
+    with content_buffer_condition:
+        for provider in content_buffers:
+            drop_expired_posts(provider)
+        provider = max(content_buffers, key=lambda p: len(content_buffers[p]))
+        return provider if content_buffers[provider] else None
+
+def content_buffer_report():
+    """
+    Depth, oldest item age, refill state and counters for each provider's buffer.
+    """
+    now = time.time()
+    with content_buffer_condition:
+        return {
+            "enabled_providers": CONTENT_BUFFER_PROVIDERS,
+            "target": CONTENT_BUFFER_TARGET,
+            "low_watermark": CONTENT_BUFFER_LOW_WATERMARK,
+            "ttl_seconds": CONTENT_BUFFER_TTL_SECONDS,
+            "buffers": {
+                provider: {
+                    "depth": len(buffer),
+                    "oldest_age_seconds": round(now - buffer[0]['prepared_at'], 1) if buffer else None,
+                    "refilling": content_buffer_refilling[provider],
+                    **content_buffer_stats[provider],
+                }
+                for provider, buffer in content_buffers.items()
+            },
+        }
+
+# --- Provider Health ---
+# A token bucket per provider keeps generation calls under PROVIDER_RATE_LIMITS, and a circuit
+# breaker stops calling a provider after BREAKER_FAILURE_THRESHOLD consecutive failures.
+# An open breaker lets a single trial call through (half-open) after BREAKER_COOLDOWN_SECONDS;
+# its success closes the breaker and its failure re-opens it. A call that has not returned after
+# PROVIDER_CALL_TIMEOUT_SECONDS is abandoned and counts as a failure, so a hanging provider opens
+# its breaker like a failing one.
+
+class ProviderUnavailable(Exception):
+    """
+    A provider's breaker is open, its rate limit is saturated, its generation call failed or
+    its image was filtered as NSFW.
+    prepare_post falls back to another provider on this error.
+    """
+
+provider_health = {
+    provider: {
+        'tokens': float(PROVIDER_RATE_BURST), 'refilled_at': time.monotonic(),
+        'state': 'closed', 'consecutive_failures': 0, 'opened_at': None, 'trial_in_flight': False,
+        'calls': 0, 'failures': 0, 'rejected_open': 0, 'rejected_saturated': 0, 'throttle_wait_seconds': 0.0,
+        'abandoned_running': 0, 'abandoned': 0, 'rejected_abandoned': 0,
+    }
+    for provider in POST_PREPARERS
+}
+provider_health_lock = threading.Lock()
+
+def provider_rate_per_second(provider):
+    return PROVIDER_RATE_LIMITS.get(provider, PROVIDER_RATE_PER_MINUTE) / 60
+
+def provider_available(provider):
+    """
+    True unless the provider's breaker is open and still cooling down, or its trial call is in flight.
+    """
+    with provider_health_lock:
+        health = provider_health[provider]
+        if health['state'] == 'open':
+            return time.monotonic() - health['opened_at'] >= BREAKER_COOLDOWN_SECONDS
+        return not (health['state'] == 'half_open' and health['trial_in_flight'])
+
+def call_provider(provider, fn, *args, rate_limited=True, **kwargs):
+    """
+    Call a provider's generation function through its circuit breaker and rate limiter,
+    within PROVIDER_CALL_TIMEOUT_SECONDS and the current job's deadline.
+    rate_limited=False skips the rate limit token, for calls that are part of a post already charged one.
+    Raises ProviderUnavailable when the call is not allowed, fails or times out, DeadlineExceeded
+    when it overruns the job's deadline.
+    """
+    reserve_provider_call(provider, rate_limited)
+    try:
+        result = run_within_budget(provider, fn, *args, **kwargs)
+    except Exception as e:
+        raise provider_call_failed(provider, e)
+    record_provider_result(provider, True)
+    increment_counter('instabot_provider_calls_total', provider=provider, outcome='ok')
+    return result
+
+def reserve_provider_call(provider, rate_limited=True):
+    """
+    Let one call through the provider's breaker and take a rate limit token for it, unless rate_limited is False.
+    Raises ProviderUnavailable when the breaker is open, the rate limit is saturated or
+    PROVIDER_ABANDONED_CALLS_MAX of the provider's timed-out calls are still running.
+    """
+    with provider_health_lock:
+        abandoned_running = provider_health[provider]['abandoned_running']
+        if abandoned_running >= PROVIDER_ABANDONED_CALLS_MAX:
+            provider_health[provider]['rejected_abandoned'] += 1
+    if abandoned_running >= PROVIDER_ABANDONED_CALLS_MAX:
+        # They still hold provider_call_executor threads; more would starve other providers' calls
+        increment_counter('instabot_provider_calls_total', provider=provider, outcome='rejected_abandoned')
+        raise ProviderUnavailable(f"{abandoned_running} timed-out {provider} calls are still running")
+    try:
+        admit_provider_call(provider)
+    except ProviderUnavailable:
+        increment_counter('instabot_provider_calls_total', provider=provider, outcome='rejected_open')
+        raise
+    if not rate_limited:
+        return
+    try:
+        take_rate_token(provider)
+    except (ProviderUnavailable, DeadlineExceeded) as e:
+        with provider_health_lock:
+            provider_health[provider]['trial_in_flight'] = False
+        if isinstance(e, ProviderUnavailable):
+            increment_counter('instabot_provider_calls_total', provider=provider, outcome='rejected_saturated')
+        raise
+
+def provider_call_failed(provider, error):
+    """
+    Record a failed provider call and return the exception to raise: DeadlineExceeded as is,
+    anything else as ProviderUnavailable so prepare_post falls back.
+    """
+    if isinstance(error, DeadlineExceeded):
+        # Out of job budget says nothing about the provider's health
+        with provider_health_lock:
+            provider_health[provider]['trial_in_flight'] = False
+        increment_counter('instabot_provider_calls_total', provider=provider, outcome='timed_out')
+        return error
+    record_provider_result(provider, False)
+    increment_counter('instabot_provider_calls_total', provider=provider, outcome='failed')
+    unavailable = ProviderUnavailable(f"{provider} call failed: {error}")
+    unavailable.__cause__ = error
+    return unavailable
+
+def admit_provider_call(provider):
+    """
+    Let a call through the breaker, moving an open breaker whose cooldown has passed to half-open.
+    """
+    with provider_health_lock:
+        health = provider_health[provider]
+        if health['state'] == 'open' and time.monotonic() - health['opened_at'] >= BREAKER_COOLDOWN_SECONDS:
+            health['state'] = 'half_open'
+            print(f"Circuit for {provider} half-open: allowing a trial call")
+        if health['state'] == 'open' or (health['state'] == 'half_open' and health['trial_in_flight']):
+            health['rejected_open'] += 1
+            raise ProviderUnavailable(f"circuit for {provider} is {health['state']}")
+        if health['state'] == 'half_open':
+            health['trial_in_flight'] = True
+        health['calls'] += 1
+
+def take_rate_token(provider):
+    """
+    Take one token from the provider's bucket, sleeping until one refills.
+    Raises ProviderUnavailable if that would take longer than PROVIDER_RATE_MAX_WAIT_SECONDS.
+    """
+    rate = provider_rate_per_second(provider)
+    max_wait = budget_timeout(PROVIDER_RATE_MAX_WAIT_SECONDS, 'rate limit wait')
+    waited = 0.0
+    while True:
+        with provider_health_lock:
+            health = provider_health[provider]
+            now = time.monotonic()
+            health['tokens'] = min(PROVIDER_RATE_BURST, health['tokens'] + (now - health['refilled_at']) * rate)
+            health['refilled_at'] = now
+            if health['tokens'] >= 1:
+                health['tokens'] -= 1
+                health['throttle_wait_seconds'] += waited
+                return
+            delay = (1 - health['tokens']) / rate if rate > 0 else float('inf')
+            if waited + delay > max_wait:
+                health['rejected_saturated'] += 1
+                raise ProviderUnavailable(f"rate limit for {provider} saturated ({delay:.1f}s until the next call)")
+        time.sleep(delay)
+        waited += delay
+
+def record_provider_result(provider, succeeded):
+    """
+    Update the provider's breaker after a call: close it on success, open it on too many failures.
+    """
+    with provider_health_lock:
+        health = provider_health[provider]
+        health['trial_in_flight'] = False
+        if succeeded:
+            if health['state'] != 'closed':
+                print(f"Circuit for {provider} closed")
+            health['state'] = 'closed'
+            health['consecutive_failures'] = 0
+            return
+        health['failures'] += 1
+        health['consecutive_failures'] += 1
+        if health['state'] == 'half_open' or health['consecutive_failures'] >= BREAKER_FAILURE_THRESHOLD:
+            if health['state'] != 'open':
+                print(f"Circuit for {provider} opened after {health['consecutive_failures']} consecutive failures")
+            health['state'] = 'open'
+            health['opened_at'] = time.monotonic()
+
+def provider_health_report():
+    """
+    Breaker state, rate limiter tokens, counters and recent prepare latency for each provider.
+    """
+    now = time.monotonic()
+    latency = {provider: prepare_latency_stats(provider) for provider in provider_health}
+    with provider_health_lock:
+        return {
+            "fallback_order": PROVIDER_FALLBACK_ORDER,
+            "failure_threshold": BREAKER_FAILURE_THRESHOLD,
+            "cooldown_seconds": BREAKER_COOLDOWN_SECONDS,
+            "call_threads": PROVIDER_CALL_THREADS,
+            "abandoned_calls_max": PROVIDER_ABANDONED_CALLS_MAX,
+            "providers": {
+                provider: {
+                    "state": health['state'],
+                    "consecutive_failures": health['consecutive_failures'],
+                    "open_for_seconds": round(now - health['opened_at'], 1) if health['state'] != 'closed' else None,
+                    "rate_per_minute": PROVIDER_RATE_LIMITS.get(provider, PROVIDER_RATE_PER_MINUTE),
+                    "tokens": round(min(PROVIDER_RATE_BURST, health['tokens'] + (now - health['refilled_at']) * provider_rate_per_second(provider)), 2),
+                    "calls": health['calls'],
+                    "failures": health['failures'],
+                    "rejected_open": health['rejected_open'],
+                    "rejected_saturated": health['rejected_saturated'],
+                    "throttle_wait_seconds": round(health['throttle_wait_seconds'], 1),
+                    "abandoned_running": health['abandoned_running'],
+                    "abandoned": health['abandoned'],
+                    "rejected_abandoned": health['rejected_abandoned'],
+                    "prepare": latency[provider],
+                }
+                for provider, health in provider_health.items()
+            },
+        }
+
+# --- Provider Routing ---
+# prepare_post records how long each provider's prepare step took and whether it succeeded,
+# over a rolling window of AUTO_POST_WINDOW samples; any error counts as a failed sample.
+# /auto_post ranks providers by expected prepare time: p50 blended with p95 by
+# AUTO_POST_TAIL_WEIGHT, so a provider with a long tail ranks below one with a steady time,
+# divided by success rate, i.e. including the cost of retrying a failure.
+
+prepare_samples = {provider: deque(maxlen=AUTO_POST_WINDOW) for provider in POST_PREPARERS}
+prepare_samples_lock = threading.Lock()
+routing_rng = random.Random()
+
+def record_prepare_sample(provider, seconds, succeeded):
+    with prepare_samples_lock:
+        prepare_samples[provider].append((seconds, succeeded))
+
+def prepare_latency_stats(provider):
+    """
+    p50/p95 of successful prepares, success rate and sample count over the rolling window.
+    """
+    with prepare_samples_lock:
+        samples = list(prepare_samples[provider])
+    durations = [seconds for seconds, succeeded in samples if succeeded]
+    return {
+        "samples": len(samples),
+        "success_rate": round(len(durations) / len(samples), 3) if samples else None,
+        "p50_seconds": round(percentile(durations, 50), 2) if durations else None,
+        "p95_seconds": round(percentile(durations, 95), 2) if durations else None,
+    }
+
+def choose_auto_post_provider():
+    """
+    Pick the provider for the next auto post, or None if every configured provider's circuit is open.
+
+    Returns:
+        dict: provider, reason ('buffered', 'warming', 'explore' or 'fastest') and the expected seconds per provider
+    """
+    healthy = [provider for provider in AUTO_POST_PROVIDERS if provider in POST_PREPARERS and provider_available(provider)]
+    if not healthy:
+        return None
+    expected = {}
+    for provider in healthy:
+        stats = prepare_latency_stats(provider)
+        if stats['p50_seconds'] is not None:
+            typical = (1 - AUTO_POST_TAIL_WEIGHT) * stats['p50_seconds'] + AUTO_POST_TAIL_WEIGHT * stats['p95_seconds']
+            expected[provider] = round(typical / stats['success_rate'], 2)
+
+    with content_buffer_condition:
+        buffered = [provider for provider in healthy if content_buffers[provider]]
+    if buffered:
+        return {"provider": max(buffered, key=lambda p: len(content_buffers[p])), "reason": "buffered", "expected_seconds": expected}
+    warming = [provider for provider in healthy if prepare_latency_stats(provider)['samples'] < AUTO_POST_MIN_SAMPLES]
+    if warming:
+        return {"provider": routing_rng.choice(warming), "reason": "warming", "expected_seconds": expected}
+    if routing_rng.random() < AUTO_POST_EXPLORATION:
+        return {"provider": routing_rng.choice(healthy), "reason": "explore", "expected_seconds": expected}
+    # A provider whose recent prepares all failed has no p50; rank it last
+    provider = min(healthy, key=lambda p: expected.get(p, float('inf')))
+    return {"provider": provider, "reason": "fastest", "expected_seconds": expected}
+
+# --- Deadlines ---
+# Every job gets a deadline when it is queued (JOB_DEADLINE_SECONDS, BATCH_JOB_DEADLINE_SECONDS
+# for batches), carried in a context variable like the trace id. Each stage draws its timeouts from
+# what is left: stage_span refuses to start a stage past the deadline, HTTP requests, container
+# waits, caption requests and rate limit waits are capped at the remaining budget, and provider SDK
+# calls get it as their own timeout and are abandoned by call_provider when they overrun it.
+# A job that runs out of budget ends as 'timed_out', and its checkpoint can be resumed.
+
+class DeadlineExceeded(Exception):
+    """
+    The current job ran out of its deadline budget.
+    """
+
+job_deadline_var = contextvars.ContextVar('job_deadline', default=None)  # time.monotonic() deadline of the current job
+# Two calls per prepare slot (a DALL-E post's chat and image calls) plus each provider's abandoned calls,
+# so a provider that hangs cannot take the threads other providers' calls need
+PROVIDER_CALL_THREADS = sum(2 * provider_concurrency(p) + PROVIDER_ABANDONED_CALLS_MAX for p in POST_PREPARERS)
+provider_call_executor = ThreadPoolExecutor(max_workers=PROVIDER_CALL_THREADS, thread_name_prefix='provider-call')
+
+def remaining_budget():
+    """
+    Seconds left before the current job's deadline, or None outside a job with a deadline.
+    """
+    deadline = job_deadline_var.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def check_deadline(stage):
+    remaining = remaining_budget()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded(f"Job deadline exceeded before {stage}")
+
+def budget_timeout(seconds, stage):
+    """
+    Cap a timeout (None = no limit of its own) at the current job's remaining budget.
+    Raises DeadlineExceeded when no budget is left.
+    """
+    check_deadline(stage)
+    remaining = remaining_budget()
+    if remaining is None:
+        return seconds
+    return remaining if seconds is None else min(seconds, remaining)
+
+def openai_request_options(seconds=None):
+    """
+    Per-request options for OpenAI SDK calls: the remaining budget as timeout, capped at
+    seconds when given, if either applies.
+    """
+    timeout = budget_limit(seconds)
+    return {} if timeout is None else {'timeout': max(timeout, 0.1)}
+
+def genai_http_options(seconds=None):
+    """
+    HttpOptions for Gemini SDK calls with the remaining budget as timeout, capped at seconds
+    when given, or None when neither applies.
+    """
+    timeout = budget_limit(seconds)
+    if timeout is None:
+        return None
+    return lazy_import('google.genai.types').HttpOptions(timeout=max(int(timeout * 1000), 100))
+
+def budget_limit(seconds=None):
+    """
+    The smaller of seconds and the remaining budget, ignoring whichever is None.
+    Unlike budget_timeout it never raises; the SDK call fails on its own timeout instead.
+    """
+    remaining = remaining_budget()
+    if remaining is None:
+        return seconds
+    return remaining if seconds is None else min(seconds, remaining)
+
+def run_within_budget(provider, fn, *args, **kwargs):
+    """
+    Call fn, giving up with TimeoutError if it has not returned after PROVIDER_CALL_TIMEOUT_SECONDS,
+    or with DeadlineExceeded if the job's budget runs out first.
+    A running call cannot be interrupted, so it is left to finish on provider_call_executor and its
+    result is discarded; it counts towards the provider's abandoned calls until it returns.
+    """
+    call_timeout = PROVIDER_CALL_TIMEOUT_SECONDS or None
+    timeout = budget_timeout(call_timeout, 'provider call')
+    if timeout is None:
+        return fn(*args, **kwargs)
+    future = submit_traced(provider_call_executor, lambda: fn(*args, **kwargs))
+    try:
+        return future.result(timeout=timeout)
+    except FuturesTimeoutError:
+        if not future.cancel():
+            abandon_provider_call(provider, future)
+        name = getattr(fn, '__name__', 'provider call')
+        if call_timeout is None or timeout < call_timeout:
+            raise DeadlineExceeded(f"Job deadline exceeded during {name}") from None
+        raise TimeoutError(f"{name} did not return within {call_timeout:g}s") from None
+
+def abandon_provider_call(provider, future):
+    """
+    Count a timed-out call that is still running against its provider until it returns.
+    """
+    with provider_health_lock:
+        provider_health[provider]['abandoned_running'] += 1
+        provider_health[provider]['abandoned'] += 1
+    future.add_done_callback(lambda _: release_abandoned_call(provider))
+
+def release_abandoned_call(provider):
+    with provider_health_lock:
+        provider_health[provider]['abandoned_running'] -= 1
+
+# --- Metrics ---
+# Hand-rolled Prometheus counters and histograms, rendered by /metrics. Each job carries a trace id
+# (its job id) in a context variable that submit_traced copies into worker threads, so every
+# stage_span is logged with the job it belongs to and added to the job's 'spans'.
+
+trace_id_var = contextvars.ContextVar('trace_id', default=None)
+trace_provider_var = contextvars.ContextVar('trace_provider', default=None)
+trace_spans_var = contextvars.ContextVar('trace_spans', default=None)
+
+metrics_counters = {}    # (name, labels) -> value
+metrics_histograms = {}  # (name, labels) -> {'buckets': [count per METRICS_BUCKETS bound], 'sum': float, 'count': int}
+metrics_lock = threading.Lock()
+
+METRICS_HELP = {
+    'instabot_stage_duration_seconds': ('histogram', 'Duration of each pipeline stage by provider and publish target.'),
+    'instabot_stage_total': ('counter', 'Pipeline stages run, by provider, publish target and outcome.'),
+    'instabot_provider_calls_total': ('counter', 'Provider generation calls by outcome.'),
+    'instabot_job_duration_seconds': ('histogram', 'Run time of finished jobs by kind.'),
+    'instabot_jobs_total': ('counter', 'Finished jobs by kind and status.'),
+    'instabot_jobs_active': ('gauge', 'Jobs queued or running.'),
+    'instabot_content_buffer_depth': ('gauge', 'Prepared posts waiting in each content buffer.'),
+    'instabot_circuit_open': ('gauge', '1 when a provider circuit is open or half-open.'),
+    'instabot_caption_requests_total': ('counter', 'Caption requests by provider and outcome (won, failed, cancelled).'),
+    'instabot_caption_hedges_total': ('counter', 'Hedged caption requests, by the provider asked second.'),
+}
+
+def submit_traced(executor, fn, *args):
+    """
+    Submit fn to an executor so it runs with a copy of the caller's trace context.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+@contextmanager
+def stage_span(stage, target=''):
+    """
+    Time a pipeline stage for the current provider and job, recording it in /metrics and the job's spans.
+    Raises DeadlineExceeded instead of starting the stage when the job's deadline has passed.
+    """
+    provider = trace_provider_var.get() or ''
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        check_deadline(stage)
+        yield
+        outcome = 'ok'
+    except DeadlineExceeded:
+        outcome = 'timed_out'
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        observe_histogram('instabot_stage_duration_seconds', seconds, stage=stage, provider=provider, target=target)
+        increment_counter('instabot_stage_total', stage=stage, provider=provider, target=target, outcome=outcome)
+        spans = trace_spans_var.get()
+        if spans is not None:
+            spans.append({'stage': stage, 'provider': provider, 'target': target, 'outcome': outcome, 'seconds': round(seconds, 3)})
+        label = ' '.join(part for part in (stage, provider, target) if part)
+        print(f"[trace {trace_id_var.get() or '-'}] {label}: {outcome} in {seconds:.3f}s")
+
+def increment_counter(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics_counters[key] = metrics_counters.get(key, 0) + amount
+
+def observe_histogram(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metrics_histograms.setdefault(key, {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0})
+        for index, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def record_job_metrics(kind, status, seconds):
+    increment_counter('instabot_jobs_total', kind=kind, status=status)
+    observe_histogram('instabot_job_duration_seconds', seconds, kind=kind)
+
+def format_labels(labels):
+    """
+    Format (name, value) pairs as a Prometheus label set, escaping backslashes, quotes and newlines.
+    """
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+def render_metrics():
+    """
+    Render all metrics in the Prometheus text exposition format.
+    """
+    with jobs_lock:
+        active = sum(1 for job in jobs.values() if job['status'] in ('queued', 'running'))
+    with content_buffer_condition:
+        depths = {provider: len(buffer) for provider, buffer in content_buffers.items()}
+    with provider_health_lock:
+        circuits = {provider: int(health['state'] != 'closed') for provider, health in provider_health.items()}
+    gauges = {('instabot_jobs_active', ()): active}
+    gauges.update({('instabot_content_buffer_depth', (('provider', provider),)): depth for provider, depth in depths.items()})
+    gauges.update({('instabot_circuit_open', (('provider', provider),)): state for provider, state in circuits.items()})
+
+    with metrics_lock:
+        counters = dict(metrics_counters)
+        histograms = {key: dict(histogram, buckets=list(histogram['buckets'])) for key, histogram in metrics_histograms.items()}
+
+    lines = []
+    for name, (kind, help_text) in METRICS_HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'histogram':
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(METRICS_BUCKETS, histogram['buckets']):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        else:
+            values = counters if kind == 'counter' else gauges
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+# --- State Store ---
+# One SQLite connection shared by all threads, serialized by state_db_lock.
+# Features add their tables to STATE_DB_SCHEMA.
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS prompt_combinations (
+    provider TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    style TEXT NOT NULL,
+    used_at REAL NOT NULL,
+    PRIMARY KEY (provider, subject, style)
+);
+CREATE TABLE IF NOT EXISTS published_images (
+    phash INTEGER NOT NULL,
+    provider TEXT NOT NULL,
+    image_url TEXT NOT NULL,
+    published_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    prepared TEXT,
+    targets TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at ON idempotency_keys (expires_at);
+CREATE TABLE IF NOT EXISTS prompt_attempts (
+    id INTEGER PRIMARY KEY,
+    provider TEXT NOT NULL,
+    strategy TEXT NOT NULL,
+    generated INTEGER NOT NULL,
+    nsfw INTEGER NOT NULL,
+    published INTEGER NOT NULL,
+    generation_seconds REAL,
+    e2e_seconds REAL,
+    attempted_at REAL NOT NULL
+);
+"""
+
+state_db = None
+state_db_lock = threading.RLock()
+
+def get_state_db():
+    """
+    Return the shared SQLite connection, opening it and creating the schema on first use.
+    The connection is in autocommit mode; use `with state_db_lock:` around every use.
+    """
+    global state_db
+    with state_db_lock:
+        if state_db is None:
+            state_db = sqlite3.connect(STATE_DB_PATH, check_same_thread=False, isolation_level=None)
+            state_db.execute("PRAGMA journal_mode=WAL")
+            state_db.executescript(STATE_DB_SCHEMA)
+        return state_db
+
+# --- Dedup Index ---
+# Remembers the (subject, style) combinations already used per provider and the perceptual
+# hashes of published images. Selectors draw unused combinations, and generated images within
+# DEDUP_HAMMING_THRESHOLD bits of a published one are rejected before upload.
+
+used_combinations = None   # {(provider, subject, style)}, loaded on first use
+published_hashes = None    # numpy uint64 array of published pHashes, loaded on first use
+published_image_urls = []  # image URL for each entry of published_hashes
+dct_matrix = None          # 32x32 DCT-II basis for image_phash
+
+def load_dedup_index():
+    """
+    Load used combinations and published hashes from the state store. Caller must hold state_db_lock.
+    """
+    global used_combinations, published_hashes
+    if used_combinations is not None:
+        return
+    np = lazy_import('numpy')
+    db = get_state_db()
+    used_combinations = set(db.execute("SELECT provider, subject, style FROM prompt_combinations"))
+    rows = db.execute("SELECT phash, image_url FROM published_images ORDER BY published_at").fetchall()
+    published_hashes = np.array([phash for phash, _ in rows], dtype=np.int64).view(np.uint64)
+    published_image_urls.extend(url for _, url in rows)
+
+def pick_fresh_combination(provider, subjects, styles):
+    """
+    Draw a (subject, style) pair this provider has not used yet and reserve it.
+    After DEDUP_PICK_ATTEMPTS used draws the last draw is accepted anyway.
+
+    Returns:
+        tuple: (subject, style, reservation), where reservation is passed to release_combination
+        if the generation fails, or None when nothing new was reserved
+    """
+    if not DEDUP_ENABLED:
+        return random.choice(subjects), random.choice(styles), None
+    with state_db_lock:
+        load_dedup_index()
+        for _ in range(DEDUP_PICK_ATTEMPTS):
+            subject, style = random.choice(subjects), random.choice(styles)
+            if (provider, subject, style) not in used_combinations:
+                reservation = (provider, subject, style)
+                break
+        else:
+            print(f"No unused {provider} combination after {DEDUP_PICK_ATTEMPTS} draws, reusing one.")
+            reservation = None
+        used_combinations.add((provider, subject, style))
+        get_state_db().execute(
+            "INSERT OR REPLACE INTO prompt_combinations (provider, subject, style, used_at) VALUES (?, ?, ?, ?)",
+            (provider, subject, style, time.time()))
+    return subject, style, reservation
+
+def release_combination(reservation):
+    """
+    Make a combination reserved by pick_fresh_combination available again, after a failed
+    or NSFW-filtered generation.
+    """
+    if reservation is None:
+        return
+    with state_db_lock:
+        load_dedup_index()
+        used_combinations.discard(reservation)
+        get_state_db().execute("DELETE FROM prompt_combinations WHERE provider = ? AND subject = ? AND style = ?", reservation)
+    print(f"Released {reservation[0]} combination {reservation[1]!r} / {reservation[2]!r}")
+
+def image_phash(image_bytes):
+    """
+    64-bit perceptual hash: the signs of the 8x8 lowest frequencies of the 32x32 grayscale DCT,
+    relative to their median.
+    """
+    global dct_matrix
+    np = lazy_import('numpy')
+    Image = lazy_import('PIL.Image')
+    if dct_matrix is None:
+        k = np.arange(32)
+        dct_matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / 64)
+    with Image.open(BytesIO(image_bytes)) as img:
+        pixels = np.asarray(img.convert('L').resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (dct_matrix @ pixels @ dct_matrix.T)[:8, :8].flatten()
+    bits = low > np.median(low[1:])  # the DC term would dominate the median
+    return int(np.packbits(bits).view('>u8')[0])
+
+def find_near_duplicate(phash):
+    """
+    Return the closest published image within DEDUP_HAMMING_THRESHOLD bits as
+    {'distance', 'image_url'}, or None.
+    """
+    np = lazy_import('numpy')
+    with state_db_lock:
+        load_dedup_index()
+        if not len(published_hashes):
+            return None
+        xor = np.bitwise_xor(published_hashes, np.uint64(phash))
+        distances = np.bitwise_count(xor) if hasattr(np, 'bitwise_count') else np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+        index = int(np.argmin(distances))
+        if distances[index] > DEDUP_HAMMING_THRESHOLD:
+            return None
+        return {'distance': int(distances[index]), 'image_url': published_image_urls[index]}
+
+def record_published_image(phash, provider, image_url):
+    """
+    Add a published image's hash to the index.
+    """
+    global published_hashes
+    np = lazy_import('numpy')
+    with state_db_lock:
+        load_dedup_index()
+        published_hashes = np.append(published_hashes, np.uint64(phash))
+        published_image_urls.append(image_url)
+        signed = phash - (1 << 64) if phash >= (1 << 63) else phash  # SQLite integers are signed 64-bit
+        get_state_db().execute(
+            "INSERT INTO published_images (phash, provider, image_url, published_at) VALUES (?, ?, ?, ?)",
+            (signed, provider, image_url, time.time()))
+
+def dedup_report():
+    """
+    Size of the dedup index.
+    """
+    with state_db_lock:
+        load_dedup_index()
+        return {
+            "enabled": DEDUP_ENABLED,
+            "hamming_threshold": DEDUP_HAMMING_THRESHOLD,
+            "used_combinations": len(used_combinations),
+            "published_images": len(published_hashes),
+        }
+
+# --- Prompt Performance ---
+# Every generation attempt is a row in prompt_attempts. prompt_performance holds the running
+# totals per provider and prompt strategy plus the latencies of the last PROMPT_PERFORMANCE_WINDOW
+# attempts, loaded from the state store on first use, so /prompt_performance never scans the table.
+
+prompt_performance = None  # provider -> strategy -> stats, see new_prompt_stats
+
+def new_prompt_stats():
+    return {
+        'attempts': 0, 'successes': 0, 'nsfw': 0, 'published': 0,
+        'generation_seconds': deque(maxlen=PROMPT_PERFORMANCE_WINDOW),
+        'e2e_seconds': deque(maxlen=PROMPT_PERFORMANCE_WINDOW),
+    }
+
+def prompt_stats(provider, strategy):
+    return prompt_performance.setdefault(provider, {}).setdefault(strategy, new_prompt_stats())
+
+def load_prompt_performance():
+    """
+    Load totals and recent latencies from the state store. Caller must hold state_db_lock.
+    """
+    global prompt_performance
+    if prompt_performance is not None:
+        return
+    prompt_performance = {}
+    db = get_state_db()
+    totals = db.execute(
+        "SELECT provider, strategy, COUNT(*), SUM(generated AND NOT nsfw), SUM(nsfw), SUM(published) FROM prompt_attempts GROUP BY provider, strategy")
+    for provider, strategy, attempts, successes, nsfw, published in totals:
+        prompt_stats(provider, strategy).update(attempts=attempts, successes=successes, nsfw=nsfw, published=published)
+    recent = db.execute(
+        "SELECT provider, strategy, generation_seconds, e2e_seconds FROM ("
+        "  SELECT *, ROW_NUMBER() OVER (PARTITION BY provider, strategy ORDER BY id DESC) AS age FROM prompt_attempts"
+        ") WHERE age <= ? ORDER BY id", (PROMPT_PERFORMANCE_WINDOW,))
+    for provider, strategy, generation_seconds, e2e_seconds in recent:
+        stats = prompt_stats(provider, strategy)
+        if generation_seconds is not None:
+            stats['generation_seconds'].append(generation_seconds)
+        if e2e_seconds is not None:
+            stats['e2e_seconds'].append(e2e_seconds)
+
+def record_prompt_attempt(provider, strategy, generated, nsfw=False, generation_seconds=None):
+    """
+    Record one generation attempt. Returns its row id for record_prompt_published.
+    """
+    with state_db_lock:
+        load_prompt_performance()
+        stats = prompt_stats(provider, strategy)
+        stats['attempts'] += 1
+        stats['successes'] += int(generated and not nsfw)
+        stats['nsfw'] += int(nsfw)
+        if generation_seconds is not None:
+            stats['generation_seconds'].append(generation_seconds)
+        return get_state_db().execute(
+            "INSERT INTO prompt_attempts (provider, strategy, generated, nsfw, published, generation_seconds, attempted_at) VALUES (?, ?, ?, ?, 0, ?, ?)",
+            (provider, strategy, int(generated), int(nsfw), generation_seconds, time.time())).lastrowid
+
+def record_prompt_published(performance, e2e_seconds):
+    """
+    Mark an attempt from track_generation as published, with its end-to-end latency.
+    """
+    with state_db_lock:
+        load_prompt_performance()
+        stats = prompt_stats(performance['provider'], performance['strategy'])
+        stats['published'] += 1
+        stats['e2e_seconds'].append(e2e_seconds)
+        get_state_db().execute("UPDATE prompt_attempts SET published = 1, e2e_seconds = ? WHERE id = ?", (e2e_seconds, performance['id']))
+
+def track_generation(provider, strategy, generate, *args, reservation=None):
+    """
+    Run a provider's generation call through call_provider and record the attempt.
+    The prompt's combination reservation is released if the generation fails or is filtered.
+
+    Returns:
+        tuple: (artifact, performance) where performance identifies the attempt for publish_prepared_post
+    """
+    started_at = time.time()
+    started = time.perf_counter()
+    try:
+        with stage_span('generation'):
+            artifact = call_provider(provider, generate, *args)
+    except Exception as e:
+        release_combination(reservation)
+        if isinstance(e, ProviderUnavailable) and e.__cause__ is not None:  # the call ran and failed, rather than being rejected
+            record_prompt_attempt(provider, strategy, False)
+        raise
+    return record_generation(provider, strategy, artifact, started_at, time.perf_counter() - started, reservation)
+
+def record_generation(provider, strategy, artifact, started_at, seconds, reservation=None):
+    """
+    Record a successful generation attempt. Returns (artifact without its 'nsfw' flag, performance).
+    A filtered image is never published: its combination is released and ProviderUnavailable
+    raised, so prepare_post falls back to another provider.
+    """
+    nsfw = artifact.pop('nsfw', False)
+    attempt_id = record_prompt_attempt(provider, strategy, True, nsfw, seconds)
+    if nsfw:
+        release_combination(reservation)
+        raise ProviderUnavailable(f"{provider} filtered the image as NSFW")
+    return artifact, {'id': attempt_id, 'provider': provider, 'strategy': strategy, 'started_at': started_at}
+
+def prompt_performance_report():
+    """
+    Totals, rates and latency quantiles per provider and prompt strategy.
+    """
+    def quantiles(values):
+        return {f"p{pct}": round(percentile(values, pct), 3) if values else None for pct in (50, 95, 99)}
+
+    with state_db_lock:
+        load_prompt_performance()
+        return {
+            provider: {
+                strategy: {
+                    "attempts": stats['attempts'],
+                    "successes": stats['successes'],
+                    "nsfw": stats['nsfw'],
+                    "published": stats['published'],
+                    "success_rate": round(stats['successes'] / stats['attempts'], 3) if stats['attempts'] else None,
+                    "nsfw_rate": round(stats['nsfw'] / stats['attempts'], 3) if stats['attempts'] else None,
+                    "generation_seconds": quantiles(list(stats['generation_seconds'])),
+                    "e2e_seconds": quantiles(list(stats['e2e_seconds'])),
+                }
+                for strategy, stats in strategies.items()
+            }
+            for provider, strategies in prompt_performance.items()
+        }
+
+def reset_prompt_performance_store():
+    """
+    Clear prompt performance in memory and in the state store.
+    """
+    global prompt_performance
+    with state_db_lock:
+        get_state_db().execute("DELETE FROM prompt_attempts")
+        prompt_performance = {}
+
+# --- Job Checkpoints ---
+# Each post job records its progress in job_checkpoints as it goes: 'started', then 'uploaded'
+# (image in GCS), 'prepared' (caption written), then every target's container id and result,
+# and 'finished' once all targets published. A failed or interrupted job can be resumed from
+# there (/jobs/<id>/resume, or the sweeper) without paying for generation or captioning again.
+# Published targets are never retried, and a checkpointed container that turns out to be
+# PUBLISHED already is counted as published instead of being posted twice.
+
+checkpoint_job_var = contextvars.ContextVar('checkpoint_job', default=None)  # job id, set by run_job for post jobs
+CHECKPOINT_FIELDS = ('provider', 'prompt', 'image_url', 'mime_type', 'sha256', 'hashtags', 'caption', 'caption_provider', 'phash', 'encode', 'performance', 'prepared_at', 'fallback_from')
+
+def start_checkpoint(job_id, kind):
+    """
+    Create a job's checkpoint, or count another attempt when it is being resumed.
+    """
+    now = time.time()
+    with state_db_lock:
+        get_state_db().execute(
+            "INSERT INTO job_checkpoints (job_id, kind, stage, prepared, targets, attempts, created_at, updated_at) VALUES (?, ?, 'started', NULL, '{}', 1, ?, ?) "
+            "ON CONFLICT(job_id) DO UPDATE SET attempts = attempts + 1, updated_at = excluded.updated_at",
+            (job_id, kind, now, now))
+
+def load_checkpoint(job_id):
+    with state_db_lock:
+        row = get_state_db().execute(
+            "SELECT job_id, kind, stage, prepared, targets, attempts, created_at, updated_at FROM job_checkpoints WHERE job_id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    keys = ('job_id', 'kind', 'stage', 'prepared', 'targets', 'attempts', 'created_at', 'updated_at')
+    checkpoint = dict(zip(keys, row))
+    checkpoint['prepared'] = json.loads(checkpoint['prepared']) if checkpoint['prepared'] else None
+    checkpoint['targets'] = json.loads(checkpoint['targets'])
+    return checkpoint
+
+def checkpoint_prepared(stage, prepared):
+    """
+    Save the current job's prepared post at 'uploaded' or 'prepared'. No-op outside a post job.
+    """
+    job_id = checkpoint_job_var.get()
+    if job_id is None:
+        return
+    saved = {key: prepared[key] for key in CHECKPOINT_FIELDS if key in prepared}
+    with state_db_lock:
+        get_state_db().execute(
+            "UPDATE job_checkpoints SET stage = ?, prepared = ?, updated_at = ? WHERE job_id = ?",
+            (stage, json.dumps(saved), time.time(), job_id))
+
+def checkpoint_target(target, **fields):
+    """
+    Merge fields (container_id, status, id, error) into a target's entry in the current job's checkpoint.
+    """
+    job_id = checkpoint_job_var.get()
+    if job_id is None:
+        return
+    with state_db_lock:
+        db = get_state_db()
+        row = db.execute("SELECT targets FROM job_checkpoints WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return
+        targets = json.loads(row[0])
+        entry = targets.setdefault(target, {})
+        if 'status' in fields:  # a new result replaces the previous attempt's id or error
+            entry.pop('id', None)
+            entry.pop('error', None)
+        entry.update(fields)
+        db.execute("UPDATE job_checkpoints SET targets = ?, updated_at = ? WHERE job_id = ?", (json.dumps(targets), time.time(), job_id))
+
+def finish_checkpoint(job_id):
+    with state_db_lock:
+        get_state_db().execute("UPDATE job_checkpoints SET stage = 'finished', updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+def resume_post(job_id):
+    """
+    Job target that continues a post job from its checkpoint.
+    Without an uploaded image there is nothing to reuse, so the provider's pipeline runs again.
+    """
+    checkpoint = load_checkpoint(job_id)
+    print(f"--- Resuming job {job_id} from stage {checkpoint['stage']} (attempt {checkpoint['attempts']}) ---")
+    if checkpoint['stage'] == 'started':
+        return POST_PIPELINES[checkpoint['kind']]()
+    prepared = checkpoint['prepared']
+    if checkpoint['stage'] == 'uploaded':
+        print("Generating caption for the uploaded image...")
+        with stage_span('caption'):
+            prepared = add_caption(prepared, *generate_caption(prepared['prompt'], None, prepared['mime_type'], prepared['image_url']))
+    published = {target: result for target, result in checkpoint['targets'].items() if result.get('status') == 'published'}
+    container_ids = {target: result.get('container_id') for target, result in checkpoint['targets'].items() if target not in published}
+    remaining = [target for target in PUBLISHERS if target not in published]
+    return publish_prepared_post(prepared, remaining, container_ids, published)
+
+def enqueue_resume(job_id):
+    """
+    Queue a job to continue from its checkpoint under the same job id.
+
+    Returns:
+        tuple: (enqueue_job's result, checkpoint), or (None, None) when there is no checkpoint
+    """
+    checkpoint = load_checkpoint(job_id)
+    if checkpoint is None:
+        return None, None
+    return enqueue_job(checkpoint['kind'], resume_post, job_id, job_id=job_id), checkpoint
+
+def start_checkpoint_sweeper():
+    threading.Thread(target=sweep_checkpoints_forever, name='checkpoint-sweeper', daemon=True).start()
+    print(f"Started checkpoint sweeper (every {CHECKPOINT_SWEEP_SECONDS}s)")
+
+def sweep_checkpoints_forever():
+    while True:
+        time.sleep(CHECKPOINT_SWEEP_SECONDS)
+        try:
+            sweep_checkpoints()
+        except Exception as e:
+            print(f"Checkpoint sweep failed: {e}")
+
+def sweep_checkpoints():
+    """
+    Resume unfinished jobs that already have an uploaded image, are not running and have been idle
+    for CHECKPOINT_RETRY_AFTER_SECONDS, up to CHECKPOINT_MAX_ATTEMPTS attempts; drop old checkpoints.
+    """
+    now = time.time()
+    with state_db_lock:
+        db = get_state_db()
+        db.execute("DELETE FROM job_checkpoints WHERE updated_at < ?", (now - CHECKPOINT_RETENTION_SECONDS,))
+        job_ids = [row[0] for row in db.execute(
+            "SELECT job_id FROM job_checkpoints WHERE stage IN ('uploaded', 'prepared') AND attempts < ? AND updated_at < ? ORDER BY created_at",
+            (CHECKPOINT_MAX_ATTEMPTS, now - CHECKPOINT_RETRY_AFTER_SECONDS))]
+    for job_id in job_ids:
+        resumed, _ = enqueue_resume(job_id)
+        if resumed == JOB_ALREADY_ACTIVE:
+            continue
+        print(f"Checkpoint sweep resumed job {job_id}" if resumed else f"Checkpoint sweep could not queue job {job_id}, queue is full")
+
+# --- Idempotency ---
+# Cloud Scheduler and Cloud Run retry requests that time out, so one trigger can reach a post
+# endpoint more than once. Each accepted request's idempotency key is stored with its job id for
+# IDEMPOTENCY_TTL_SECONDS, and a repeat of the key gets the existing job back instead of a new one.
+# Keys are kept per instance (the state store is a local file), which covers retries of a request
+# that this instance accepted.
+
+idempotency_lock = threading.Lock()  # held from key lookup to key insert, so concurrent repeats queue one job
+
+def request_idempotency_key():
+    """
+    The current request's idempotency key, scoped to its path: the Idempotency-Key header, or
+    for Cloud Scheduler the job name plus its schedule time (or the current IDEMPOTENCY_SLOT_SECONDS
+    slot when the schedule time is missing). None when the request carries neither.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        scheduler_job = request.headers.get('X-CloudScheduler-JobName')
+        if not scheduler_job:
+            return None
+        slot = request.headers.get('X-CloudScheduler-ScheduleTime') or str(int(time.time() // IDEMPOTENCY_SLOT_SECONDS))
+        key = f"scheduler:{scheduler_job}:{slot}"
+    return f"{request.path}|{key}"
+
+def idempotent(enqueue):
+    """
+    Run an endpoint's enqueue call once per idempotency key.
+
+    Args:
+        enqueue: Callable returning the endpoint's response, job_response() style
+
+    Returns:
+        The response of enqueue(), or the existing job's status when the key was already used
+    """
+    key = request_idempotency_key() if IDEMPOTENCY_ENABLED else None
+    if key is None:
+        return enqueue()
+    now = time.time()
+    with idempotency_lock:
+        with state_db_lock:
+            db = get_state_db()
+            db.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (now,))
+            row = db.execute("SELECT job_id, created_at FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            job_id, created_at = row
+            job = get_job(job_id)
+            print(f"Duplicate request for {key}, returning job {job_id}")
+            status_url = f"/jobs/{job_id}"
+            return {"job_id": job_id, "status": job['status'] if job else 'unknown', "status_url": status_url,
+                    "duplicate": True, "first_seen_at": created_at}, 200, {'Location': status_url}
+        response = enqueue()
+        if isinstance(response, tuple) and response[1] == 202:  # only accepted jobs; a 503 can be retried
+            with state_db_lock:
+                get_state_db().execute("INSERT INTO idempotency_keys (key, job_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                                       (key, response[0]['job_id'], now, now + IDEMPOTENCY_TTL_SECONDS))
+        return response
+
+# --- Client Registry ---
+# SDK clients are created lazily, once per worker process, and shared by all threads so their
+# auth discovery, HTTP connections and gRPC channels are reused across requests.
+# Tests can swap any of them for a fake with set_client().
+
+client_factories = {}
+client_instances = {}
+client_locks = {}
+client_init_timings = {}  # name -> seconds spent in its factory, including lazy imports
+clients_lock = threading.Lock()
+
+def register_client(name, factory):
+    """
+    Register a zero-argument factory that builds the named client on first use.
+    """
+    with clients_lock:
+        client_factories[name] = factory
+        client_locks.setdefault(name, threading.Lock())
+
+def get_client(name):
+    """
+    Return the shared client for a name, building it with its factory on first use.
+    Only one thread builds a given client; others wait for it instead of building their own.
+    """
+    instance = client_instances.get(name)
+    if instance is not None:
+        return instance
+    with clients_lock:
+        lock = client_locks[name]
+    with lock:
+        instance = client_instances.get(name)
+        if instance is None:
+            print(f"Initializing {name} client...")
+            started = time.perf_counter()
+            instance = client_factories[name]()
+            client_init_timings[name] = time.perf_counter() - started
+            client_instances[name] = instance
+        return instance
+
+def set_client(name, instance):
+    """
+    Replace the shared client for a name, e.g. with a fake in tests.
+    """
+    with clients_lock:
+        client_locks.setdefault(name, threading.Lock())
+        client_instances[name] = instance
+
+def reset_clients():
+    """
+    Drop every shared client so the next get_client() builds a fresh one.
+    """
+    with clients_lock:
+        client_instances.clear()
+
+register_client('storage', lambda: lazy_import('google.cloud.storage').Client())
+register_client('genai', lambda: lazy_import('google.genai').Client(api_key=GEMINI_API_KEY))
+register_client('openai', lambda: lazy_import('openai').OpenAI(api_key=OPENAI_TOKEN))
+def new_stability_client():
+    """
+    Build the Stability client with PROVIDER_CALL_TIMEOUT_SECONDS as the gRPC deadline of every call.
+    It waits for the channel to be ready (wait_for_ready) and has no deadline of its own, so during
+    an outage a call would otherwise hang, and hold a provider_call_executor thread, forever.
+    """
+    client = lazy_import('stability_sdk.client').StabilityInference(
+        key=STABILITY_KEY,
+        verbose=True,
+        engine=STABILITY_ENGINE,)
+    if PROVIDER_CALL_TIMEOUT_SECONDS:
+        if isinstance(getattr(client, 'grpc_args', None), dict):
+            client.grpc_args['timeout'] = PROVIDER_CALL_TIMEOUT_SECONDS
+        else:
+            print("Stability client has no grpc_args; its calls run without a deadline")
+    return client
+
+register_client('stability', new_stability_client)
+
+# --- Warmup ---
+# Each step builds a shared client and makes one cheap call so its connection is open
+# before the first real job needs it.
+
+def warm_storage():
+    get_client('storage').bucket(GCS_BUCKET_NAME).exists()
+
+def warm_genai():
+    get_client('genai').models.get(model=GEMINI_CAPTION_MODEL)
+
+def warm_openai():
+    get_client('openai').models.retrieve(OPENAI_MODEL)
+
+def warm_stability():
+    # gRPC connects on the first call; importing the protobufs and building the channel is the expensive part
+    lazy_import(STABILITY_GENERATION_MODULE)
+    get_client('stability')
+
+def warm_instagram():
+    http_request('GET', f"{INSTAGRAM_GRAPH_URL}/me", params={'fields': 'id', 'access_token': PAGE_ACCESS_TOKEN})
+
+def warm_threads():
+    http_request('GET', f"{THREADS_GRAPH_URL}/me", params={'fields': 'id', 'access_token': THREADS_API_TOKEN})
+
+WARMUP_STEPS = {
+    'storage': warm_storage,
+    'instagram': warm_instagram,
+    'threads': warm_threads,
+    'stability': warm_stability,
+    'dalle': warm_openai,
+    'imagen': warm_genai,
+    'caption': warm_genai,
+}
+
+# --- HTTP Client ---
+# One keep-alive session per host, so the many Graph and Threads round trips of a post
+# reuse TLS connections instead of handshaking every time.
+
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def get_http_session(url):
+    """
+    Return the pooled session for the host of a URL, creating it on first use.
+    """
+    host = urlsplit(url).netloc
+    with http_sessions_lock:
+        session = http_sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            http_sessions[host] = session
+        return session
+
+def http_request(method, url, timeout=None, **kwargs):
+    """
+    Send a request through the pooled session for its host, with default timeouts and
+    retries with exponential backoff. Timeouts and retries stay within the current job's deadline.
+
+    429 responses are retried for every method, honouring Retry-After. 5xx responses and
+    connection errors are retried only for GET, because repeating a POST such as
+    media_publish after the server may have acted on it could publish twice.
+    Connect timeouts never reached the server and are retried for every method.
+
+    Returns the final requests.Response; callers check status_code as before.
+    """
+    method = method.upper()
+    idempotent = method in ('GET', 'HEAD')
+    session = get_http_session(url)
+    timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    attempt = 0
+    while True:
+        stage = f"{method} {urlsplit(url).netloc}"
+        attempt_timeout = tuple(budget_timeout(part, stage) for part in timeout) if isinstance(timeout, tuple) else budget_timeout(timeout, stage)
+        try:
+            response = session.request(method, url, timeout=attempt_timeout, **kwargs)
+        except requests.exceptions.ConnectTimeout as e:
+            if attempt >= HTTP_MAX_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+            print(f"Connect timeout for {method} {urlsplit(url).netloc}: {e}. Retrying in {delay:.1f}s")
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if isinstance(e, requests.exceptions.Timeout):
+                check_deadline(f"{stage} (request timed out)")
+            if not idempotent or attempt >= HTTP_MAX_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+            print(f"Request error for {method} {urlsplit(url).netloc}: {e}. Retrying in {delay:.1f}s")
+        else:
+            retryable = response.status_code == 429 or (idempotent and response.status_code in RETRY_STATUS_CODES)
+            if not retryable or attempt >= HTTP_MAX_RETRIES:
+                return response
+            delay = retry_delay(attempt, response.headers.get('Retry-After'))
+            print(f"Received status {response.status_code} for {method} {urlsplit(url).netloc}. Retrying in {delay:.1f}s")
+            response.close()
+        remaining = remaining_budget()
+        if remaining is not None and delay >= remaining:
+            raise DeadlineExceeded(f"Job deadline exceeded before retrying {stage}")
+        time.sleep(delay)
+        attempt += 1
+
+def retry_delay(attempt, retry_after=None):
+    """
+    Seconds to wait before the next retry: the server's Retry-After (seconds or HTTP date)
+    when given, otherwise exponential backoff with jitter. Capped at HTTP_MAX_BACKOFF_SECONDS.
+    """
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None:
+            return min(max(delay, 0), HTTP_MAX_BACKOFF_SECONDS)
+    delay = HTTP_BACKOFF_SECONDS * (2 ** attempt)
+    return min(delay * random.uniform(0.5, 1.5), HTTP_MAX_BACKOFF_SECONDS)
+
+# --- Utility Functions ---
+
+def run_strategy_sample(strategy_name, prompt, negative_prompt, seed):
+    """
+    Generate one Stability AI image for a prompt strategy and measure it.
+
+    Returns:
+        dict: strategy, seed, status ("success", "NSFW" or "error"), latency_seconds, output_bytes
+    """
+    print(f"Testing {strategy_name} strategy with seed {seed}: {prompt}")
+    generation = lazy_import(STABILITY_GENERATION_MODULE)
+    prompts = [generation.Prompt(text=prompt, parameters=generation.PromptParameters(weight=1.0))]
+    if negative_prompt:
+        prompts.append(generation.Prompt(text=negative_prompt, parameters=generation.PromptParameters(weight=-1.0)))
+
+    run = {"strategy": strategy_name, "seed": seed, "status": "error", "latency_seconds": None, "output_bytes": 0}
+    started = time.perf_counter()
+    try:
+        for resp in get_client('stability').generate(prompt=prompts, seed=seed):
+            for artifact in resp.artifacts:
+                if artifact.finish_reason == generation.FILTER:
+                    run['status'] = "NSFW"
+                elif artifact.type == generation.ARTIFACT_IMAGE and run['status'] != "NSFW":
+                    run['status'] = "success"
+                    run['output_bytes'] = len(artifact.binary)
+        if run['status'] == "error":
+            run['error'] = "No image returned"
+    except Exception as e:
+        print(f"Error testing {strategy_name}: {e}")
+        run['error'] = str(e)
+    run['latency_seconds'] = round(time.perf_counter() - started, 3)
+    record_prompt_attempt('stability', strategy_name, run['status'] != "error", run['status'] == "NSFW",
+                          run['latency_seconds'] if run['status'] != "error" else None)
+    return run
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of numbers, or None when it is empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(-(-len(ordered) * pct // 100)), 1)  # ceil(n * pct / 100)
+    return ordered[rank - 1]
+
+def upload_to_bucket(blob_name, data, bucket_name, content_type):
+    """
+    Upload in-memory image bytes to Google Cloud Storage and return its public URL.
+    """
+    # Reuse the process-wide Cloud Storage client
+    storage_client = get_client('storage')
+
+    # Get the bucket that the file will be uploaded to
+    bucket = storage_client.bucket(bucket_name)
+
+    # Create a new blob and upload the bytes straight from memory
+    blob = bucket.blob(blob_name)
+    blob.upload_from_string(data, content_type=content_type, timeout=budget_timeout(GCS_TIMEOUT_SECONDS, 'upload'))
+
+    # Make the blob publicly viewable
+    blob.make_public(timeout=budget_timeout(GCS_TIMEOUT_SECONDS, 'upload'))
+
+    # Return the public URL of the uploaded file
+    return blob.public_url
+
+def delete_from_bucket(image_url, bucket_name):
+    """
+    Delete an uploaded image from Google Cloud Storage given its public URL.
+    """
+    _, found, blob_name = urlsplit(image_url).path.partition(f"/{bucket_name}/")
+    if not found:
+        raise ValueError(f"{image_url} is not in bucket {bucket_name}")
+    get_client('storage').bucket(bucket_name).blob(unquote(blob_name)).delete()
+
+def stream_url_to_bucket(url, bucket_name):
+    """
+    Stream an image from a URL into a Google Cloud Storage resumable upload in
+    STREAM_CHUNK_SIZE chunks, hashing it on the way through, and make it public.
+    At most one chunk is held in memory, and the download overlaps the upload.
+
+    Returns:
+        dict: public_url, mime_type, size (bytes) and sha256 of the uploaded image
+    """
+    print(f"Streaming image into GCS from: {url}")
+    response = http_request('GET', url, stream=True)
+    with response:
+        if response.status_code != 200:
+            raise Exception(f"Failed to download image: {response.status_code}")
+        mime_type = response.headers.get('Content-Type', 'image/png').split(';')[0]
+        blob = get_client('storage').bucket(bucket_name).blob(new_blob_name(mime_type))
+        digest = hashlib.sha256()
+        size = 0
+        with blob.open('wb', chunk_size=STREAM_CHUNK_SIZE, content_type=mime_type, timeout=budget_timeout(GCS_TIMEOUT_SECONDS, 'upload')) as writer:
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                check_deadline('upload')
+                digest.update(chunk)
+                size += len(chunk)
+                writer.write(chunk)
+    blob.make_public(timeout=budget_timeout(GCS_TIMEOUT_SECONDS, 'upload'))
+    print(f"Streamed {size} bytes (sha256 {digest.hexdigest()}) to {blob.public_url}")
+    return {'public_url': blob.public_url, 'mime_type': mime_type, 'size': size, 'sha256': digest.hexdigest()}
+
+def new_blob_name(mime_type):
+    """
+    Return a unique blob name for an image, so concurrent jobs never overwrite each other.
+    """
+    extension = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/webp': '.webp'}.get(mime_type, '')
+    return f"{int(time.time())}_{uuid.uuid4().hex[:12]}{extension}"
+
+def exec_openai_vision(image_url, my_prompt=None, prompt_text=None):
+    """
+    Use OpenAI's vision model to generate a description for an image.
+    prompt_text replaces the default instruction built from my_prompt.
+    """
+    print(f"Generating OpenAI vision description for image: {image_url}")
+    openai = get_client('openai')
+    response = openai.chat.completions.create(**openai_vision_request(image_url, my_prompt, prompt_text))
+    ai_response = response.choices[0].message.content
+    print(f"OpenAI vision response: {ai_response}")
+    return ai_response
+
+def openai_vision_request(image_url, my_prompt=None, prompt_text=None):
+    """
+    Keyword arguments for a vision chat completion, shared with the async client in asgi.py.
+    """
+    return dict(
+        model=OPENAI_MODEL,
+        messages=[
+            {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": prompt_text or f"What are in this image? Describe it good for sns post. The image title tells that {my_prompt}",
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url,
+                    },
+                },
+            ],
+            }
+        ],
+        max_tokens=1000,
+        # A caption that lost the hedge cannot be interrupted, so it must not run unbounded outside a job
+        **openai_request_options(CAPTION_TIMEOUT_SECONDS),
+    )
+
+def gemini_chat_with_image(image_bytes, prompt_text, mime_type="image/jpeg", image_url=None, cancelled=None):
+    """
+    Use Gemini API to generate a caption for an image given a prompt.
+    The image is sent as in-memory bytes; when image_bytes is None (a streamed upload) they are
+    downloaded from image_url first, as the Gemini Developer API does not fetch arbitrary URLs.
+    Stops reading the stream once the optional cancelled event is set. Errors are raised.
+    """
+    try:
+        if image_bytes is None:
+            image_bytes = download_image(image_url)['data']
+        genai_client = get_client('genai')
+        # Generate content with image and text
+        response = ""
+        for chunk in genai_client.models.generate_content_stream(**gemini_caption_request(image_bytes, prompt_text, mime_type, image_url)):
+            if cancelled is not None and cancelled.is_set():
+                raise CaptionError("Gemini caption cancelled, another provider answered first")
+            response += chunk.text or ""
+        print(f"Gemini response: {response}")
+        return response
+
+    except Exception as e:
+        print(f"Error during image + text Gemini request: {e}")
+        raise
+
+def gemini_caption_request(image_bytes, prompt_text, mime_type, image_url):
+    """
+    Keyword arguments for a caption generate_content_stream call, shared with the async client in asgi.py.
+    """
+    types = lazy_import('google.genai.types')
+    print(f"Generating Gemini caption for {len(image_bytes)} bytes of {mime_type} ({image_url})")
+    image_part = types.Part.from_bytes(mime_type=mime_type, data=image_bytes)
+
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                image_part,
+                types.Part.from_text(text=prompt_text)
+            ],
+        )
+    ]
+    return {
+        'model': GEMINI_CAPTION_MODEL,
+        'contents': contents,
+        'config': types.GenerateContentConfig(response_mime_type="text/plain", http_options=genai_http_options(CAPTION_TIMEOUT_SECONDS)),
+    }
+
+def wait_for_media_ready(media_id, access_token, timeout=120):
+    """Waits for a media container to be ready for publishing."""
+    return wait_for_container('instagram', media_id, access_token, timeout)
+
+
+def wait_for_threads_media_ready(media_id, access_token, timeout=120):
+    """Waits for a Threads media container to be ready for publishing."""
+    return wait_for_container('threads', media_id, access_token, timeout)
+
+
+# --- Captions ---
+# Captions are requested from the first provider in CAPTION_PROVIDERS. If it has not answered
+# after its recent p95 caption time, the same caption is also requested from the next provider
+# (a hedged request) and the first usable answer wins. The loser's stream is stopped at its next
+# chunk and its answer discarded. Failed, empty or oversized answers never become captions.
+
+class CaptionError(Exception):
+    """
+    No caption provider returned a usable caption in time.
+    """
+
+CAPTION_CALLERS = {
+    'gemini': lambda prompt_text, image_bytes, mime_type, image_url, cancelled: gemini_chat_with_image(image_bytes, prompt_text, mime_type, image_url, cancelled),
+    'openai': lambda prompt_text, image_bytes, mime_type, image_url, cancelled: exec_openai_vision(image_url, prompt_text=prompt_text),
+}
+
+# Every prepare, whether a job, a batch item or a buffer producer, captions within its provider's
+# PROVIDER_CONCURRENCY slot, one request per caption provider at most. Losing requests can keep
+# their thread for up to CAPTION_TIMEOUT_SECONDS after the slot is freed, hence the factor 2.
+caption_executor = ThreadPoolExecutor(max_workers=sum(provider_concurrency(p) for p in POST_PREPARERS) * len(CAPTION_CALLERS) * 2,
+                                      thread_name_prefix='caption')
+caption_samples = {provider: deque(maxlen=CAPTION_WINDOW) for provider in CAPTION_CALLERS}  # seconds of usable answers
+caption_samples_lock = threading.Lock()
+
+def caption_hedge_delay(provider):
+    """
+    Seconds to wait for a provider before hedging: its CAPTION_HEDGE_QUANTILE caption time, or
+    CAPTION_HEDGE_DELAY_SECONDS until it has CAPTION_MIN_SAMPLES answers.
+    """
+    with caption_samples_lock:
+        durations = list(caption_samples[provider])
+    if len(durations) < CAPTION_MIN_SAMPLES:
+        return CAPTION_HEDGE_DELAY_SECONDS
+    return max(CAPTION_HEDGE_MIN_DELAY_SECONDS, percentile(durations, CAPTION_HEDGE_QUANTILE))
+
+CAPTION_ERROR_PREFIX = "Error: "  # what caption helpers used to return instead of raising
+
+def usable_caption(text):
+    """
+    Return the caption stripped, or raise CaptionError if it must not be posted.
+    """
+    text = (text or '').strip()
+    if not text:
+        raise CaptionError("empty caption")
+    if text.startswith(CAPTION_ERROR_PREFIX):
+        raise CaptionError(f"provider returned an error as caption: {text[:80]}")
+    if len(text) > CAPTION_MAX_LENGTH:
+        raise CaptionError(f"caption is {len(text)} characters, limit {CAPTION_MAX_LENGTH}")
+    return text
+
+def request_caption(provider, prompt_text, image_bytes, mime_type, image_url, cancelled):
+    """
+    One provider's caption attempt, run on caption_executor. Records its time when usable.
+    """
+    started = time.perf_counter()
+    text = usable_caption(CAPTION_CALLERS[provider](prompt_text, image_bytes, mime_type, image_url, cancelled))
+    record_caption_sample(provider, time.perf_counter() - started)
+    return text
+
+def record_caption_sample(provider, seconds):
+    with caption_samples_lock:
+        caption_samples[provider].append(seconds)
+
+def generate_caption(my_prompt, image_bytes, mime_type, image_url):
+    """
+    Caption an image, hedging slow providers with the next one in CAPTION_PROVIDERS.
+    Gemini gets the image as bytes (downloaded from image_url when image_bytes is None), OpenAI by its public URL.
+
+    Returns:
+        tuple: (caption text, provider that wrote it)
+
+    Raises:
+        CaptionError: when every provider failed or none answered within CAPTION_TIMEOUT_SECONDS
+        DeadlineExceeded: when the job's deadline came first
+    """
+    providers = [provider for provider in CAPTION_PROVIDERS if provider in CAPTION_CALLERS]
+    if not providers:
+        raise CaptionError(f"No caption provider configured (CAPTION_PROVIDERS={CAPTION_PROVIDERS})")
+    prompt_text = get_chat_with_image_template(my_prompt)
+    cancelled = threading.Event()
+    budget = budget_timeout(CAPTION_TIMEOUT_SECONDS, 'caption')
+    deadline = time.monotonic() + budget
+    pending = {}  # future -> provider
+    errors = []
+    next_index, hedge_at = 0, time.monotonic()
+    try:
+        while pending or next_index < len(providers):
+            now = time.monotonic()
+            if now >= deadline:
+                if budget < CAPTION_TIMEOUT_SECONDS:
+                    raise DeadlineExceeded(f"Job deadline exceeded waiting for a caption from {', '.join(pending.values())}")
+                raise CaptionError(f"No caption within {CAPTION_TIMEOUT_SECONDS}s from {', '.join(pending.values())}")
+            if next_index < len(providers) and (not pending or now >= hedge_at):
+                provider = providers[next_index]
+                if pending:
+                    print(f"Caption from {', '.join(pending.values())} is slow, hedging with {provider}")
+                    increment_counter('instabot_caption_hedges_total', provider=provider)
+                future = submit_traced(caption_executor, request_caption, provider, prompt_text, image_bytes, mime_type, image_url, cancelled)
+                pending[future] = provider
+                next_index += 1
+                hedge_at = now + caption_hedge_delay(provider)
+                continue
+            wait_until = min(deadline, hedge_at) if next_index < len(providers) else deadline
+            done, _ = wait(pending, timeout=max(0, wait_until - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    text = future.result()
+                except Exception as e:
+                    print(f"Caption from {provider} failed: {e}")
+                    increment_counter('instabot_caption_requests_total', provider=provider, outcome='failed')
+                    errors.append(f"{provider}: {e}")
+                    continue
+                increment_counter('instabot_caption_requests_total', provider=provider, outcome='won')
+                return text, provider
+        raise CaptionError(f"No usable caption ({'; '.join(errors)})")
+    finally:
+        cancelled.set()
+        for future, provider in pending.items():
+            future.cancel()
+            increment_counter('instabot_caption_requests_total', provider=provider, outcome='cancelled')
+
+def caption_latency_report():
+    """
+    Caption p50/p95, sample count and current hedge delay per provider.
+    """
+    report = {}
+    for provider in CAPTION_CALLERS:
+        with caption_samples_lock:
+            durations = list(caption_samples[provider])
+        report[provider] = {
+            "samples": len(durations),
+            "p50_seconds": round(percentile(durations, 50), 2) if durations else None,
+            "p95_seconds": round(percentile(durations, 95), 2) if durations else None,
+            "hedge_delay_seconds": round(caption_hedge_delay(provider), 2),
+        }
+    return report
+
+# --- Container Status Poller ---
+# A single background thread polls every in-flight Instagram and Threads container, across all
+# jobs. Containers that are due at the same time are checked with one multi-ID Graph API call
+# (?ids=a,b,c), and each container's first poll is scheduled from the observed time-to-FINISHED
+# instead of a fixed interval. Waiters block on a condition and are woken when a status changes.
+
+CONTAINER_KINDS = {
+    'instagram': {'base_url': INSTAGRAM_GRAPH_URL, 'field': 'status_code', 'label': 'media container'},
+    'threads': {'base_url': THREADS_GRAPH_URL, 'field': 'status', 'label': 'Threads media container'},
+}
+CONTAINER_FAILED_STATUSES = ('ERROR', 'EXPIRED')
+
+watched_containers = {}  # (kind, media_id) -> poll state
+container_ready_estimates = {kind: STATUS_POLL_INITIAL_ESTIMATE for kind in CONTAINER_KINDS}  # seconds to FINISHED
+batch_status_paused_until = {kind: 0.0 for kind in CONTAINER_KINDS}  # monotonic time multi-ID lookups resume
+poller_stats = {'api_calls': 0, 'containers_checked': 0, 'finished': 0, 'failed': 0, 'timed_out': 0}
+poller_condition = threading.Condition()
+poller_thread = None
+
+def wait_for_container(kind, media_id, access_token, timeout=120):
+    """
+    Register a container with the shared poller and block until it is FINISHED.
+    Raises if it reaches ERROR/EXPIRED or is not ready within timeout seconds, and
+    DeadlineExceeded if the job's deadline comes first.
+    """
+    label = CONTAINER_KINDS[kind]['label']
+    print(f"Waiting for {label} {media_id} to be ready...")
+    key = (kind, media_id)
+    budget = budget_timeout(timeout, f"waiting for {label}")
+    deadline = time.monotonic() + budget
+    with poller_condition:
+        watch_container(kind, media_id, access_token)
+        try:
+            while True:
+                entry = watched_containers[key]
+                if entry['status'] == 'FINISHED':
+                    print(f"{label} {media_id} is ready for publishing.")
+                    return True
+                if entry['status'] in CONTAINER_FAILED_STATUSES:
+                    raise Exception(f"{label} failed with status: {entry['status']}. Full response: {entry['data']}")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    poller_stats['timed_out'] += 1
+                    if budget < timeout:
+                        raise DeadlineExceeded(f"Job deadline exceeded waiting for {label} {media_id}")
+                    raise Exception(f"{label} not ready after {timeout} seconds.")
+                poller_condition.wait(remaining)
+        finally:
+            watched_containers.pop(key, None)
+
+def watch_container(kind, media_id, access_token, wake=None):
+    """
+    Register a container with the poller. wake, if given, is called from the poller thread
+    after each status check. Caller must hold poller_condition.
+
+    Returns:
+        dict: the poll state entry, whose 'status' and 'data' the poller updates
+    """
+    ensure_poller_thread()
+    now = time.monotonic()
+    entry = watched_containers[(kind, media_id)] = {
+        'kind': kind,
+        'media_id': media_id,
+        'access_token': access_token,
+        'status': None,
+        'data': None,
+        'registered_at': now,
+        'last_pending_at': now,
+        'next_poll': now + container_ready_estimates[kind],
+        'overdue_polls': 0,
+        'wake': wake,
+    }
+    poller_condition.notify_all()
+    return entry
+
+def ensure_poller_thread():
+    """
+    Start the poller thread if it is not running. Caller must hold poller_condition.
+    """
+    global poller_thread
+    if poller_thread is None or not poller_thread.is_alive():
+        poller_thread = threading.Thread(target=poll_containers_forever, name='container-poller', daemon=True)
+        poller_thread.start()
+
+def poll_containers_forever():
+    """
+    Poller thread: wait until some containers are due, check them in batches and publish the results.
+    """
+    while True:
+        with poller_condition:
+            while True:
+                now = time.monotonic()
+                pending = [entry for entry in watched_containers.values() if entry['status'] not in ('FINISHED',) + CONTAINER_FAILED_STATUSES]
+                due = [entry for entry in pending if entry['next_poll'] <= now]
+                if due:
+                    break
+                poller_condition.wait(min((entry['next_poll'] for entry in pending), default=now + 60) - now)
+            groups = {}
+            for entry in due:
+                groups.setdefault((entry['kind'], entry['access_token']), []).append(entry['media_id'])
+
+        results = {}
+        for (kind, access_token), media_ids in groups.items():
+            for start in range(0, len(media_ids), STATUS_POLL_BATCH_SIZE):
+                batch = media_ids[start:start + STATUS_POLL_BATCH_SIZE]
+                try:
+                    for media_id, (status, data) in fetch_container_statuses(kind, batch, access_token).items():
+                        results[(kind, media_id)] = (status, data)
+                except Exception as e:
+                    print(f"Warning: failed to check {kind} container status for {batch}: {e}")
+
+        with poller_condition:
+            now = time.monotonic()
+            for entry in due:
+                key = (entry['kind'], entry['media_id'])
+                if watched_containers.get(key) is not entry:
+                    continue  # waiter already gave up
+                status, data = results.get(key, (None, None))
+                record_container_status(entry, status, data, now)
+                if entry['wake'] is not None:
+                    entry['wake']()
+            poller_condition.notify_all()
+
+def record_container_status(entry, status, data, now):
+    """
+    Apply a polled status to a watched container and schedule its next poll.
+    Caller must hold poller_condition.
+    """
+    kind = entry['kind']
+    if status and status != entry['status']:
+        print(f"Current {CONTAINER_KINDS[kind]['label']} {entry['media_id']} status: {status}")
+    entry['status'] = status or entry['status']
+    entry['data'] = data
+    if status == 'FINISHED':
+        # It became ready somewhere between the last pending poll and now; use the midpoint.
+        observed = ((entry['last_pending_at'] + now) / 2) - entry['registered_at']
+        container_ready_estimates[kind] = (1 - STATUS_POLL_EWMA_WEIGHT) * container_ready_estimates[kind] + STATUS_POLL_EWMA_WEIGHT * observed
+        poller_stats['finished'] += 1
+        return
+    if status in CONTAINER_FAILED_STATUSES:
+        poller_stats['failed'] += 1
+        return
+    if status:
+        entry['last_pending_at'] = now
+    entry['next_poll'] = now + next_poll_delay(entry, now)
+
+def next_poll_delay(entry, now):
+    """
+    Seconds until a pending container is checked again: wait out the expected time-to-FINISHED,
+    then back off exponentially from STATUS_POLL_MIN_INTERVAL up to STATUS_POLL_MAX_INTERVAL.
+    """
+    age = now - entry['registered_at']
+    expected = container_ready_estimates[entry['kind']]
+    if age < expected:
+        return max(STATUS_POLL_MIN_INTERVAL, expected - age)
+    delay = STATUS_POLL_MIN_INTERVAL * (2 ** entry['overdue_polls'])
+    entry['overdue_polls'] += 1
+    return min(delay, STATUS_POLL_MAX_INTERVAL)
+
+def fetch_container_statuses(kind, media_ids, access_token):
+    """
+    Check the status of several containers, with one multi-ID call where the API accepts it
+    and one call per container otherwise.
 
-    # Upload the image to Facebook as story
-    print("Uploading image for story...")
-    url = f"https://graph.instagram.com/v22.0/{BUSINESS_ACCOUNT_ID}/media"
-    params = {'access_token': PAGE_ACCESS_TOKEN, 'image_url':image_url, 'media_type':'STORIES'}
+    Returns:
+        dict: media_id -> (status, response data); containers whose check failed are omitted
+    """
+    config = CONTAINER_KINDS[kind]
+    field = config['field']
+    with poller_condition:
+        batch = len(media_ids) > 1 and time.monotonic() >= batch_status_paused_until[kind]
+        if batch:
+            poller_stats['api_calls'] += 1
+            poller_stats['containers_checked'] += len(media_ids)
+    if batch:
+        response = http_request('GET', f"{config['base_url']}/", params={'ids': ','.join(media_ids), 'fields': field, 'access_token': access_token})
+        if response.status_code == 200:
+            data = response.json()
+            return {media_id: (data[media_id].get(field), data[media_id]) for media_id in media_ids if media_id in data}
+        if response.status_code in (401, 403) or graph_error_code(response) == 190:
+            # The token is rejected; polling one by one would fail the same way
+            print(f"Warning: Received status {response.status_code} when checking {kind} media status: {response.text}")
+            return {}
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            # Possibly unsupported, possibly one bad id; pause rather than give up on batching for good
+            print(f"Multi-ID status lookup rejected for {kind} ({response.status_code}), polling containers one by one "
+                  f"for {STATUS_POLL_BATCH_RETRY_SECONDS:.0f}s.")
+            with poller_condition:
+                batch_status_paused_until[kind] = time.monotonic() + STATUS_POLL_BATCH_RETRY_SECONDS
+        else:
+            print(f"Warning: Received status {response.status_code} when checking {kind} media status.")
+            return {}
+
+    statuses = {}
+    for media_id in media_ids:
+        with poller_condition:
+            poller_stats['api_calls'] += 1
+            poller_stats['containers_checked'] += 1
+        response = http_request('GET', f"{config['base_url']}/{media_id}", params={'fields': field, 'access_token': access_token})
+        if response.status_code != 200:
+            print(f"Warning: Received status {response.status_code} when checking {kind} media status.")
+            continue
+        data = response.json()
+        statuses[media_id] = (data.get(field), data)
+    return statuses
+
+def graph_error_code(response):
+    """
+    The Graph API error code of a failed response, or None.
+    """
+    try:
+        data = response.json()
+    except ValueError:
+        return None
+    return data.get('error', {}).get('code') if isinstance(data, dict) else None
+
+
+def create_instagram_container(image_url, caption=None, media_type=None):
+    """
+    Create an Instagram media container for an image and return its ID.
+    """
+    url = f"{INSTAGRAM_GRAPH_URL}/{BUSINESS_ACCOUNT_ID}/media"
+    params = {'access_token': PAGE_ACCESS_TOKEN, 'image_url': image_url}
+    if caption:
+        params['caption'] = caption
+    if media_type:
+        params['media_type'] = media_type
     print("--- REQUEST ---")
     print(f"  Method: POST")
     print(f"  URL: {url}")
     print(f"  Params: {params}")
-    response = requests.post(url, params=params)
+    response = http_request('POST', url, params=params)
     print("--- RESPONSE ---")
     print(f"  Status Code: {response.status_code}")
     print(f"  Text: {response.text}")
     if response.status_code != 200:
-        print(f"Failed to upload image for story: {response.text}")
+        print(f"Failed to upload image: {response.text}")
         raise Exception(f"Failed to upload image: {response.text}")
-    media_id = response.json()['id']
-    print(f"Created media container for story with ID: {media_id}")
-
-    # Wait for the media container to be ready
-    wait_for_media_ready(media_id, PAGE_ACCESS_TOKEN)
+    return response.json()['id']
 
-    # Publish the photo to Instagram as story
-    print(f"Publishing story with creation ID: {media_id}")
-    url = f"https://graph.instagram.com/v22.0/{BUSINESS_ACCOUNT_ID}/media_publish"
+def publish_instagram_container(media_id):
+    """
+    Publish a ready Instagram media container and return the published media ID.
+    """
+    url = f"{INSTAGRAM_GRAPH_URL}/{BUSINESS_ACCOUNT_ID}/media_publish"
     params = {'access_token': PAGE_ACCESS_TOKEN, 'creation_id': media_id}
     print("--- REQUEST ---")
     print(f"  Method: POST")
     print(f"  URL: {url}")
     print(f"  Params: {params}")
-    response = requests.post(url, params=params)
+    response = http_request('POST', url, params=params)
     print("--- RESPONSE ---")
     print(f"  Status Code: {response.status_code}")
     print(f"  Text: {response.text}")
     if response.status_code != 200:
-        print(f"Failed to publish photo for story: {response.text}")
+        print(f"Failed to publish photo: {response.text}")
         raise Exception(f"Failed to publish photo: {response.text}")
-    
-    print('instagram Image uploaded and published successfully!')
+    return response.json()['id']
 
-def exec_threads_post(image_url, text = ''):
+def create_threads_container(image_url, text=''):
     """
-    Post an image and optional text to Threads in a single post.
+    Create a Threads media container for an image and optional text and return its ID.
     """
-    print("Executing Threads post...")
     # Truncate text to 500 characters as required by Threads API
     if len(text) > 500:
         text = text[:500]
         print("Text truncated to 500 characters for Threads API.")
 
-    # --- Step 1: Create media container for image and text ---
     print("--- REQUEST (Media Container) ---")
-    url = f"https://graph.threads.net/v1.0/{THREADS_USER_ID}/threads"
-    
+    url = f"{THREADS_GRAPH_URL}/{THREADS_USER_ID}/threads"
     params = {
         'access_token': THREADS_API_TOKEN,
         'media_type': 'IMAGE',
@@ -825,50 +3428,175 @@ def exec_threads_post(image_url, text = ''):
         params['text'] = text
 
     print(f"  Method: POST, URL: {url}, Params: {params}")
-    response = requests.post(url, params=params)
+    response = http_request('POST', url, params=params)
     print(f"--- RESPONSE ---\n  Status: {response.status_code}\n  Text: {response.text}")
-    
+
     if response.status_code != 200:
         raise Exception(f"Failed to create media container on Threads: {response.text}")
-    
-    container_id = response.json()['id']
-    print(f"Created media container with ID: {container_id}")
-
-    # --- Step 2: Wait for media container to be ready ---
-    if not wait_for_threads_media_ready(container_id, THREADS_API_TOKEN):
-        raise Exception("Media container was not ready in time.")
+    return response.json()['id']
 
-    # --- Step 3: Publish the media container ---
+def publish_threads_container(container_id):
+    """
+    Publish a ready Threads media container and return the post ID.
+    """
     print("--- REQUEST (Publish Media) ---")
-    url = f"https://graph.threads.net/v1.0/{THREADS_USER_ID}/threads_publish"
+    url = f"{THREADS_GRAPH_URL}/{THREADS_USER_ID}/threads_publish"
     params = {'access_token': THREADS_API_TOKEN, 'creation_id': container_id}
-    
+
     print(f"  Method: POST, URL: {url}, Params: {params}")
-    response = requests.post(url, params=params)
+    response = http_request('POST', url, params=params)
     print(f"--- RESPONSE ---\n  Status: {response.status_code}\n  Text: {response.text}")
-    
+
     if response.status_code != 200:
         raise Exception(f"Failed to publish post to Threads: {response.text}")
-        
-    post_id = response.json()['id']
-    print(f"Successfully published Threads post with ID: {post_id}")
+    return response.json()['id']
 
-def remove_img_file(image_path):
+def publish_instagram_feed(image_url, caption, container_id=None):
     """
-    Remove a temporary image file from the filesystem.
+    Create, wait for and publish an Instagram feed post. Returns the published media ID.
     """
-    if os.path.exists(image_path): # check if the file exists
-        os.remove(image_path) # delete the file
-        print(f"{image_path} has been deleted.")
-    else:
-        print(f"{image_path} does not exist.")
-        
+    media_id = prepare_container('instagram', 'instagram_feed', container_id, PAGE_ACCESS_TOKEN,
+                                 lambda: create_instagram_container(image_url, caption=caption))
+    if media_id is None:
+        return None
+    print(f"Created media container for post with ID: {media_id}")
+    with stage_span('status_poll', target='instagram_feed'):
+        wait_for_media_ready(media_id, PAGE_ACCESS_TOKEN)
+    print(f"Publishing post with creation ID: {media_id}")
+    with stage_span('publish', target='instagram_feed'):
+        return publish_instagram_container(media_id)
+
+def publish_instagram_story(image_url, caption, container_id=None):
+    """
+    Create, wait for and publish an Instagram story. Stories carry no caption.
+    Returns the published media ID.
+    """
+    media_id = prepare_container('instagram', 'instagram_story', container_id, PAGE_ACCESS_TOKEN,
+                                 lambda: create_instagram_container(image_url, media_type='STORIES'))
+    if media_id is None:
+        return None
+    print(f"Created media container for story with ID: {media_id}")
+    with stage_span('status_poll', target='instagram_story'):
+        wait_for_media_ready(media_id, PAGE_ACCESS_TOKEN)
+    print(f"Publishing story with creation ID: {media_id}")
+    with stage_span('publish', target='instagram_story'):
+        return publish_instagram_container(media_id)
+
+def publish_threads(image_url, caption, container_id=None):
+    """
+    Create, wait for and publish a Threads post. Returns the post ID.
+    """
+    container_id = prepare_container('threads', 'threads', container_id, THREADS_API_TOKEN,
+                                     lambda: create_threads_container(image_url, caption))
+    if container_id is None:
+        return None
+    print(f"Created media container with ID: {container_id}")
+    with stage_span('status_poll', target='threads'):
+        wait_for_threads_media_ready(container_id, THREADS_API_TOKEN)
+    with stage_span('publish', target='threads'):
+        return publish_threads_container(container_id)
+
+def prepare_container(kind, target, container_id, access_token, create):
+    """
+    Return the container to publish for a target: a checkpointed one from an earlier attempt
+    if it can still be published, otherwise a new one from create(), checkpointed right away.
+    Returns None when the checkpointed container was already published.
+    """
+    if container_id:
+        status = fetch_container_statuses(kind, [container_id], access_token).get(container_id, (None, None))[0]
+        action = checkpointed_container_action(target, container_id, status)
+        if action == 'published':
+            return None
+        if action == 'reuse':
+            return container_id
+    with stage_span('container_create', target=target):
+        container_id = create()
+    checkpoint_target(target, container_id=container_id)
+    return container_id
+
+def checkpointed_container_action(target, container_id, status):
+    """
+    Decide what to do with a checkpointed container given its current status:
+    'published' (skip the target), 'reuse' it, or 'create' a new one.
+    """
+    if status == 'PUBLISHED':
+        print(f"Checkpointed {target} container {container_id} is already published, not posting again.")
+        return 'published'
+    if status is None:
+        # Publishing a new container could post twice if this one went out after all
+        raise RuntimeError(f"Could not check checkpointed {target} container {container_id}")
+    if status in ('FINISHED', 'IN_PROGRESS'):
+        print(f"Reusing checkpointed {target} container {container_id} ({status}).")
+        return 'reuse'
+    print(f"Checkpointed {target} container {container_id} is {status}, creating a new one.")
+    return 'create'
+
+# Each target runs its own container lifecycle, so they can all proceed at once.
+PUBLISHERS = {
+    'instagram_feed': publish_instagram_feed,
+    'instagram_story': publish_instagram_story,
+    'threads': publish_threads,
+}
+publish_executor = ThreadPoolExecutor(max_workers=POST_WORKER_CONCURRENCY * len(PUBLISHERS), thread_name_prefix='publish')
+publish_executor_var = contextvars.ContextVar('publish_executor', default=None)  # set by run_batch_post to its own pool
+
+def publish_to_targets(image_url, caption, targets=tuple(PUBLISHERS), container_ids=None):
+    """
+    Publish an image to several targets concurrently.
+    Each target creates its container (or reuses the one in container_ids), waits for it and
+    publishes as soon as it is ready, independently of the others. Targets run on
+    publish_executor, or on the pool run_batch_post set up for its items.
+
+    Returns:
+        dict: target -> {"status": "published", "id": ...} or {"status": "failed", "error": ...}
+    """
+    container_ids = container_ids or {}
+    executor = publish_executor_var.get() or publish_executor
+    futures = {target: submit_traced(executor, PUBLISHERS[target], image_url, caption, container_ids.get(target)) for target in targets}
+    results = {}
+    for target, future in futures.items():
+        try:
+            results[target] = {"status": "published", "id": wait_for_publish(target, future)}
+            print(f"Published to {target}: {results[target]['id']}")
+        except DeadlineExceeded as e:
+            print(f"Publishing to {target} timed out: {e}")
+            results[target] = {"status": "timed_out", "error": str(e)}
+        except Exception as e:
+            print(f"Failed to publish to {target}: {e}")
+            results[target] = {"status": "failed", "error": str(e)}
+        checkpoint_target(target, **results[target])
+    return results
+
+def wait_for_publish(target, future):
+    """
+    Wait for a target's publish within the job's budget. A target still queued for a publish
+    thread when the budget runs out is cancelled; one already running is waited for, since it
+    may have published and its own waits are bounded by the budget.
+    """
+    timeout = budget_limit()
+    if timeout is None:
+        return future.result()
+    try:
+        return future.result(timeout=max(timeout, 0))
+    except FuturesTimeoutError:
+        if future.cancel():
+            raise DeadlineExceeded(f"Job deadline exceeded waiting for a {target} publish thread") from None
+        return future.result()
+
 def get_chat_with_image_template(prompt):
     """
     Return a template prompt for describing an image for social media.
     """
     return f"What are in this image? Describe it good for sns post. Return only text of description. The image title tells that {prompt}."
 
+if CONTENT_BUFFER_PROVIDERS:
+    start_content_buffer()
+if CHECKPOINTS_ENABLED and CHECKPOINT_SWEEP_SECONDS > 0:
+    start_checkpoint_sweeper()
+
+MODULE_LOAD_SECONDS = time.perf_counter() - MODULE_LOAD_STARTED
+print(f"main.py loaded in {MODULE_LOAD_SECONDS:.3f}s")
+
 if __name__ == '__main__':
     # Run the Flask app in debug mode for local development
     app.run(debug=True)